@@ -0,0 +1,431 @@
+# Cold archive
+# The scenarios look back a week to a year (weight_change_past_year), but
+# the event tables keep every row ever logged. archive_months() moves the
+# rows of whole months older than a horizon, at least MIN_HORIZON_DAYS, out
+# of the hot database into a compressed cold store next to it,
+# health_and_fitness.archive.db, so the hot file stays small enough for its
+# pages to stay cached. Each (table, user, month) is one zlib-compressed
+# batch in the store, with the meal food items of its meals, and leaves a
+# stub in archive_stubs; archived_rows() reads the batches of a date range
+# back on demand for the scenarios that take one.
+#
+# Archived months are closed: the ORM refuses to write rows of the archived
+# tables dated in them, and the rollup rebuilds keep their rollups (see
+# rollups.py), which stay hot. Rows already moved into partitions (see
+# partitions.py) stay there. With user shards (see shards.py) each shard has
+# a cold store of its own; the commands below go through every shard.
+#
+#     python3 archive.py run --horizon-days 400
+#     python3 archive.py list
+from models import (
+    Base, Meal, WaterIntake, SleepLog, Workout, HealthMetric, ArchiveStub
+)
+from sqlalchemy import create_engine, event, exists, func, inspect, select, \
+    text, tuple_
+from sqlalchemy.orm import Session
+from datetime import date, timedelta
+from functools import lru_cache
+from itertools import islice
+import argparse
+import json
+import os
+import time
+import zlib
+
+# Tables archived by month, with their models
+ARCHIVED_MODELS = {
+    'workouts': Workout,
+    'meals': Meal,
+    'water_intake': WaterIntake,
+    'sleep_logs': SleepLog,
+    'health_metrics': HealthMetric,
+}
+
+# Tables whose rows go with the archived row they belong to: table ->
+# (foreign key column, archived table)
+ARCHIVE_CHILDREN = {'meal_food_items': ('meal_id', 'meals')}
+
+# The longest look-back of the scenarios is a year, so no horizon may be
+# shorter; rows newer than this are never archived
+MIN_HORIZON_DAYS = 366
+DEFAULT_HORIZON_DAYS = 400
+
+# (table, user, month) batches archived per transaction, so the hot
+# database's write lock is held briefly and an interrupted run loses little
+BATCHES_PER_TRANSACTION = 50
+
+# Rows deleted per statement
+MAX_IDS_PER_STATEMENT = 10000
+
+COLD_SCHEMA = ('CREATE TABLE IF NOT EXISTS archive_batches ('
+               'table_name TEXT NOT NULL, user_id INTEGER NOT NULL, '
+               'month DATE NOT NULL, data BLOB NOT NULL, '
+               'PRIMARY KEY (table_name, user_id, month)) WITHOUT ROWID')
+
+
+class ArchiveError(RuntimeError):
+    pass
+
+
+# Cold store file of a database file, next to it
+def archive_path(main_path):
+    stem, extension = os.path.splitext(main_path)
+    return f'{stem}.archive{extension or ".db"}'
+
+
+# Path of the main database file of a connection
+def _main_path(connection):
+    path = next(row[2] for row in connection.exec_driver_sql(
+        'PRAGMA database_list') if row[1] == 'main')
+    if not path:
+        raise ArchiveError("An in-memory database has no cold store.")
+    return path
+
+
+# Engine of the cold store of a database file, created on first use
+@lru_cache(maxsize=None)
+def cold_engine(main_path):
+    engine = create_engine(f'sqlite:///{archive_path(main_path)}')
+    with engine.begin() as connection:
+        connection.exec_driver_sql('PRAGMA journal_mode=WAL')
+        connection.exec_driver_sql(COLD_SCHEMA)
+    return engine
+
+
+# First day of the month of a day
+def _month(day):
+    return day.replace(day=1)
+
+
+def _next_month(month):
+    return (month + timedelta(days=31)).replace(day=1)
+
+
+# Day of a date, datetime or ISO string bound, None for an open end
+def _day(value):
+    if value is None or type(value) is date:
+        return value
+    if isinstance(value, date):
+        return value.date()
+    return date.fromisoformat(str(value)[:10])
+
+
+# Whether rows dated from start on may be archived: archived months are at
+# least MIN_HORIZON_DAYS old, so only ranges reaching that far back need to
+# look at the stubs
+def may_be_archived(start):
+    start = _day(start)
+    return start is None \
+        or start < date.today() - timedelta(days=MIN_HORIZON_DAYS)
+
+
+# Batch of rows as stored: {table: {"columns": [...], "rows": [[...]]}} of
+# the raw SQLite values, as compressed JSON
+def _encode(batch):
+    return zlib.compress(json.dumps(batch, separators=(',', ':')).encode())
+
+
+def _decode(data):
+    return json.loads(zlib.decompress(data))
+
+
+# Rows of an archived table and its children from two batches of the same
+# key, the newer rows replacing older ones with the same id
+def _merge(older, newer):
+    merged = {}
+    for table in older.keys() | newer.keys():
+        columns = (newer.get(table) or older[table])['columns']
+        rows = {}
+        for batch in (older, newer):
+            if table in batch:
+                rows.update(zip(_ids(batch[table]), batch[table]['rows']))
+        merged[table] = {'columns': columns,
+                         'rows': [rows[id] for id in sorted(rows)]}
+    return merged
+
+
+# EXISTS criterion: the month of a user's row dated on date_column is
+# archived, in any table
+def archived_month(user_column, date_column):
+    return exists().where(
+        ArchiveStub.user_id == user_column,
+        ArchiveStub.month == func.date(date_column, 'start of month'))
+
+
+# Ids of the rows archiving leaves hot whatever their date: the rows holding
+# the highest ids, so SQLite never hands out an archived id again (see
+# partitions._kept_ids), and each user's latest reading, which
+# user_latest_state points at
+def _kept_ids(connection):
+    kept = {table: set() for table in ARCHIVED_MODELS}
+    for table in ARCHIVED_MODELS:
+        kept[table].add(connection.exec_driver_sql(
+            f'SELECT max(id) FROM main.{table}').scalar())
+    for child, (column, parent) in ARCHIVE_CHILDREN.items():
+        kept[parent].add(connection.exec_driver_sql(
+            f'SELECT {column} FROM main.{child} '
+            'ORDER BY id DESC LIMIT 1').scalar())
+    kept['health_metrics'] |= set(connection.exec_driver_sql(
+        'SELECT health_metric_id FROM main.user_latest_state').scalars())
+    return {table: sorted(ids - {None}) for table, ids in kept.items()}
+
+
+# Ids of the rows of a table in a batch
+def _ids(rows):
+    position = rows['columns'].index('id')
+    return [row[position] for row in rows['rows']]
+
+
+# The hot rows of a (table, user, month) key, with their children, as a batch
+def _read_batch(connection, key, kept):
+    table, user_id, month = key
+    batch = {}
+
+    def read(name, condition, parameters):
+        columns = Base.metadata.tables[name].columns.keys()
+        rows = connection.exec_driver_sql(
+            f'SELECT {", ".join(columns)} FROM main.{name} '
+            f'WHERE {condition} ORDER BY id', parameters).all()
+        if rows:
+            batch[name] = {'columns': columns,
+                           'rows': [list(row) for row in rows]}
+
+    read(table, f'user_id = ? AND date >= ? AND date < ? AND id NOT IN '
+                f'({", ".join("?" * len(kept[table]))})',
+         (user_id, month.isoformat(), _next_month(month).isoformat(),
+          *kept[table]))
+    for child, (column, parent) in ARCHIVE_CHILDREN.items():
+        if parent == table and table in batch:
+            ids = _ids(batch[table])
+            read(child, f'{column} IN ({", ".join("?" * len(ids))})',
+                 tuple(ids))
+    return batch
+
+
+# Move the rows of the archived tables dated in months before today minus
+# horizon_days into the cold store, BATCHES_PER_TRANSACTION (table, user,
+# month) batches at a time. Each batch is committed to the store before its
+# rows are deleted from the hot database and its stub written, and a batch
+# archived again is merged with the stored one, so running it again after an
+# interruption finishes the job. Returns the number of rows moved per table.
+def archive_months(engine, horizon_days=DEFAULT_HORIZON_DAYS):
+    if horizon_days < MIN_HORIZON_DAYS:
+        raise ArchiveError(
+            f"The scenarios look back up to a year; the horizon must be at "
+            f"least {MIN_HORIZON_DAYS} days.")
+    before = _month(date.today() - timedelta(days=horizon_days)).isoformat()
+    moved = dict.fromkeys([*ARCHIVED_MODELS, *ARCHIVE_CHILDREN], 0)
+    with engine.connect() as connection:
+        cold = cold_engine(_main_path(connection))
+        kept = _kept_ids(connection)
+        keys = []
+        for table in ARCHIVED_MODELS:
+            keys += [(table, user_id, date.fromisoformat(month))
+                     for user_id, month in connection.exec_driver_sql(
+                         f"SELECT DISTINCT user_id, "
+                         f"date(date, 'start of month') FROM main.{table} "
+                         f"WHERE date < ? AND id NOT IN "
+                         f"({', '.join('?' * len(kept[table]))}) "
+                         f"ORDER BY 1, 2", (before, *kept[table]))]
+        connection.rollback()
+
+        keys = iter(keys)
+        while chunk := list(islice(keys, BATCHES_PER_TRANSACTION)):
+            batches = {key: batch for key in chunk
+                       if (batch := _read_batch(connection, key, kept))}
+            stored = {}
+            with cold.begin() as cold_connection:
+                for (table, user_id, month), batch in batches.items():
+                    parameters = dict(table_name=table, user_id=user_id,
+                                      month=month.isoformat())
+                    data = cold_connection.execute(text(
+                        'SELECT data FROM archive_batches '
+                        'WHERE table_name = :table_name '
+                        'AND user_id = :user_id AND month = :month'),
+                        parameters).scalar()
+                    if data is not None:
+                        batch = _merge(_decode(data), batch)
+                    cold_connection.execute(text(
+                        'INSERT OR REPLACE INTO archive_batches '
+                        '(table_name, user_id, month, data) '
+                        'VALUES (:table_name, :user_id, :month, :data)'),
+                        dict(parameters, data=_encode(batch)))
+                    stored[table, user_id, month] = len(batch[table]['rows'])
+
+            # children first, while their parents are still there
+            for (table, user_id, month), batch in batches.items():
+                for name in reversed(list(batch)):
+                    ids = _ids(batch[name])
+                    for start in range(0, len(ids), MAX_IDS_PER_STATEMENT):
+                        part = ids[start:start + MAX_IDS_PER_STATEMENT]
+                        moved[name] += connection.exec_driver_sql(
+                            f'DELETE FROM main.{name} WHERE id IN '
+                            f'({", ".join("?" * len(part))})',
+                            tuple(part)).rowcount
+                connection.exec_driver_sql(
+                    'INSERT INTO main.archive_stubs '
+                    '(user_id, month, table_name, row_count) '
+                    'VALUES (?, ?, ?, ?) ON CONFLICT DO UPDATE '
+                    'SET row_count = excluded.row_count',
+                    (user_id, month.isoformat(), table,
+                     stored[table, user_id, month]))
+            connection.commit()
+    return moved
+
+
+# The stored batches of an archived table for the given users, or every
+# user if None, in months from start to end (dates, datetimes or ISO
+# strings, or None for an open end), one at a time, oldest month first per
+# user. Each is a dict {table: {"columns": [...], "rows": [[...]]}} of the
+# raw SQLite values, holding the table's rows and those of its children.
+# connection is a Connection of the hot database, e.g. session.connection().
+def archived_batches(connection, table_name, user_ids=None, start=None,
+                     end=None):
+    start, end = _day(start), _day(end)
+    stubs = select(ArchiveStub.user_id, ArchiveStub.month).where(
+        ArchiveStub.table_name == table_name
+    ).order_by(ArchiveStub.user_id, ArchiveStub.month)
+    if user_ids is not None:
+        stubs = stubs.where(ArchiveStub.user_id.in_(user_ids))
+    if start is not None:
+        stubs = stubs.where(ArchiveStub.month >= _month(start))
+    if end is not None:
+        stubs = stubs.where(ArchiveStub.month <= end)
+    keys = connection.execute(stubs).all()
+    if not keys:
+        return
+
+    with cold_engine(_main_path(connection)).connect() as cold_connection:
+        for user_id, month in keys:
+            data = cold_connection.execute(text(
+                'SELECT data FROM archive_batches WHERE table_name = :table '
+                'AND user_id = :user_id AND month = :month'),
+                dict(table=table_name, user_id=user_id,
+                     month=month.isoformat())).scalar()
+            if data is None:
+                raise ArchiveError(
+                    f"The cold store has lost the {table_name} of user "
+                    f"{user_id} for {month:%Y-%m}.")
+            yield _decode(data)
+
+
+# The archived rows of a model of ARCHIVED_MODELS dated from start to end
+# for the given users, or every user if None, as transient instances ordered
+# by user, date and id. start and end may be dates, datetimes or ISO
+# strings, or None for an open end. Only ranges starting before the newest
+# months that may be archived read the stubs. connection is a Connection,
+# e.g. session.connection().
+def archived_rows(connection, model, user_ids=None, start=None, end=None):
+    if not may_be_archived(start):
+        return []
+    start, end = _day(start), _day(end)
+    table = model.__table__
+    dialect = connection.dialect
+    rows = []
+    for batch in archived_batches(connection, table.name, user_ids, start,
+                                  end):
+        batch = batch[table.name]
+        processors = [
+            table.columns[name].type.dialect_impl(dialect)
+            .result_processor(dialect, None)
+            for name in batch['columns']]
+        for row in batch['rows']:
+            values = {name: processor(value) if processor else value
+                      for name, processor, value
+                      in zip(batch['columns'], processors, row)}
+            if (start is None or values['date'] >= start) \
+                    and (end is None or values['date'] <= end):
+                rows.append(model(**values))
+    rows.sort(key=lambda row: (row.user_id, row.date, row.id))
+    return rows
+
+
+# Current and previous values of an attribute of a flushed object
+def _values(obj, attribute):
+    history = inspect(obj).attrs[attribute].history
+    return {value for value in (*history.added, *history.unchanged,
+                                *history.deleted) if value is not None}
+
+
+@event.listens_for(Session, 'before_flush')
+def _refuse_archived_months(session, flush_context, instances):
+    newest = date.today() - timedelta(days=MIN_HORIZON_DAYS)
+    months = {}
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if not isinstance(obj, tuple(ARCHIVED_MODELS.values())):
+            continue
+        for day in map(_day, _values(obj, 'date')):
+            if day < newest:
+                for user_id in _values(obj, 'user_id'):
+                    months.setdefault((user_id, _month(day)),
+                                      type(obj).__name__)
+    if not months:
+        return
+    archived = session.connection().execute(
+        select(ArchiveStub.user_id, ArchiveStub.month).where(
+            tuple_(ArchiveStub.user_id, ArchiveStub.month).in_(list(months))
+        ).limit(1)).first()
+    if archived is not None:
+        raise ArchiveError(
+            f"{archived.month:%Y-%m} of user {archived.user_id} is archived; "
+            f"{months[tuple(archived)]} rows can no longer be written for "
+            f"it.")
+
+
+# Stubbed batches and archived rows per table, and the sizes of the hot
+# database and its cold store
+def archive_rows(engine):
+    with engine.connect() as connection:
+        counts = {table: (batches, rows or 0)
+                  for table, batches, rows in connection.execute(select(
+                      ArchiveStub.table_name, func.count(),
+                      func.sum(ArchiveStub.row_count)
+                  ).group_by(ArchiveStub.table_name))}
+        path = _main_path(connection)
+    cold = archive_path(path)
+    return counts, os.path.getsize(path), \
+        os.path.getsize(cold) if os.path.exists(cold) else 0
+
+
+if __name__ == "__main__":
+    from create import init_db, user_engines
+
+    parser = argparse.ArgumentParser(
+        description="Move old months of the event tables into the cold "
+                    "store.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser(
+        'run', help="archive the months older than the horizon")
+    run.add_argument('--horizon-days', type=int, default=DEFAULT_HORIZON_DAYS,
+                     help=f"age in days of the newest rows archived, at "
+                          f"least {MIN_HORIZON_DAYS} (default: "
+                          f"{DEFAULT_HORIZON_DAYS})")
+    run.add_argument('--vacuum', action='store_true',
+                     help="VACUUM the hot database afterwards to give the "
+                          "freed pages back")
+    commands.add_parser('list', help="list the archived rows and file sizes")
+    args = parser.parse_args()
+    init_db()
+    # every user shard has a cold store of its own
+    engines = user_engines()
+    started = time.perf_counter()
+
+    for engine in engines:
+        if len(engines) > 1:
+            print(f"{engine.url.database}:")
+        if args.command == 'run':
+            moved = archive_months(engine, args.horizon_days)
+            print("moved " + ', '.join(
+                f"{count} {table}" for table, count in moved.items()))
+            if args.vacuum:
+                with engine.connect() as connection:
+                    connection.exec_driver_sql('VACUUM main')
+        elif args.command == 'list':
+            counts, hot_size, cold_size = archive_rows(engine)
+            for table, (batches, rows) in sorted(counts.items()):
+                print(f"{table:>14}  {rows} rows in {batches} batches")
+            print(f"hot {hot_size / 2**20:.1f} MiB, "
+                  f"cold {cold_size / 2**20:.1f} MiB")
+
+    if args.command == 'run':
+        print(f"Done in {time.perf_counter() - started:.2f}s")
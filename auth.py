@@ -0,0 +1,364 @@
+# Authentication
+# login() and register() are the concurrency-safe versions of
+# create.login_user and create.register_user. The bcrypt work, hundreds of
+# milliseconds of CPU at the default cost, runs in a bounded thread pool
+# (bcrypt releases the GIL) before any transaction is opened, and the
+# database work is a single short read or write. They return an AuthResult
+# instead of printing.
+#
+# validate_session() answers from an in-process LRU cache of valid tokens
+# and only queries the sessions table on a miss. A cached token is trusted
+# until its session expires or, at most, SESSION_CACHE_TTL after it was
+# read, which bounds how long a revocation made by another process goes
+# unnoticed; logout and revocations made here drop the entries at once.
+# A background sweeper deletes expired sessions in small batches so the
+# table only holds live sessions.
+from create import Session, init_db
+from models import User, UserSession
+from sqlalchemy import select, delete
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+import argparse
+import os
+import secrets
+import threading
+
+# Threads hashing and checking passwords; more than one per core only
+# makes each login slower
+HASH_WORKERS = os.cpu_count() or 1
+# Most password operations queued or running at once; callers past this
+# wait for a slot instead of piling work onto the pool
+MAX_PENDING_HASHES = 64
+# bcrypt cost for new passwords; None uses bcrypt's default
+BCRYPT_ROUNDS = None
+
+# How long a session from login() lasts, as in create.login_user
+SESSION_LIFETIME = timedelta(days=1)
+
+# Most tokens kept in the cache; the least recently used go first
+SESSION_CACHE_SIZE = 10000
+# Longest a cached token is trusted without reading its session again
+SESSION_CACHE_TTL = timedelta(minutes=5)
+
+# Sessions deleted per sweep transaction, so writers are never blocked long
+SWEEP_BATCH_SIZE = 1000
+# Seconds between background sweeps
+SWEEP_INTERVAL = 600
+
+
+# LRU cache of token -> (user_id, valid_until), safe to share between
+# threads. Every invalidation takes the next generation and leaves a
+# tombstone for its token or user; put() is given the generation read
+# before the session row was, and refuses a token invalidated since, so a
+# read racing a logout or revocation cannot cache the ended session. The
+# newest max_size tombstones of each kind are kept; a put() older than a
+# dropped one is refused too.
+class SessionCache:
+    def __init__(self, max_size=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        # generation of the latest invalidation of each token and user
+        self.token_tombstones = OrderedDict()
+        self.user_tombstones = OrderedDict()
+        # newest generation whose tombstone was dropped
+        self.forgotten = 0
+
+    # The generation to pass to put() for a session row read from now on
+    def current_generation(self):
+        with self.lock:
+            return self.generation
+
+    # The user id of a cached, still valid token, or None
+    def get(self, token, now=None):
+        now = now or datetime.utcnow()
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None:
+                return None
+            user_id, valid_until = entry
+            if valid_until <= now:
+                del self.entries[token]
+                return None
+            self.entries.move_to_end(token)
+            return user_id
+
+    # Cache a token read from its session, never past the session's expiry,
+    # unless the token or its user was invalidated after generation since
+    def put(self, token, user_id, expires_at, since, now=None):
+        now = now or datetime.utcnow()
+        with self.lock:
+            if since < self.forgotten \
+                    or self.token_tombstones.get(token, 0) > since \
+                    or self.user_tombstones.get(user_id, 0) > since:
+                return False
+            self.entries[token] = (user_id, min(expires_at, now + self.ttl))
+            self.entries.move_to_end(token)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            return True
+
+    def _tombstone(self, tombstones, key):
+        self.generation += 1
+        tombstones[key] = self.generation
+        tombstones.move_to_end(key)
+        while len(tombstones) > self.max_size:
+            _, generation = tombstones.popitem(last=False)
+            self.forgotten = max(self.forgotten, generation)
+
+    def invalidate(self, token):
+        with self.lock:
+            self._tombstone(self.token_tombstones, token)
+            self.entries.pop(token, None)
+
+    def invalidate_user(self, user_id):
+        with self.lock:
+            self._tombstone(self.user_tombstones, user_id)
+            for token in [token for token, (owner, _) in self.entries.items()
+                          if owner == user_id]:
+                del self.entries[token]
+
+    # Drop the entries that are no longer valid
+    def purge_expired(self, now=None):
+        now = now or datetime.utcnow()
+        with self.lock:
+            for token in [token for token, (_, valid_until)
+                          in self.entries.items() if valid_until <= now]:
+                del self.entries[token]
+
+    # Empty the cache; tokens read before are not cached afterwards
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.token_tombstones.clear()
+            self.user_tombstones.clear()
+            self.generation += 1
+            self.forgotten = self.generation
+
+    def __len__(self):
+        return len(self.entries)
+
+
+session_cache = SessionCache()
+
+
+@dataclass
+class AuthResult:
+    ok: bool
+    user_id: Optional[int] = None
+    # session token, set by a successful login()
+    token: Optional[str] = None
+    error: Optional[str] = None
+
+
+_hash_executor = None
+_hash_slots = threading.BoundedSemaphore(MAX_PENDING_HASHES)
+_executor_lock = threading.Lock()
+
+
+# Run a bcrypt function in the shared pool and wait for its result
+def _run_bcrypt(function, *args):
+    global _hash_executor
+    if _hash_executor is None:
+        with _executor_lock:
+            if _hash_executor is None:
+                _hash_executor = ThreadPoolExecutor(
+                    max_workers=HASH_WORKERS, thread_name_prefix='bcrypt')
+    with _hash_slots:
+        return _hash_executor.submit(function, *args).result()
+
+
+def _hash_password(password):
+    import bcrypt
+    salt = bcrypt.gensalt() if BCRYPT_ROUNDS is None \
+        else bcrypt.gensalt(BCRYPT_ROUNDS)
+    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+
+
+def _check_password(password, password_hash):
+    import bcrypt
+    # User.set_password stores the hash as bytes
+    if isinstance(password_hash, str):
+        password_hash = password_hash.encode('utf-8')
+    return bcrypt.checkpw(password.encode('utf-8'), password_hash)
+
+
+# Hash checked for unknown usernames, so they take as long to reject as
+# wrong passwords and do not reveal which usernames exist
+_unknown_user_hash = None
+
+
+def _unknown_user_password_hash():
+    global _unknown_user_hash
+    if _unknown_user_hash is None:
+        _unknown_user_hash = _run_bcrypt(_hash_password,
+                                         secrets.token_urlsafe())
+    return _unknown_user_hash
+
+
+# Create a user. profile holds the other User columns (initial_weight and
+# height are required).
+def register(username, email, password, **profile):
+    password_hash = _run_bcrypt(_hash_password, password)
+    with Session() as session:
+        user = User(username=username, email=email,
+                    password_hash=password_hash, **profile)
+        session.add(user)
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            if session.scalar(select(User.id).where(
+                    (User.username == username) | (User.email == email))):
+                return AuthResult(
+                    False, error="The username or email is already in use.")
+            return AuthResult(False, error="Missing required user details.")
+        except SQLAlchemyError as e:
+            session.rollback()
+            return AuthResult(
+                False, error=f"An error occurred while registering: {e}")
+        return AuthResult(True, user_id=user.id)
+
+
+# Check a password and open a session. The new token is cached, so the
+# requests that follow the login validate without a query.
+def login(username, password):
+    try:
+        with Session() as session:
+            row = session.execute(
+                select(User.id, User.password_hash).where(
+                    User.username == username)).first()
+    except SQLAlchemyError as e:
+        return AuthResult(False,
+                          error=f"An error occurred while logging in: {e}")
+    if row is None:
+        _run_bcrypt(_check_password, password, _unknown_user_password_hash())
+        return AuthResult(False, error="Invalid username or password.")
+    if not _run_bcrypt(_check_password, password, row.password_hash):
+        return AuthResult(False, error="Invalid username or password.")
+
+    token = secrets.token_urlsafe()
+    expires_at = datetime.utcnow() + SESSION_LIFETIME
+    since = session_cache.current_generation()
+    try:
+        with Session() as session:
+            session.add(UserSession(user_id=row.id, token=token,
+                                    expires_at=expires_at))
+            session.commit()
+    except SQLAlchemyError as e:
+        return AuthResult(False,
+                          error=f"An error occurred while logging in: {e}")
+    session_cache.put(token, row.id, expires_at, since)
+    return AuthResult(True, user_id=row.id, token=token)
+
+
+# The id of the user a session token belongs to, or None if the token is
+# unknown, expired, logged out or revoked
+def validate_session(token):
+    now = datetime.utcnow()
+    user_id = session_cache.get(token, now)
+    if user_id is not None:
+        return user_id
+
+    since = session_cache.current_generation()
+    with Session() as session:
+        row = session.execute(
+            select(UserSession.user_id, UserSession.expires_at).where(
+                UserSession.token == token,
+                UserSession.expires_at > now)
+        ).first()
+    if row is None:
+        return None
+    session_cache.put(token, row.user_id, row.expires_at, since, now)
+    return row.user_id
+
+
+# End one session. Returns whether the token had a session. The token is
+# invalidated once the delete has committed; a validate_session() that read
+# the session before then is refused by the cache (see SessionCache).
+def logout_user(token):
+    with Session() as session:
+        deleted = session.execute(
+            delete(UserSession).where(UserSession.token == token)).rowcount
+        session.commit()
+    session_cache.invalidate(token)
+    return deleted > 0
+
+
+# End every session of a user, e.g. after a password change. Returns the
+# number of sessions ended.
+def revoke_user_sessions(user_id):
+    with Session() as session:
+        deleted = session.execute(
+            delete(UserSession).where(UserSession.user_id == user_id)
+        ).rowcount
+        session.commit()
+    session_cache.invalidate_user(user_id)
+    return deleted
+
+
+# Delete the sessions that expired before now, batch_size rows per
+# transaction. Returns the number of sessions deleted.
+def sweep_expired_sessions(batch_size=SWEEP_BATCH_SIZE, now=None):
+    now = now or datetime.utcnow()
+    session_cache.purge_expired(now)
+    expired = select(UserSession.id).where(
+        UserSession.expires_at <= now).limit(batch_size)
+    total = 0
+    while True:
+        with Session() as session:
+            deleted = session.execute(
+                delete(UserSession).where(UserSession.id.in_(expired))
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            session.commit()
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+
+# Daemon thread running sweep_expired_sessions every interval seconds
+class SessionSweeper(threading.Thread):
+    def __init__(self, interval=SWEEP_INTERVAL, batch_size=SWEEP_BATCH_SIZE):
+        super().__init__(name='session-sweeper', daemon=True)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                sweep_expired_sessions(self.batch_size)
+            except SQLAlchemyError as e:
+                print(f"An error occurred while sweeping sessions: {e}")
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+# Start sweeping expired sessions in the background
+def start_session_sweeper(interval=SWEEP_INTERVAL,
+                          batch_size=SWEEP_BATCH_SIZE):
+    sweeper = SessionSweeper(interval, batch_size)
+    sweeper.start()
+    return sweeper
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Session maintenance.")
+    parser.add_argument('command', choices=['sweep'],
+                        help="sweep: delete expired sessions")
+    parser.add_argument('--batch-size', type=int, default=SWEEP_BATCH_SIZE,
+                        help="sessions deleted per transaction")
+    args = parser.parse_args()
+    init_db()
+    print(f"Deleted {sweep_expired_sessions(args.batch_size)} expired "
+          f"sessions.")
@@ -0,0 +1,2 @@
+# Benchmark scripts. Run them from the repository root, for example
+# python3 -m benchmarks.cold_start
@@ -0,0 +1,89 @@
+# Async query benchmark
+# Serves a small profile request (BMI, fitness level and water intake, three
+# scenarios on one connection) for a set of users from 1, 32 and 256
+# concurrent clients: threads calling query_data, and coroutines on one
+# event loop calling query_async. Requests per second and latency.
+import argparse
+import asyncio
+import time
+
+from benchmarks.common import (
+    percentile, run_threads, sample_user_ids, print_table)
+from create import read_session
+import query_async
+import query_data
+
+
+def sync_request(user_id):
+    with read_session() as session:
+        query_data.calculate_user_bmi(user_id, session=session)
+        query_data.assess_fitness_level(user_id, session=session)
+        query_data.recommend_water_intake(user_id, session=session)
+
+
+async def async_request(user_id):
+    async with query_async.AsyncSession() as session:
+        await query_async.calculate_user_bmi(user_id, session=session)
+        await query_async.assess_fitness_level(user_id, session=session)
+        await query_async.recommend_water_intake(user_id, session=session)
+
+
+# Each client takes the next user until every user was served once;
+# returns the sorted latencies in ms and the elapsed seconds
+async def run_tasks(clients, user_ids):
+    pending = iter(user_ids)
+    latencies = []
+
+    async def client():
+        for user_id in pending:
+            started = time.perf_counter()
+            await async_request(user_id)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    return sorted(latencies), time.perf_counter() - started
+
+
+def row(approach, clients, latencies, elapsed):
+    return dict(approach=approach, clients=clients,
+                requests_per_s=len(latencies) / elapsed,
+                p50_ms=percentile(latencies, 0.50),
+                p95_ms=percentile(latencies, 0.95),
+                p99_ms=percentile(latencies, 0.99))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', default='1,32,256',
+                        help="comma separated concurrent client counts")
+    parser.add_argument('--users', type=int, default=1000,
+                        help="number of users served per run")
+    args = parser.parse_args(argv)
+
+    query_async.init_async_db()
+    user_ids = sample_user_ids(query_data.session, args.users)
+    query_data.session.remove()
+    clients = list(map(int, args.clients.split(',')))
+
+    calls = [(user_id,) for user_id in user_ids]
+    run_threads(sync_request, calls[:10], 1)
+    rows = [row('threads', count, *run_threads(sync_request, calls, count))
+            for count in clients]
+
+    # one event loop for every run, as the pooled connections belong to it
+    async def run_async():
+        try:
+            await run_tasks(1, user_ids[:10])
+            return [row('asyncio', count, *await run_tasks(count, user_ids))
+                    for count in clients]
+        finally:
+            await query_async.async_engine.dispose()
+
+    rows += asyncio.run(run_async())
+    print_table(rows, ['approach', 'clients', 'requests_per_s', 'p50_ms',
+                       'p95_ms', 'p99_ms'])
+
+
+if __name__ == "__main__":
+    main()
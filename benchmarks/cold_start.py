@@ -0,0 +1,48 @@
+# Cold start benchmark
+# Runs each startup step in a fresh interpreter, so nothing is cached in the
+# process, and reports the median wall time over several runs.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Startup steps, from bare imports to a fully initialized database
+STEPS = [
+    ('python startup', 'pass'),
+    ('import models', 'import models'),
+    ('import create', 'import create'),
+    ('import query_data', 'import query_data'),
+    ('import insert_data', 'import insert_data'),
+    ('init_db()', 'import create; create.init_db()'),
+    ('first query', 'import query_data; query_data.init_db(); '
+                    'query_data.calculate_user_bmi(1)'),
+]
+
+
+def time_step(code, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=REPO_ROOT,
+                       check=True)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5,
+                        help="fresh interpreters per step")
+    args = parser.parse_args(argv)
+
+    print(f"{'step':<20} {'median ms':>10}")
+    for name, code in STEPS:
+        print(f"{name:<20} {time_step(code, args.runs) * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# Helpers shared by the benchmark scripts
+from contextlib import contextmanager
+from sqlalchemy import event, select
+import statistics
+import threading
+import time
+
+
+# Count the SQL statements an engine executes inside the block
+@contextmanager
+def count_queries(engine):
+    counter = {'queries': 0}
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        counter['queries'] += 1
+
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+
+# Percentile of a sorted list of timings, nearest-rank method
+def percentile(sorted_timings, fraction):
+    index = max(0, min(len(sorted_timings) - 1,
+                       round(fraction * len(sorted_timings)) - 1))
+    return sorted_timings[index]
+
+
+# Call function(*args) for each args tuple after a warmup pass and return
+# latency statistics in milliseconds
+def time_calls(function, calls, warmup=10):
+    calls = list(calls)
+    for args in calls[:warmup]:
+        function(*args)
+    timings = []
+    for args in calls:
+        started = time.perf_counter()
+        function(*args)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        'calls': len(timings),
+        'mean_ms': statistics.fmean(timings),
+        'p50_ms': percentile(timings, 0.50),
+        'p95_ms': percentile(timings, 0.95),
+        'p99_ms': percentile(timings, 0.99),
+    }
+
+
+# Call function(*args) for each args tuple from clients threads at once,
+# each thread taking the next call until none are left. Returns the sorted
+# latencies in milliseconds and the elapsed seconds.
+def run_threads(function, calls, clients):
+    pending = iter(calls)
+    latencies = []
+    lock = threading.Lock()
+
+    def client():
+        own = []
+        while True:
+            with lock:
+                args = next(pending, None)
+            if args is None:
+                break
+            started = time.perf_counter()
+            function(*args)
+            own.append((time.perf_counter() - started) * 1000)
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), time.perf_counter() - started
+
+
+# User ids to benchmark against, spread over the whole table
+def sample_user_ids(session, count):
+    from models import User
+    user_ids = session.scalars(select(User.id).order_by(User.id)).all()
+    if not user_ids:
+        raise SystemExit("The database has no users; seed it first with "
+                         "python3 insert_data.py --bulk")
+    step = max(1, len(user_ids) // count)
+    return user_ids[::step][:count]
+
+
+def print_table(rows, columns):
+    widths = [max(len(str(column)), *(len(_format(row[column]))
+                                      for row in rows)) for column in columns]
+    print('  '.join(str(column).ljust(width)
+                    for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(_format(row[column]).ljust(width)
+                        for column, width in zip(columns, widths)))
+
+
+def _format(value):
+    return f'{value:.3f}' if isinstance(value, float) else str(value)
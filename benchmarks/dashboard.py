@@ -0,0 +1,60 @@
+# Dashboard benchmark
+# Compares get_user_dashboard with calling the 14 scenario functions one by
+# one for the same users: statements per dashboard and latency.
+import argparse
+from datetime import datetime, timedelta
+
+from benchmarks.common import (
+    count_queries, time_calls, sample_user_ids, print_table)
+from create import init_db
+import query_data
+from dashboard import get_user_dashboard
+
+
+# The home screen built from the individual scenario functions
+def dashboard_one_by_one(user_id):
+    now = datetime.now()
+    start = now - timedelta(days=30)
+    return (
+        query_data.get_workouts_by_user_and_date(user_id, start, now),
+        query_data.average_daily_calories(user_id, start, now),
+        query_data.average_sleep_duration_last_month(user_id),
+        query_data.weight_change_past_year(user_id),
+        query_data.last_recorded_health_metrics(user_id),
+        query_data.recommend_water_intake(user_id),
+        query_data.suggest_calories_intake(user_id),
+        query_data.assess_fitness_level(user_id),
+        query_data.sleep_duration_tips(user_id),
+        query_data.sleep_consistency_tips(user_id),
+        query_data.dietary_diversity_tips(user_id),
+        query_data.track_goal_progress(user_id),
+        query_data.calculate_user_bmi(user_id),
+        query_data.summarize_frequent_workouts(user_id, start, now),
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=200,
+                        help="number of users to render dashboards for")
+    args = parser.parse_args(argv)
+
+    engine = init_db()
+    user_ids = sample_user_ids(query_data.session, args.users)
+    calls = [(user_id,) for user_id in user_ids]
+
+    rows = []
+    for name, function in (('one by one', dashboard_one_by_one),
+                           ('get_user_dashboard', get_user_dashboard)):
+        with count_queries(engine) as counter:
+            for user_id in user_ids:
+                function(user_id)
+        stats = time_calls(function, calls)
+        rows.append(dict(stats, approach=name,
+                         queries=counter['queries'] / len(user_ids)))
+    print_table(rows, ['approach', 'queries', 'mean_ms', 'p50_ms', 'p95_ms',
+                       'p99_ms'])
+
+
+if __name__ == "__main__":
+    main()
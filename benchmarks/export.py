@@ -0,0 +1,86 @@
+# User export benchmark
+# Exports the users with the most rows as NDJSON twice: by loading the User
+# and its relationships as ORM objects and serializing them, and with the
+# streaming keyset export of export.py. Rows per second and peak Python
+# memory per approach; the streaming peak stays flat as the history grows.
+import argparse
+import json
+import os
+import time
+import tracemalloc
+
+from benchmarks.common import print_table
+from create import init_db, read_session
+from export import PRIVATE_COLUMNS, export_user
+from models import HealthMetric, Meal, User
+from sqlalchemy import func, inspect, select
+
+# User relationships holding the exported tables, and the meal food items
+# of each meal
+RELATIONSHIPS = ['workouts', 'meals', 'water_intakes', 'nutrition_logs',
+                 'medications', 'sleep_logs', 'health_metrics',
+                 'body_compositions', 'goals']
+
+
+def _row(obj):
+    table = obj.__table__.name
+    return {name: getattr(obj, column.key)
+            for column in inspect(type(obj)).columns
+            if (name := column.name) not in PRIVATE_COLUMNS.get(table, ())}
+
+
+# Load every relationship of the user, then write a line per object
+def orm_export(user_id, output):
+    with read_session(user_id=user_id) as session:
+        user = session.get(User, user_id)
+        objects = [user]
+        for relationship in RELATIONSHIPS:
+            for obj in getattr(user, relationship):
+                objects.append(obj)
+                if isinstance(obj, Meal):
+                    objects.extend(obj.food_items)
+        for obj in objects:
+            output.write(json.dumps({'table': obj.__table__.name,
+                                     'row': _row(obj)}, default=str) + '\n')
+        return len(objects)
+
+
+def streaming_export(user_id, output):
+    return sum(export_user(user_id, output).values())
+
+
+def measure(function, user_ids):
+    tracemalloc.start()
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as output:
+        rows = sum(function(user_id, output) for user_id in user_ids)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return rows, elapsed, peak / 2 ** 20
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=5,
+                        help="number of users exported, those with the most "
+                             "health metric readings")
+    args = parser.parse_args(argv)
+
+    init_db()
+    with read_session() as session:
+        user_ids = session.scalars(
+            select(HealthMetric.user_id).group_by(HealthMetric.user_id)
+            .order_by(func.count().desc()).limit(args.users)).all()
+
+    rows = []
+    for name, function in (('ORM relationships', orm_export),
+                           ('streaming keyset', streaming_export)):
+        exported, elapsed, peak_mb = measure(function, user_ids)
+        rows.append(dict(approach=name, users=len(user_ids), rows=exported,
+                         rows_per_s=exported / elapsed, peak_mb=peak_mb))
+    print_table(rows, ['approach', 'users', 'rows', 'rows_per_s', 'peak_mb'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+# Food search benchmark
+# Type-ahead latency against a large generated food catalog: the names of a
+# sample of food items are typed one keystroke at a time and every prefix
+# is looked up, as a meal logging UI would, through the food_search index
+# and through a LIKE scan of food_items.name for comparison. Latency per
+# lookup, grouped by the length of the typed text.
+#
+# The catalog is generated once into --data-dir and reused by later runs
+# with the same size and seed.
+import argparse
+import os
+import random
+import time
+
+from benchmarks.common import time_calls, print_table
+from create import init_db, read_session
+from food_search import search_food_items, DEFAULT_RESULTS
+from models import FoodItem
+from sqlalchemy import func, insert, select
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PREPARATIONS = [
+    'Grilled', 'Roasted', 'Baked', 'Fried', 'Steamed', 'Smoked', 'Boiled',
+    'Braised', 'Sautéed', 'Pickled', 'Dried', 'Frozen', 'Organic', 'Raw',
+    'Low-fat', 'Spicy', 'Sweet', 'Salted', 'Unsalted', 'Whole', 'Creamy',
+]
+FOODS = [
+    'Chicken', 'Beef', 'Pork', 'Turkey', 'Salmon', 'Tuna', 'Shrimp', 'Tofu',
+    'Egg', 'Rice', 'Quinoa', 'Oat', 'Wheat', 'Barley', 'Potato', 'Tomato',
+    'Spinach', 'Kale', 'Broccoli', 'Carrot', 'Pepper', 'Onion', 'Garlic',
+    'Mushroom', 'Lentil', 'Chickpea', 'Bean', 'Pea', 'Corn', 'Apple',
+    'Banana', 'Orange', 'Mango', 'Blueberry', 'Strawberry', 'Peach',
+    'Cherry', 'Coconut', 'Almond', 'Peanut', 'Cashew', 'Walnut', 'Yogurt',
+    'Cheese', 'Milk', 'Butter', 'Honey', 'Chocolate', 'Vanilla', 'Cinnamon',
+]
+FORMS = [
+    'Breast', 'Fillet', 'Salad', 'Soup', 'Sandwich', 'Pie', 'Curry', 'Stew',
+    'Wrap', 'Bowl', 'Smoothie', 'Juice', 'Chips', 'Bar', 'Bread', 'Pasta',
+    'Noodles', 'Burger', 'Pizza', 'Muffin', 'Cereal', 'Sauce', 'Spread',
+]
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'to', 'vi', 'ze', 'pa',
+             'bri', 'cor', 'dal', 'fen', 'gra', 'hol', 'jun', 'mar', 'nor']
+
+# Lengths of typed text reported separately; longer text is grouped with
+# the last one
+LENGTH_GROUPS = [1, 2, 3, 5, 8, 12]
+
+
+# A made-up catalog entry: an optional brand, then preparation, food and
+# form, some of them left out
+def food_name(rng):
+    words = []
+    if rng.random() < 0.7:
+        words.append(''.join(rng.choice(SYLLABLES)
+                             for _ in range(rng.randint(2, 3))).capitalize())
+    if rng.random() < 0.6:
+        words.append(rng.choice(PREPARATIONS))
+    words.append(rng.choice(FOODS))
+    if rng.random() < 0.8:
+        words.append(rng.choice(FORMS))
+    return ' '.join(words)
+
+
+# Database file holding a catalog of the given size, generating it on first
+# use. Rows go in through Core, so the food_search triggers index them as
+# they are inserted.
+def catalog(data_dir, items, seed):
+    path = os.path.join(data_dir, f'food-catalog-{items}-seed{seed}.db')
+    if os.path.exists(path):
+        return path
+    os.makedirs(data_dir, exist_ok=True)
+    partial = path + '.partial'
+    for leftover in (partial, partial + '-wal', partial + '-shm'):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+    rng = random.Random(seed)
+    engine = init_db(f'sqlite:///{partial}', profile='bulk_load')
+    started = time.perf_counter()
+    with engine.begin() as connection:
+        for start in range(0, items, 10000):
+            connection.execute(insert(FoodItem), [
+                dict(name=food_name(rng), calories=rng.randint(50, 800),
+                     proteins=rng.uniform(0, 30), carbs=rng.uniform(0, 100),
+                     fats=rng.uniform(0, 50), fiber=rng.uniform(0, 10))
+                for _ in range(min(10000, items - start))])
+        connection.exec_driver_sql(
+            "INSERT INTO food_search(food_search) VALUES ('optimize')")
+    print(f"Generated {items} food items in "
+          f"{time.perf_counter() - started:.1f}s")
+    engine.dispose()
+    os.replace(partial, path)
+    return path
+
+
+# The same lookup through an unindexed substring scan of the names
+def like_search(typed, limit=DEFAULT_RESULTS):
+    with read_session() as session:
+        return session.scalars(select(FoodItem).where(
+            FoodItem.name.like(f'%{typed}%')).limit(limit)).all()
+
+
+def length_group(length):
+    return max(group for group in LENGTH_GROUPS if group <= length)
+
+
+# "3-4" for the group of lengths starting at 3, "12+" for the last one
+def length_label(group):
+    index = LENGTH_GROUPS.index(group)
+    if index + 1 == len(LENGTH_GROUPS):
+        return f'{group}+'
+    last = LENGTH_GROUPS[index + 1] - 1
+    return str(group) if last == group else f'{group}-{last}'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--items', type=int, default=300000,
+                        help="number of food items in the catalog")
+    parser.add_argument('--names', type=int, default=200,
+                        help="number of names typed")
+    parser.add_argument('--like-names', type=int, default=20,
+                        help="number of names typed for the LIKE scan")
+    parser.add_argument('--limit', type=int, default=DEFAULT_RESULTS,
+                        help="results per lookup")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed of the generated catalog")
+    parser.add_argument('--data-dir',
+                        default=os.path.join(BENCHMARKS_DIR, 'data'),
+                        help="directory of the generated catalogs")
+    args = parser.parse_args(argv)
+
+    init_db(f'sqlite:///{catalog(args.data_dir, args.items, args.seed)}')
+    with read_session() as session:
+        names = session.scalars(select(FoodItem.name).order_by(
+            func.random()).limit(args.names)).all()
+
+    rows = []
+    for approach, function, typed_names in (
+            ('food_search', search_food_items, names),
+            ('LIKE scan', like_search, names[:args.like_names])):
+        groups = {}
+        for name in typed_names:
+            for length in range(1, len(name) + 1):
+                groups.setdefault(length_group(length), []).append(
+                    (name[:length], args.limit))
+        for group, calls in sorted(groups.items()):
+            results = sum(len(function(*call)) for call in calls)
+            stats = time_calls(function, calls)
+            rows.append(dict(stats, approach=approach,
+                             typed=length_label(group),
+                             results=results / len(calls)))
+    print_table(rows, ['approach', 'typed', 'calls', 'results', 'mean_ms',
+                       'p50_ms', 'p95_ms', 'p99_ms'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# Health metric loading benchmark
+# Loads the health metrics of a set of users as ORM objects and as NumPy
+# column arrays, then computes a 7-day rolling mean heart rate from each:
+# wall time and peak Python memory per approach.
+import argparse
+import time
+import tracemalloc
+from datetime import timedelta
+
+from benchmarks.common import sample_user_ids, print_table
+from create import init_db
+from models import HealthMetric
+from query_data import session
+from health_series import load_health_metrics, rolling_mean
+
+WINDOW = timedelta(days=7)
+
+
+# One ORM object per reading, averaged per reading in Python
+def orm_rolling_means(user_ids):
+    readings = session.query(HealthMetric).filter(
+        HealthMetric.user_id.in_(user_ids)
+    ).order_by(HealthMetric.user_id, HealthMetric.date,
+               HealthMetric.time).all()
+    means = []
+    window = []
+    for reading in readings:
+        window = [other for other in window
+                  if other.user_id == reading.user_id
+                  and other.time > reading.time - WINDOW]
+        window.append(reading)
+        rates = [other.heart_rate for other in window
+                 if other.heart_rate is not None]
+        means.append(sum(rates) / len(rates) if rates else None)
+    return means
+
+
+def columnar_rolling_means(user_ids):
+    return [rolling_mean(series.time, series.heart_rate, WINDOW)
+            for series in load_health_metrics(user_ids).values()]
+
+
+def measure(function, user_ids):
+    tracemalloc.start()
+    started = time.perf_counter()
+    function(user_ids)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed * 1000, peak / 2 ** 20
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=1000,
+                        help="number of users whose metrics are loaded")
+    args = parser.parse_args(argv)
+
+    init_db()
+    user_ids = sample_user_ids(session, args.users)
+    readings = session.query(HealthMetric).filter(
+        HealthMetric.user_id.in_(user_ids)).count()
+
+    rows = []
+    for name, function in (('ORM objects', orm_rolling_means),
+                           ('NumPy columns', columnar_rolling_means)):
+        elapsed_ms, peak_mb = measure(function, user_ids)
+        rows.append(dict(approach=name, readings=readings,
+                         total_ms=elapsed_ms, peak_mb=peak_mb))
+        session.expunge_all()
+    print_table(rows, ['approach', 'readings', 'total_ms', 'peak_mb'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# Login throughput benchmark
+# Logs in test users from 1, 8 and 32 concurrent client threads for a few
+# seconds each, with create.login_user (bcrypt inline, inside the session)
+# and auth.login (bcrypt in the bounded pool, short transactions): logins
+# per second and latency. The test users and their sessions are deleted
+# afterwards.
+import argparse
+import contextlib
+import io
+import threading
+import time
+
+from benchmarks.common import percentile, print_table
+from create import Session, init_db, login_user
+from models import User, UserSession
+from sqlalchemy import delete, select
+import auth
+
+USERNAME_PREFIX = 'benchmark_login_'
+PASSWORD = 'benchmark password'
+
+
+def create_test_users(count):
+    delete_test_users()
+    for index in range(count):
+        username = f'{USERNAME_PREFIX}{index}'
+        result = auth.register(username, f'{username}@example.com', PASSWORD,
+                               initial_weight=70, height=175)
+        if not result.ok:
+            raise SystemExit(result.error)
+
+
+def delete_test_users():
+    with Session() as session:
+        user_ids = select(User.id).where(
+            User.username.startswith(USERNAME_PREFIX))
+        session.execute(delete(UserSession).where(
+            UserSession.user_id.in_(user_ids)))
+        session.execute(delete(User).where(
+            User.username.startswith(USERNAME_PREFIX)))
+        session.commit()
+
+
+def inline_login(username):
+    return login_user(username, PASSWORD) is not None
+
+
+def executor_login(username):
+    return auth.login(username, PASSWORD).ok
+
+
+# Run clients threads logging in for seconds; returns the latencies in ms
+def run_clients(login, clients, users, seconds):
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client(number):
+        own, failed = [], 0
+        attempt = number
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            if not login(f'{USERNAME_PREFIX}{attempt % users}'):
+                failed += 1
+            own.append((time.perf_counter() - started) * 1000)
+            attempt += clients
+        with lock:
+            latencies.extend(own)
+            failures.append(failed)
+
+    threads = [threading.Thread(target=client, args=(number,))
+               for number in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), sum(failures), time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', default='1,8,32',
+                        help="comma separated concurrent client counts")
+    parser.add_argument('--seconds', type=float, default=5,
+                        help="duration of each run")
+    parser.add_argument('--rounds', type=int, default=10,
+                        help="bcrypt cost of the test users' passwords")
+    parser.add_argument('--users', type=int, default=32,
+                        help="number of test users")
+    args = parser.parse_args(argv)
+
+    init_db()
+    auth.BCRYPT_ROUNDS = args.rounds
+    create_test_users(args.users)
+    rows = []
+    try:
+        # login_user prints the outcome of every login
+        with contextlib.redirect_stdout(io.StringIO()):
+            for name, login in (('inline', inline_login),
+                                ('executor', executor_login)):
+                for clients in map(int, args.clients.split(',')):
+                    latencies, failures, elapsed = run_clients(
+                        login, clients, args.users, args.seconds)
+                    rows.append(dict(
+                        approach=name, clients=clients, failures=failures,
+                        logins_per_s=len(latencies) / elapsed,
+                        p50_ms=percentile(latencies, 0.50),
+                        p95_ms=percentile(latencies, 0.95),
+                        p99_ms=percentile(latencies, 0.99)))
+    finally:
+        delete_test_users()
+    print_table(rows, ['approach', 'clients', 'logins_per_s', 'failures',
+                       'p50_ms', 'p95_ms', 'p99_ms'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+# Health metric chart benchmark
+# Draws a year-long heart rate chart for a set of users from the raw
+# readings, the hourly tier and the daily tier: rows read per chart and
+# latency.
+import argparse
+from datetime import timedelta
+
+from benchmarks.common import time_calls, sample_user_ids, print_table
+from create import init_db
+from models import HealthMetric
+from query_data import session
+from sqlalchemy import func
+from metric_charts import get_metric_chart, choose_tier
+
+RESOLUTIONS = [timedelta(minutes=1), timedelta(hours=1), timedelta(days=1)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=200,
+                        help="number of users to draw charts for")
+    parser.add_argument('--days', type=int, default=365,
+                        help="length of the charted range in days")
+    args = parser.parse_args(argv)
+
+    init_db()
+    user_ids = sample_user_ids(session, args.users)
+    # chart the range ending at the latest reading, so it has data
+    end = session.query(func.max(HealthMetric.date)).scalar()
+    start = end - timedelta(days=args.days)
+
+    rows = []
+    for resolution in RESOLUTIONS:
+        calls = [(user_id, 'heart_rate', start, end, resolution)
+                 for user_id in user_ids]
+        points = sum(len(get_metric_chart(*call)) for call in calls)
+        stats = time_calls(get_metric_chart, calls)
+        rows.append(dict(stats, tier=choose_tier(resolution),
+                         points=points / len(calls)))
+    print_table(rows, ['tier', 'points', 'mean_ms', 'p50_ms', 'p95_ms',
+                       'p99_ms'])
+
+
+if __name__ == "__main__":
+    main()
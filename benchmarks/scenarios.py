@@ -0,0 +1,273 @@
+# Query scenario benchmark
+# Times every query_data scenario against generated datasets of 1k, 100k and
+# 1M users (rows of the other tables scale with the user count, as in
+# insert_data.py --scale). For each scenario it reports latency percentiles
+# after a warmup, the statements one call issues and their EXPLAIN QUERY
+# PLAN, and flags the tables a plan reads with a full scan. The results are
+# written as JSON so runs can be compared over time; --baseline compares
+# with an earlier results file.
+#
+# Each dataset is generated once into --data-dir and reused by later runs
+# with the same scale and seed.
+import argparse
+import json
+import os
+import platform
+import re
+import sqlite3
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from benchmarks.common import time_calls, sample_user_ids, print_table
+from create import init_db, read_session
+from insert_data import (
+    DEFAULT_SCALE, scaled_counts, parallel_insert_data, precompute_hash_pool
+)
+from models import Base
+from sqlalchemy import event, func, select
+import query_data
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARKS_DIR)
+
+# Scenario name -> function and the arguments of one call for a user, given
+# the start and end of the benchmarked date range
+SCENARIOS = {
+    'get_workouts_by_user_and_date': (
+        query_data.get_workouts_by_user_and_date,
+        lambda user_id, start, end: (user_id, start, end)),
+    'average_daily_calories': (
+        query_data.average_daily_calories,
+        lambda user_id, start, end: (user_id, start, end)),
+    'average_sleep_duration_last_month': (
+        query_data.average_sleep_duration_last_month,
+        lambda user_id, start, end: (user_id,)),
+    'weight_change_past_year': (
+        query_data.weight_change_past_year,
+        lambda user_id, start, end: (user_id,)),
+    'last_recorded_health_metrics': (
+        query_data.last_recorded_health_metrics,
+        lambda user_id, start, end: (user_id,)),
+    'recommend_water_intake': (
+        query_data.recommend_water_intake,
+        lambda user_id, start, end: (user_id,)),
+    'suggest_calories_intake': (
+        query_data.suggest_calories_intake,
+        lambda user_id, start, end: (user_id,)),
+    'assess_fitness_level': (
+        query_data.assess_fitness_level,
+        lambda user_id, start, end: (user_id,)),
+    'sleep_duration_tips': (
+        query_data.sleep_duration_tips,
+        lambda user_id, start, end: (user_id,)),
+    'sleep_consistency_tips': (
+        query_data.sleep_consistency_tips,
+        lambda user_id, start, end: (user_id,)),
+    'dietary_diversity_tips': (
+        query_data.dietary_diversity_tips,
+        lambda user_id, start, end: (user_id,)),
+    'track_goal_progress': (
+        query_data.track_goal_progress,
+        lambda user_id, start, end: (user_id,)),
+    'calculate_user_bmi': (
+        query_data.calculate_user_bmi,
+        lambda user_id, start, end: (user_id,)),
+    'summarize_frequent_workouts': (
+        query_data.summarize_frequent_workouts,
+        lambda user_id, start, end: (user_id, start, end)),
+    'nutrient_intake_report': (
+        query_data.nutrient_intake_report,
+        lambda user_id, start, end: (user_id, start, end)),
+}
+
+# A plan step reading a whole table or a whole index of it, e.g.
+# "SCAN workouts" or "SCAN workouts_1 USING COVERING INDEX ...". The name is
+# the table's alias when the query gives it one.
+FULL_SCAN = re.compile(r'^SCAN (\S+)(?: USING (?:COVERING )?INDEX \S+)?$')
+# Plan steps producing the rows of a subquery, which SCAN steps then read
+# without touching a table
+SUBQUERY = re.compile(r'^(?:CO-ROUTINE|MATERIALIZE) (\S+)')
+
+
+# Database file holding the dataset for a scale and seed, generating it on
+# first use. The data is written to a temporary file that is renamed once
+# complete, so an interrupted run never leaves a partial dataset behind.
+def dataset(data_dir, users, seed, workers):
+    path = os.path.join(data_dir, f'scenarios-{users}-seed{seed}.db')
+    if os.path.exists(path):
+        return path
+    os.makedirs(data_dir, exist_ok=True)
+    partial = path + '.partial'
+    for leftover in (partial, partial + '-wal', partial + '-shm'):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+    engine = init_db(f'sqlite:///{partial}', profile='bulk_load')
+    counts = scaled_counts(users / DEFAULT_SCALE['users'])
+    # generated users only need some password hash; cheap ones will do
+    hash_pool = precompute_hash_pool(100, rounds=4)
+    parallel_insert_data(counts, seed=seed, workers=workers, bind=engine,
+                         rounds=4, hash_pool=hash_pool)
+    engine.dispose()
+    os.replace(partial, path)
+    return path
+
+
+# Row count of every table
+def table_sizes(engine):
+    with engine.connect() as connection:
+        return {table.name: connection.scalar(
+                    select(func.count()).select_from(table))
+                for table in Base.metadata.sorted_tables}
+
+
+# Collect the distinct statements an engine executes inside the block, with
+# the parameters of their first execution
+@contextmanager
+def capture_statements(engine):
+    statements = {}
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.setdefault(statement, parameters)
+
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+
+
+# EXPLAIN QUERY PLAN of a statement as indented plan steps, and the tables
+# (or aliases) the plan scans in full
+def explain(engine, statement, parameters):
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql(
+            f'EXPLAIN QUERY PLAN {statement}', parameters).all()
+    depth = {0: -1}
+    steps, subqueries, full_scans = [], set(), []
+    for step_id, parent, _, detail in rows:
+        depth[step_id] = depth.get(parent, -1) + 1
+        steps.append('  ' * depth[step_id] + detail)
+        subquery = SUBQUERY.match(detail)
+        if subquery:
+            subqueries.add(subquery.group(1))
+        scan = FULL_SCAN.match(detail)
+        if scan and scan.group(1) not in subqueries:
+            full_scans.append(scan.group(1))
+    return steps, full_scans
+
+
+def benchmark_scenario(engine, name, calls):
+    function, _ = SCENARIOS[name]
+    with capture_statements(engine) as statements:
+        function(*calls[0])
+    plans = []
+    for statement, parameters in statements.items():
+        steps, full_scans = explain(engine, statement, parameters)
+        plans.append(dict(statement=statement, plan=steps,
+                          full_scans=full_scans))
+    stats = time_calls(function, calls)
+    return dict(stats, scenario=name, queries=len(statements),
+                full_scans=sorted({table for plan in plans
+                                   for table in plan['full_scans']}),
+                plans=plans)
+
+
+def benchmark_scale(args, users):
+    path = dataset(args.data_dir, users, args.seed, args.workers)
+    engine = init_db(f'sqlite:///{path}', profile='default')
+    with read_session() as session:
+        user_ids = sample_user_ids(session, args.users)
+    end = datetime.now()
+    start = end - timedelta(days=365)
+
+    results = []
+    for name, (_, call) in SCENARIOS.items():
+        if args.scenario and name not in args.scenario:
+            continue
+        calls = [call(user_id, start, end) for user_id in user_ids]
+        results.append(benchmark_scenario(engine, name, calls))
+    sizes = table_sizes(engine)
+    engine.dispose()
+    return dict(users=users, database=path, rows=sizes, scenarios=results)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, check=True,
+            capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# p50 of every (users, scenario) in an earlier results file
+def baseline_p50s(path):
+    with open(path) as file:
+        results = json.load(file)
+    return {(scale['users'], scenario['scenario']): scenario['p50_ms']
+            for scale in results['scales']
+            for scenario in scale['scenarios']}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scales', default='1000,100000,1000000',
+                        help="comma separated dataset sizes, in users")
+    parser.add_argument('--users', type=int, default=200,
+                        help="number of users each scenario is timed for")
+    parser.add_argument('--scenario', action='append',
+                        choices=list(SCENARIOS),
+                        help="only benchmark this scenario (repeatable)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed of the generated datasets")
+    parser.add_argument('--workers', type=int,
+                        help="processes generating a dataset")
+    parser.add_argument('--data-dir',
+                        default=os.path.join(BENCHMARKS_DIR, 'data'),
+                        help="directory of the generated datasets")
+    parser.add_argument('--output',
+                        help="results file (default benchmarks/results/"
+                             "scenarios-<time>.json)")
+    parser.add_argument('--baseline',
+                        help="earlier results file to compare p50 with")
+    args = parser.parse_args(argv)
+
+    started = datetime.now()
+    output = args.output or os.path.join(
+        BENCHMARKS_DIR, 'results',
+        f'scenarios-{started:%Y%m%d-%H%M%S}.json')
+    baseline = baseline_p50s(args.baseline) if args.baseline else {}
+
+    results = dict(
+        started_at=started.isoformat(timespec='seconds'),
+        commit=git_commit(),
+        python=platform.python_version(),
+        sqlite=sqlite3.sqlite_version,
+        platform=platform.platform(),
+        scales=[])
+    for users in map(int, args.scales.split(',')):
+        scale = benchmark_scale(args, users)
+        results['scales'].append(scale)
+
+        print(f"\n{users} users")
+        rows = []
+        for scenario in scale['scenarios']:
+            row = dict(scenario, full_scans=','.join(scenario['full_scans'])
+                       or '-')
+            previous = baseline.get((users, scenario['scenario']))
+            row['vs_baseline'] = (f"{scenario['p50_ms'] / previous:.2f}x"
+                                  if previous else '-')
+            rows.append(row)
+        print_table(rows, ['scenario', 'queries', 'p50_ms', 'p95_ms',
+                           'p99_ms', 'vs_baseline', 'full_scans'])
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2, default=str)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
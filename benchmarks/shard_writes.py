@@ -0,0 +1,94 @@
+# Shard write throughput benchmark
+# Write throughput with the users' rows in 1, 2 and 4 shard files (see
+# shards.py): --writers processes each commit a wearable sync at a time, a
+# few health metric readings of a random user through the ORM, so the
+# rollups are maintained as in the application, for a few seconds per shard
+# count. SQLite runs one writer at a time per file, so with a single file
+# the writers queue for its lock; with shards, writers of users on
+# different shards commit at the same time.
+#
+# Every shard count writes to a fresh database in a temporary directory.
+import argparse
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from benchmarks.common import print_table
+from create import init_db, session_scope
+from insert_data import user_rows
+from models import HealthMetric, User
+from sqlalchemy import insert
+import create
+
+
+# Commit syncs of readings for random users from start until the deadline;
+# returns the number of commits. Runs in a worker process with its own
+# engines.
+def write(url, shards, users, readings, start, deadline, seed):
+    init_db(url, shards=shards)
+    rng = random.Random(seed)
+    commits = 0
+    time.sleep(max(0, start - time.time()))
+    while time.time() < deadline:
+        user_id = rng.randint(1, users)
+        taken_at = datetime.now().replace(microsecond=0)
+        with session_scope(user_id=user_id) as session:
+            session.add_all(
+                HealthMetric(user_id=user_id, date=taken_at.date(),
+                             time=taken_at - timedelta(minutes=minute),
+                             heart_rate=rng.randint(50, 160),
+                             blood_oxygen_level=rng.uniform(90, 100))
+                for minute in range(readings))
+        commits += 1
+    return commits
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4],
+                        help="shard counts to compare")
+    parser.add_argument('--writers', type=int, default=8,
+                        help="writer processes")
+    parser.add_argument('--users', type=int, default=1000,
+                        help="users the writes are spread over")
+    parser.add_argument('--readings', type=int, default=5,
+                        help="readings per commit")
+    parser.add_argument('--seconds', type=float, default=5,
+                        help="seconds of writing per shard count")
+    args = parser.parse_args(argv)
+
+    rows = []
+    baseline = None
+    for shards in args.shards:
+        with tempfile.TemporaryDirectory() as directory:
+            url = f'sqlite:///{os.path.join(directory, "writes.db")}'
+            engine = init_db(url, shards=shards)
+            with engine.begin() as connection:
+                connection.execute(insert(User), list(user_rows(
+                    args.users, hash_pool=['benchmark password hash'])))
+            for each in create.user_engines():
+                each.dispose()
+            engine.dispose()
+
+            # the writers start together once their processes are up
+            start = time.time() + 2
+            with ProcessPoolExecutor(args.writers) as executor:
+                commits = sum(executor.map(
+                    write, *zip(*[(url, shards, args.users, args.readings,
+                                   start, start + args.seconds, seed)
+                                  for seed in range(args.writers)])))
+        rate = commits / args.seconds
+        baseline = baseline or rate
+        rows.append(dict(shards=shards, writers=args.writers,
+                         commits=commits, commits_per_s=rate,
+                         readings_per_s=rate * args.readings,
+                         speedup=rate / baseline))
+    print_table(rows, ['shards', 'writers', 'commits', 'commits_per_s',
+                       'readings_per_s', 'speedup'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# Statement cache benchmark
+# Per-call latency of a few of the query_data lookups, run three ways on one
+# open session: as the session.query() chain the scenarios used to build on
+# every call, as a select() built on every call, and through the statement
+# query_data builds once at import. SQLite's share of each call is the same
+# in all three; the difference is SQLAlchemy building the statement and
+# finding its compiled form.
+import argparse
+from datetime import datetime, timedelta
+
+from benchmarks.common import time_calls, sample_user_ids, print_table
+from create import init_db, read_session
+from models import DailyUserSummary, Goal, User, Workout
+from query_data import (
+    ACTIVE_GOAL, AVERAGE_WATER_SINCE, USER_HEIGHT, WORKOUTS_IN_RANGE,
+    summary_average
+)
+from sqlalchemy import select
+
+START_DATE = '2023-04-01'
+END_DATE = '2024-01-31'
+
+
+def _water_average():
+    return summary_average(DailyUserSummary.water,
+                           DailyUserSummary.water_intake_count)
+
+
+# lookup: (query chain, select built per call, prebuilt statement), each
+# called as function(session, user_id, now)
+LOOKUPS = {
+    'user height': (
+        lambda session, user_id, now: session.query(User.height).filter(
+            User.id == user_id).scalar(),
+        lambda session, user_id, now: session.scalar(
+            select(User.height).where(User.id == user_id)),
+        lambda session, user_id, now: session.scalar(
+            USER_HEIGHT, dict(user_id=user_id)),
+    ),
+    'water average': (
+        lambda session, user_id, now: session.query(_water_average()).filter(
+            DailyUserSummary.user_id == user_id,
+            DailyUserSummary.date >= now - timedelta(days=7)).scalar(),
+        lambda session, user_id, now: session.scalar(
+            select(_water_average()).where(
+                DailyUserSummary.user_id == user_id,
+                DailyUserSummary.date >= now - timedelta(days=7))),
+        lambda session, user_id, now: session.scalar(
+            AVERAGE_WATER_SINCE,
+            dict(user_id=user_id, since=now - timedelta(days=7))),
+    ),
+    'workouts in range': (
+        lambda session, user_id, now: session.query(Workout).filter(
+            Workout.user_id == user_id,
+            Workout.date.between(START_DATE, END_DATE)).all(),
+        lambda session, user_id, now: session.scalars(
+            select(Workout).where(
+                Workout.user_id == user_id,
+                Workout.date.between(START_DATE, END_DATE))).all(),
+        lambda session, user_id, now: session.scalars(
+            WORKOUTS_IN_RANGE,
+            dict(user_id=user_id, start=START_DATE, end=END_DATE)).all(),
+    ),
+    'active goal': (
+        lambda session, user_id, now: session.query(Goal).filter(
+            Goal.user_id == user_id, Goal.deadline >= now
+        ).order_by(Goal.deadline.desc()).first(),
+        lambda session, user_id, now: session.scalar(
+            select(Goal).where(
+                Goal.user_id == user_id, Goal.deadline >= now
+            ).order_by(Goal.deadline.desc()).limit(1)),
+        lambda session, user_id, now: session.scalar(
+            ACTIVE_GOAL, dict(user_id=user_id, now=now)),
+    ),
+}
+APPROACHES = ['query chain', 'select per call', 'prebuilt']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=200,
+                        help="number of users to look up")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="lookups per user and approach")
+    args = parser.parse_args(argv)
+
+    init_db()
+    now = datetime.now()
+    rows = []
+    with read_session() as session:
+        user_ids = sample_user_ids(session, args.users)
+        calls = [(session, user_id, now)
+                 for user_id in user_ids] * args.repeat
+        for lookup, functions in LOOKUPS.items():
+            baseline = None
+            for approach, function in zip(APPROACHES, functions):
+                stats = time_calls(function, calls)
+                baseline = baseline or stats['mean_ms']
+                rows.append(dict(stats, lookup=lookup, approach=approach,
+                                 speedup=baseline / stats['mean_ms']))
+                # ORM objects loaded by one call are not kept for the next
+                session.expunge_all()
+    print_table(rows, ['lookup', 'approach', 'calls', 'speedup', 'mean_ms',
+                       'p50_ms', 'p95_ms', 'p99_ms'])
+
+
+if __name__ == "__main__":
+    main()
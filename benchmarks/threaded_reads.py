@@ -0,0 +1,56 @@
+# Threaded read benchmark
+# Builds the dashboard of a set of users from 1 to 16 threads at once: with
+# a short-lived read session per dashboard, as get_user_dashboard does by
+# default, and with one long-lived session shared by every thread, which is
+# only safe behind a lock. Dashboards per second and latency as the thread
+# count grows.
+import argparse
+import threading
+
+from benchmarks.common import (
+    percentile, run_threads, sample_user_ids, print_table)
+from create import Session, init_db, read_session
+from dashboard import get_user_dashboard
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--threads', default='1,2,4,8,16',
+                        help="comma separated thread counts")
+    parser.add_argument('--users', type=int, default=500,
+                        help="number of dashboards built per run")
+    parser.add_argument('--pool-size', type=int, default=None,
+                        help="connections in the engine's pool")
+    args = parser.parse_args(argv)
+
+    init_db(pool_size=args.pool_size)
+    with read_session() as session:
+        calls = [(user_id,) for user_id in sample_user_ids(session,
+                                                           args.users)]
+
+    shared = Session()
+    lock = threading.Lock()
+
+    def shared_session(user_id):
+        with lock:
+            get_user_dashboard(user_id, session=shared)
+
+    rows = []
+    for name, function in (('read session per call', get_user_dashboard),
+                           ('shared session', shared_session)):
+        function(*calls[0])
+        for threads in map(int, args.threads.split(',')):
+            latencies, elapsed = run_threads(function, calls, threads)
+            rows.append(dict(
+                approach=name, threads=threads,
+                dashboards_per_s=len(latencies) / elapsed,
+                p50_ms=percentile(latencies, 0.50),
+                p95_ms=percentile(latencies, 0.95),
+                p99_ms=percentile(latencies, 0.99)))
+    shared.close()
+    print_table(rows, ['approach', 'threads', 'dashboards_per_s', 'p50_ms',
+                       'p95_ms', 'p99_ms'])
+
+
+if __name__ == "__main__":
+    main()
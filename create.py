@@ -1,427 +1,467 @@
-from sqlalchemy import create_engine, Column, Date, DateTime, ForeignKey, func
-from sqlalchemy import Integer, String, Float, Enum, Index
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
-from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.schema import CheckConstraint
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-import bcrypt
+from models import (
+    Base, SCHEMA_VERSION,
+    User, UserSession, Workout, FoodItem, Vitamin, Mineral,
+    FoodItemVitamin, FoodItemMineral, Meal, MealFoodItem,
+    WaterIntake, NutritionLog, Medication, SleepLog,
+    HealthMetric, BodyComposition, Goal, GoalStatusEnum, GoalTypesEnum
+)
+from instrumentation import instrument
+from partitions import attach_partitions
+# importing rollups registers the flush listeners that maintain them
+from rollups import (
+    rebuild_daily_summaries, rebuild_meal_totals, rebuild_health_metric_tiers,
+    rebuild_user_latest_state
+)
 import secrets
-import enum
+import time
+import os
+
+
+# Default database location, overridable through HEALTH_DB_URL
+DEFAULT_DB_URL = 'sqlite:///health_and_fitness.db'
+
+# Connections the engine keeps open, overridable through HEALTH_DB_POOL_SIZE.
+# In WAL mode every reader can run at once on its own connection, so size it
+# to the number of threads that query concurrently. There is no overflow: a
+# connection opened past the pool would be closed after a single use,
+# paying for the PRAGMAs and a cold page cache each time, so the threads
+# past the pool wait for a free connection instead.
+POOL_SIZE = 10
+POOL_TIMEOUT = 30  # seconds
+
+# SQLite tuning profiles, applied as PRAGMAs to every new connection.
+# WAL lets readers keep reading while a writer commits, and synchronous=NORMAL
+# is crash-safe in WAL mode with far fewer fsyncs. The page cache and the
+# memory map keep the hot (user_id, date) indexes in memory, and busy_timeout
+# makes writers wait for the lock instead of failing with "database is locked".
+TUNING_PROFILES = {
+    # leave SQLite's defaults alone
+    'none': {},
+    # day-to-day application use
+    'default': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -64000,  # negative values are KiB, so 64 MB
+        'mmap_size': 268435456,  # 256 MB
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,  # milliseconds
+    },
+    # seeding load-test databases; a crash mid-load may corrupt the file
+    'bulk_load': {
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'cache_size': -512000,  # 512 MB
+        'mmap_size': 1073741824,  # 1 GB
+        'temp_store': 'MEMORY',
+        'busy_timeout': 30000,
+    },
+}
+
+# Number of user shards, overridable through HEALTH_DB_SHARDS. With more
+# than one, the rows of each user live in one of that many shard files next
+# to the main database, health_and_fitness.shard0.db and so on, picked by
+# shard_of(user_id). The main database keeps the users, their login sessions
+# and the food catalog, which every shard connection attaches as "common",
+# so queries joining them to a user's rows run unchanged on the user's
+# shard. Each shard file has its own write lock, so writes for users on
+# different shards no longer wait for each other.
+SHARD_COUNT = 1
+
+# Tables kept in the main database when sharded; the others are per user
+COMMON_TABLES = ['users', 'sessions', 'food_items', 'vitamins', 'minerals',
+                 'food_item_vitamins', 'food_item_minerals']
+SHARD_TABLES = [table for table in Base.metadata.sorted_tables
+                if table.name not in COMMON_TABLES]
+
+
+# Engine factory
+# echo is passed through to SQLAlchemy: False, True, or 'debug' to also log
+# result rows. profile names an entry in TUNING_PROFILES or is a dict of
+# PRAGMA names and values.
+def make_engine(url=None, echo=False, profile='default', pool_size=None):
+    url = make_url(url or os.environ.get('HEALTH_DB_URL', DEFAULT_DB_URL))
+    pool = {}
+    # in-memory SQLite databases live in a single connection per thread
+    if not _in_memory(url):
+        pool = dict(
+            pool_size=pool_size or int(os.environ.get('HEALTH_DB_POOL_SIZE',
+                                                      POOL_SIZE)),
+            max_overflow=0, pool_timeout=POOL_TIMEOUT)
+    new_engine = create_engine(url, echo=echo, **pool)
+    apply_tuning_profile(new_engine, profile)
+    attach_partitions(new_engine)
+    return new_engine
+
+
+def _in_memory(url):
+    return url.get_backend_name() == 'sqlite' and (
+        url.database in (None, '', ':memory:')
+        or url.query.get('mode') == 'memory')
+
+
+# URL of a shard file of a database, next to its file
+def shard_url(url, index):
+    stem, extension = os.path.splitext(url.database)
+    return url.set(database=f'{stem}.shard{index}{extension or ".db"}')
+
+
+# Attach the main database as "common" to every new connection of a shard's
+# engine, and record which shard of how many it is in the connection's info
+# (see rollups.rebuild_user_latest_state). Unqualified table names resolve
+# to the shard's own tables first, so only the COMMON_TABLES, which a shard
+# does not have, are read from the main database. For an AsyncEngine pass
+# its sync_engine.
+def attach_common(shard_engine, common_path, index, count):
+    @event.listens_for(shard_engine, 'connect')
+    def attach_common_database(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('ATTACH DATABASE ? AS common', (common_path,))
+        cursor.close()
+        connection_record.info['shard'] = (index, count)
+
+
+# Set a tuning profile's PRAGMAs on every new connection of a SQLite engine.
+# For an AsyncEngine pass its sync_engine.
+def apply_tuning_profile(engine, profile):
+    pragmas = TUNING_PROFILES[profile] if isinstance(profile, str) else profile
+
+    if pragmas and engine.dialect.name == 'sqlite':
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+            cursor.close()
+
+
+# Parse the HEALTH_DB_ECHO environment variable into an echo level
+def echo_from_env():
+    value = os.environ.get('HEALTH_DB_ECHO', '').lower()
+    if value == 'debug':
+        return 'debug'
+    return value in ('1', 'true', 'yes')
 
 
 # basic configuration
-engine = create_engine('sqlite:///health_and_fitness.db', echo=True)
-Base = declarative_base()
-Session = sessionmaker(bind=engine)
-
-
-# User class
-# Static information about the user that does not change frequently
-class User(Base):
-    __tablename__ = 'users'
-    id = Column(Integer, primary_key=True)
-    username = Column(String(255), unique=True, nullable=False)  # For login
-    # For account recovery and notifications
-    email = Column(String(255), unique=True, nullable=False)
-    # Securely storing the hashed password
-    password_hash = Column(String(255), nullable=False)
-    # Name might not be strictly required
-    name = Column(String(255), nullable=True)
-    # Age is optional but, if provided, must be non-negative integer
-    age = Column(Integer, CheckConstraint('age>=0'), nullable=True)
-    # Gender is optional, I may consider using Enum for predefined values
-    gender = Column(String(50), nullable=True)
-    # non-negative initial weight and height
-    initial_weight = Column(Float, CheckConstraint('initial_weight>=0'),
-                            nullable=False)
-    # non-negative height
-    height = Column(Float, CheckConstraint('height>=0'), nullable=False)
-
-    # relationships with other tables
-    workouts = relationship("Workout", back_populates="user")
-    meals = relationship("Meal", back_populates="user")
-    water_intakes = relationship("WaterIntake", back_populates="user")
-    nutrition_logs = relationship("NutritionLog", back_populates="user")
-    medications = relationship("Medication", back_populates="user")
-    sleep_logs = relationship("SleepLog", back_populates="user")
-    health_metrics = relationship("HealthMetric", back_populates="user")
-    body_compositions = relationship(
-        "BodyComposition", back_populates="user")
-    goals = relationship("Goal", back_populates="user")
-    # For session management
-    sessions = relationship("UserSession", back_populates="user")
-
-    # Password hashing methods
-    def set_password(self, password):
-        self.password_hash = bcrypt.hashpw(password.encode('utf-8'),
-                                           bcrypt.gensalt())
-
-    def check_password(self, password):
-        return bcrypt.checkpw(password.encode('utf-8'),
-                              self.password_hash.encode('utf-8'))
-
-
-# Session model
-class UserSession(Base):
-    __tablename__ = 'sessions'
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'), index=True,
-                     nullable=False)
-    # Ensuring uniqueness and non-nullability
-    token = Column(String(255), unique=True, nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
-    # Ensure an expiration time is always provided
-    expires_at = Column(DateTime, nullable=False)
-    user = relationship("User", back_populates="sessions")
-
-    __table_args__ = (
-        CheckConstraint('expires_at > created_at',
-                        name='check_expiration_after_creation'),
-    )
-
-
-# The following classes are for the user's health and fitness data
-# They are related to the User class through foreign keys
-
-# FoodItem class
-class FoodItem(Base):
-    __tablename__ = 'food_items'
-    id = Column(Integer, primary_key=True)
-    name = Column(String(255), nullable=False)
-    # nutritional information per serving
-    calories = Column(Float, CheckConstraint('calories>=0'), nullable=False)
-    proteins = Column(Float, CheckConstraint('proteins>=0'), nullable=False)
-    carbs = Column(Float, CheckConstraint('carbs>=0'), nullable=False)
-    fats = Column(Float, CheckConstraint('fats>=0'), nullable=False)
-    fiber = Column(Float, CheckConstraint('fiber>=0'))
-    # instead of using json, I created tables for vitamins and minerals
-    vitamins = relationship("FoodItemVitamin", back_populates="food_item")
-    minerals = relationship("FoodItemMineral", back_populates="food_item")
-    # relationships with other tables
-    meal_food_items = relationship("MealFoodItem", back_populates="food_item")
-
-
-# vitamins and minerals are separate classes to allow for more details
-class Vitamin(Base):
-    __tablename__ = 'vitamins'
-    id = Column(Integer, primary_key=True)
-    name = Column(String(255), nullable=False)  # vitamine type/name
-    # Other relevant fields
-
-
-class Mineral(Base):
-    __tablename__ = 'minerals'
-    id = Column(Integer, primary_key=True)
-    name = Column(String(255), nullable=False)  # mineral type/name
-    # Other relevant fields
-
-
-# FoodItemVitamin and FoodItemMineral classes (Association Objects)
-class FoodItemVitamin(Base):
-    __tablename__ = 'food_item_vitamins'
-    id = Column(Integer, primary_key=True)
-    food_item_id = Column(Integer, ForeignKey('food_items.id'), nullable=False,
-                          index=True)
-    vitamin_id = Column(Integer, ForeignKey('vitamins.id'), nullable=False,
-                        index=True)
-    amount = Column(Float, CheckConstraint('amount>=0'),
-                    nullable=False)  # e.g., amount in milligrams
-    food_item = relationship("FoodItem", back_populates="vitamins")
-    vitamin = relationship("Vitamin")
-
-
-class FoodItemMineral(Base):
-    __tablename__ = 'food_item_minerals'
-    id = Column(Integer, primary_key=True)
-    food_item_id = Column(Integer, ForeignKey('food_items.id'), nullable=False,
-                          index=True)
-    mineral_id = Column(Integer, ForeignKey('minerals.id'), nullable=False,
-                        index=True)
-    amount = Column(Float, nullable=False)  # e.g., amount in milligrams
-    food_item = relationship("FoodItem", back_populates="minerals")
-    mineral = relationship("Mineral")
-
-
-# Meal class
-class Meal(Base):
-    __tablename__ = 'meals'
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    date = Column(Date, nullable=False)
-    meal_type = Column(String(255), nullable=False)  # Breakfast, Lunch, etc.
-    eating_time = Column(DateTime, nullable=False)
-    user = relationship("User", back_populates="meals")
-    food_items = relationship("MealFoodItem", back_populates="meal")
-
-    # indexing user_id and date for faster queries
-    # indexing by user_id first since it is more selective and commonly used
-    __table_args__ = (
-        Index('idx_user_id_date_m', 'user_id', 'date'),
-    )
-
-
-# MealFoodItem class (Association Object), many-to-many relationship
-# This allows recording which food items are part of which meals
-class MealFoodItem(Base):
-    __tablename__ = 'meal_food_items'
-    id = Column(Integer, primary_key=True)
-    meal_id = Column(Integer, ForeignKey('meals.id'), nullable=False,
-                     index=True)
-    food_item_id = Column(Integer, ForeignKey('food_items.id'), nullable=False,
-                          index=True)
-    servings_consumed = Column(Float, CheckConstraint('servings_consumed>=0'),
-                               default=1, nullable=False)  # number of servings
-    meal = relationship("Meal", back_populates="food_items")
-    food_item = relationship("FoodItem")
-
-
-# WaterIntake class
-class WaterIntake(Base):
-    __tablename__ = 'water_intake'
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'),
-                     nullable=False)
-    date = Column(Date, nullable=False)
-    # Ensuring water intake amount is non-negative
-    amount = Column(Float, CheckConstraint('amount>=0'), nullable=False)
-    user = relationship("User", back_populates="water_intakes")
-
-    # indexing user_id and date for faster queries
-    # indexing by user_id first since it is more selective and commonly used
-    __table_args__ = (
-        Index('idx_user_id_date_wi', 'user_id', 'date'),
-    )
-
-
-# NutritionLog class
-class NutritionLog(Base):
-    __tablename__ = 'nutrition_logs'
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'),
-                     nullable=False)
-    date = Column(Date, nullable=False)
-    # include total calories, water intake, etc.
-    summary = Column(String(1000), nullable=False)
-    user = relationship("User", back_populates="nutrition_logs")
-
-    # indexing user_id and date for faster queries
-    # indexing by user_id first since it is more selective and commonly used
-    __table_args__ = (
-        Index('idx_user_id_date_nl', 'user_id', 'date'),
-    )
-
-
-class Medication(Base):
-    __tablename__ = 'medications'
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    name = Column(String(255), nullable=False)
-    dosage = Column(String(255), nullable=False)  # Dosage in mg or specifics
-    frequency = Column(String(255), nullable=False)  # How often taken
-    start_date = Column(Date, nullable=False)
-    end_date = Column(Date, nullable=True)  # nullable if ongoing
-    reason = Column(String(1000), nullable=True)  # Reason for medication
-
-    user = relationship("User", back_populates="medications")
-
-    __table_args__ = (
-        Index('idx_meds_user_start_end', 'user_id', 'start_date', 'end_date'),
-    )
-
-
-# Workout class
-class Workout(Base):
-    __tablename__ = 'workouts'
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'),
-                     nullable=False)
-    date = Column(Date, nullable=False)
-    # Assuming a max length for the workout type
-    type = Column(String(255), nullable=False)
-    # Ensure duration is non-negative
-    duration = Column(Float, CheckConstraint('duration>=0'), nullable=False)
-    # Max length for the intensity description
-    intensity = Column(String(255), nullable=False)
-    # Ensure non-negative calories burned
-    calories_burned = Column(Float, CheckConstraint('calories_burned>=0'),
-                             nullable=False)
-    user = relationship("User", back_populates="workouts")
-
-    # indexing user_id and date for faster queries
-    # indexing by user_id first since it is more selective and commonly used
-    __table_args__ = (
-        Index('idx_user_id_date_wo', 'user_id', 'date'),
-    )
-
-
-# SleepLog class
-class SleepLog(Base):
-    __tablename__ = 'sleep_logs'
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'),
-                     nullable=False)
-    date = Column(Date, nullable=False)
-    time_fell_asleep = Column(DateTime, nullable=False)
-    time_woke_up = Column(DateTime, nullable=False)
-    deep_sleep_duration = Column(Float, CheckConstraint(
-        'deep_sleep_duration>=0'), nullable=True)  # Non-negative, optional
-    rem_sleep_duration = Column(Float, CheckConstraint(
-        'rem_sleep_duration>=0'), nullable=True)
-    light_sleep_duration = Column(Float, CheckConstraint(
-        'light_sleep_duration>=0'), nullable=True)
-    interruptions = Column(Integer, CheckConstraint(
-        'interruptions>=0'), nullable=True)
-    sleep_quality_index = Column(Integer, CheckConstraint(
-        'sleep_quality_index>=0'), nullable=True)  # An index of sleep quality
-    notes = Column(String(
-        1000), nullable=True)  # Optional, with a reasonable max length notes
-
-    user = relationship("User", back_populates="sleep_logs")
-
-    # Validate sleep time range
-    __table_args__ = (
-        CheckConstraint('time_fell_asleep < time_woke_up',
-                        name='check_sleep_times'),
-    )
-
-    @hybrid_property
-    def total_sleep_duration(self):
-        if self.time_fell_asleep and self.time_woke_up:
-            # Calculate total sleep duration based on the timestamps
-            total_seconds = (
-                self.time_woke_up - self.time_fell_asleep).total_seconds()
-            return total_seconds / 3600  # Convert seconds to hours
-        return 0
-
-    @total_sleep_duration.expression
-    def total_sleep_duration(cls):
-        # Use database function to calculate duration for queries
-        return (func.julianday(
-            cls.time_woke_up) - func.julianday(cls.time_fell_asleep)) * 24
-
-    # indexing user_id and date for faster queries
-    # indexing by user_id first since it is more selective and commonly used
-    __table_args__ = (
-        Index('idx_user_id_date_sl', 'user_id', 'date'),
-    )
-
-
-# HealthMetric class
-class HealthMetric(Base):
-    __tablename__ = 'health_metrics'
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'),
-                     nullable=False)
-    date = Column(Date, nullable=False)
-    time = Column(DateTime, nullable=False)  # time of the day
-
-    # Heart rate should be positive, optional
-    heart_rate = Column(Integer,
-                        CheckConstraint('heart_rate>0'), nullable=True)
-    systolic_blood_pressure = Column(Integer, CheckConstraint(
-        'systolic_blood_pressure>0'), nullable=True)  # Optional, positive
-    diastolic_blood_pressure = Column(Integer, CheckConstraint(
-        'diastolic_blood_pressure>0'), nullable=True)  # Optional, positive
-
-    blood_oxygen_level = Column(Float, CheckConstraint(
-        'blood_oxygen_level>=0 AND blood_oxygen_level<=100'),
-        nullable=True)  # Optional, 0-100 range
-    blood_glucose_level = Column(Float, CheckConstraint(
-        'blood_glucose_level>0'), nullable=True)  # Optional, positive
-    body_temperature = Column(Float, CheckConstraint(
-        'body_temperature>0'), nullable=True)  # Optional, positive
-
-    user = relationship("User", back_populates="health_metrics")
-
-    # indexing user_id, date, and time for faster queries
-    # indexing by user_id first since it is more selective and commonly used
-    # date and time are commonly used for filtering but date is more important
-    __table_args__ = (
-        Index('idx_user_id_date_time_hm', 'user_id', 'date', 'time'),
-    )
-
-
-# BodyComposition class
-class BodyComposition(Base):
-    __tablename__ = 'body_compositions'
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'),
-                     nullable=False)
-    date = Column(Date, nullable=False)
-
-    # Assuming weight can be optional but must be positive when provided
-    weight = Column(Float, CheckConstraint('weight>0'), nullable=True)
-    # height is assumed to be static and is provided in the user model
-    # bmi = Column(Float)  # I will calculate this dynamically
-
-    # detail body composition metrics
-    body_fat_percentage = Column(
-        Float, CheckConstraint(
-            'body_fat_percentage >= 0 AND body_fat_percentage <= 100'),
-        nullable=True)
-    skeletal_muscle_mass = Column(
-        Float, CheckConstraint('skeletal_muscle_mass > 0'),
-        nullable=True)
-    lean_body_mass = Column(
-        Float, CheckConstraint('lean_body_mass > 0'), nullable=True)
-    body_water = Column(
-        Float, CheckConstraint('body_water > 0'), nullable=True)
-    visceral_fat_level = Column(
-        Integer, CheckConstraint('visceral_fat_level >= 0'), nullable=True)
-    bone_mass = Column(Float, CheckConstraint('bone_mass > 0'), nullable=True)
-    basal_metabolic_rate = Column(
-        Integer, CheckConstraint('basal_metabolic_rate > 0'), nullable=True)
-    metabolic_age = Column(Integer, CheckConstraint('metabolic_age > 0'),
-                           nullable=True)
-
-    user = relationship("User", back_populates="body_compositions")
-
-    # indexing user_id and date for faster queries
-    # indexing by user_id first since it is more selective and commonly used
-    __table_args__ = (
-        Index('idx_user_id_date_bc', 'user_id', 'date'),
-    )
-
-
-# Goal class
-
-# Define an enumeration for goal statuses
-class GoalStatusEnum(enum.Enum):
-    NOT_STARTED = "Not Started"
-    IN_PROGRESS = "In Progress"
-    ACHIEVED = "Achieved"
-    FAILED = "Failed"
-
-# Define an enumeration for goal types
-class GoalTypesEnum(enum.Enum):
-    WEIGHT_LOSS = "Weight Loss"
-    MUSCLE_GAIN = "Muscle Gain"
-    STAMINA_BUILDING = "Stamina Building"
-
-class Goal(Base):
-    __tablename__ = 'goals'
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'), index=True,
-                     nullable=False)
-    # Use Enum for predefined goal types 
-    goal_type = Column(Enum(GoalTypesEnum), nullable=False)
-    target_value = Column(Float, CheckConstraint('target_value>=0'),
-                          nullable=False)  # Targets should be non-negative
-    current_value = Column(Float, CheckConstraint('current_value>=0'),
-                           nullable=False)  # values should be non-negative
-    deadline = Column(Date, nullable=True)  # A goal may not have a deadline
-    # Use Enum for predefined statuses
-    status = Column(Enum(GoalStatusEnum), nullable=False)
-
-    user = relationship("User", back_populates="goals")
-
-
-# Create the tables
-Base.metadata.create_all(engine)
+# Nothing touches the database at import time. init_db() builds the engine,
+# binds Session to it and brings the schema up to date; call it once at
+# startup before opening sessions.
+engine = None
+# Engines of the shard files, in shard order; empty when not sharded
+shard_engines = []
+# Statement statistics of the engine, kept when HEALTH_DB_SLOW_QUERY_MS is set
+# to the slow-query log threshold in milliseconds
+instrumentation = None
+Session = sessionmaker()
+# Sessions for reads: loaded objects are not expired, so they stay usable
+# after the session is closed, and nothing is flushed before queries
+ReadSession = sessionmaker(expire_on_commit=False, autoflush=False)
+
+
+# Index of the shard holding a user's rows
+def shard_of(user_id):
+    return user_id % len(shard_engines)
+
+
+# Engine of the database holding a user's rows: the user's shard, or the
+# main database when not sharded
+def user_engine(user_id):
+    return shard_engines[shard_of(user_id)] if shard_engines else engine
+
+
+# Engines of the databases holding the users' rows: the shards, or the main
+# database when not sharded
+def user_engines():
+    return shard_engines or [engine]
+
+
+# Session arguments binding it to the database holding a user's rows
+def _user_bind(user_id):
+    if user_id is None or not shard_engines:
+        return {}
+    return {'bind': shard_engines[shard_of(user_id)]}
+
+
+# A session for one unit of work: committed when the block ends, rolled back
+# if it raises, and closed either way. Writes of a user's rows pass the
+# user_id so they go to the user's shard.
+@contextmanager
+def session_scope(user_id=None):
+    with Session(**_user_bind(user_id)) as session:
+        with session.begin():
+            yield session
+
+
+# A short-lived session for reads, closed (and its transaction rolled back)
+# when the block ends, on the shard of user_id if given. Passing an open
+# session uses it instead, so callers can run several reads on one
+# connection and snapshot.
+@contextmanager
+def read_session(session=None, user_id=None):
+    if session is not None:
+        yield session
+        return
+    with ReadSession(**_user_bind(user_id)) as session:
+        yield session
+
+
+# Migration step creating indexes added to existing tables, which
+# create_all leaves out
+def create_indexes(*names):
+    def migrate(connection):
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in names:
+                    index.create(connection, checkfirst=True)
+    return migrate
+
+
+# Migration step dropping indexes that were replaced or removed
+def drop_indexes(*names):
+    def migrate(connection):
+        for name in names:
+            connection.exec_driver_sql(f'DROP INDEX IF EXISTS {name}')
+    return migrate
+
+
+# Migration step recreating a table whose constraints changed, since SQLite
+# cannot alter them in place: the rows are copied into a table created from
+# the model and the old table dropped. A table already matching its model is
+# left alone.
+def rebuild_table(name):
+    def migrate(connection):
+        table = Base.metadata.tables[name]
+        stored = connection.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (name,)).scalar()
+        expected = str(CreateTable(table).compile(connection))
+        if stored is None or ' '.join(stored.split()) \
+                == ' '.join(expected.split()):
+            return
+        columns = ', '.join(
+            row[1] for row in connection.exec_driver_sql(
+                f'PRAGMA table_info({name})')
+            if row[1] in table.columns)
+        for index in connection.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'index' "
+                "AND tbl_name = ? AND sql IS NOT NULL", (name,)).scalars():
+            connection.exec_driver_sql(f'DROP INDEX {index}')
+        # the legacy rename leaves foreign keys to the table pointing at its
+        # name, which the new table takes over
+        connection.exec_driver_sql('PRAGMA legacy_alter_table = ON')
+        connection.exec_driver_sql(f'ALTER TABLE {name} RENAME TO {name}_old')
+        connection.exec_driver_sql('PRAGMA legacy_alter_table = OFF')
+        table.create(connection)
+        connection.exec_driver_sql(
+            f'INSERT INTO {name} ({columns}) '
+            f'SELECT {columns} FROM {name}_old')
+        connection.exec_driver_sql(f'DROP TABLE {name}_old')
+    return migrate
+
+
+# SQL creating the food_search full-text index over food_items.name: an
+# external content FTS5 table, which stores only the index and reads names
+# from food_items, kept in step by triggers so Core bulk inserts are indexed
+# too. The prefix indexes make the 1 to 3 character prefixes of type-ahead
+# lookups about as cheap as whole words.
+FOOD_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS food_search USING fts5(
+        name, content='food_items', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='1 2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS food_search_insert
+        AFTER INSERT ON food_items BEGIN
+        INSERT INTO food_search(rowid, name) VALUES (new.id, new.name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS food_search_delete
+        AFTER DELETE ON food_items BEGIN
+        INSERT INTO food_search(food_search, rowid, name)
+        VALUES ('delete', old.id, old.name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS food_search_update
+        AFTER UPDATE OF id, name ON food_items BEGIN
+        INSERT INTO food_search(food_search, rowid, name)
+        VALUES ('delete', old.id, old.name);
+        INSERT INTO food_search(rowid, name) VALUES (new.id, new.name);
+    END""",
+]
+
+
+# Migration step creating food_search and indexing the existing food items
+def create_food_search(connection):
+    for statement in FOOD_SEARCH_DDL:
+        connection.exec_driver_sql(statement)
+    connection.exec_driver_sql(
+        "INSERT INTO food_search(food_search) VALUES ('rebuild')")
+
+
+# Migration step running several steps in order
+def run_all(*steps):
+    def migrate(connection):
+        for step in steps:
+            step(connection)
+    return migrate
+
+
+# Schema upgrade steps, keyed by the version they upgrade to. Each takes a
+# connection and must be idempotent, because a fresh database created by
+# create_all at the latest version also runs every step.
+MIGRATIONS = {
+    # daily_user_summary: fill it from the existing rows
+    2: rebuild_daily_summaries,
+    # meal_nutrient_totals, meal_vitamin_totals and meal_mineral_totals
+    3: rebuild_meal_totals,
+    # health_metric_hourly and health_metric_daily
+    4: rebuild_health_metric_tiers,
+    # sessions.expires_at, for sweeping expired sessions
+    5: create_indexes('idx_expires_at_s'),
+    # covering indexes proposed by index_advisor.py, replacing the narrower
+    # ones they extend, and the sleep_logs time check, which the index on
+    # the table had overridden
+    6: run_all(
+        create_indexes('idx_user_id_deadline_g',
+                       'idx_meal_id_food_item_id_mfi',
+                       'idx_user_id_date_duration_type_w',
+                       'idx_user_id_date_id_basal_metabolic_rate_weight_bc'),
+        drop_indexes('ix_goals_user_id', 'ix_meal_food_items_meal_id',
+                     'idx_user_id_date_wo', 'idx_user_id_date_bc'),
+        rebuild_table('sleep_logs')),
+    # user_latest_state: fill it from the existing rows
+    7: rebuild_user_latest_state,
+    # food_search, the full-text index of food item names
+    8: create_food_search,
+    # 9: partitions, the registry of partitions.py, needs no step
+    # 10: archive_stubs, the stubs of archive.py, needs no step
+}
+
+# Steps skipped on the shards, which only touch COMMON_TABLES
+COMMON_MIGRATIONS = {5, 8}
+
+
+class SchemaVersionError(RuntimeError):
+    pass
+
+
+class ShardCountError(RuntimeError):
+    pass
+
+
+# Read the schema version stored in the database file
+def schema_version(connection):
+    return connection.exec_driver_sql('PRAGMA user_version').scalar()
+
+
+# Bring a database file's schema up to date: create the missing tables (of
+# tables only, if given) and run the MIGRATIONS steps past its version
+# except the skipped ones
+def upgrade_schema(connection, tables=None, skipped=()):
+    version = schema_version(connection)
+    if version > SCHEMA_VERSION:
+        raise SchemaVersionError(
+            f"Database schema version {version} is newer than this code "
+            f"supports ({SCHEMA_VERSION}).")
+    if version < SCHEMA_VERSION:
+        # Create the tables
+        Base.metadata.create_all(connection, tables=tables)
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            if target in MIGRATIONS and target not in skipped:
+                MIGRATIONS[target](connection)
+        connection.exec_driver_sql(f'PRAGMA user_version={SCHEMA_VERSION}')
+
+
+# Whether the main database holds rows of any per-user table
+def _has_user_rows(main_engine):
+    with main_engine.connect() as connection:
+        present = set(connection.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'table'").scalars())
+        return any(connection.exec_driver_sql(
+            f'SELECT 1 FROM main.{table.name} LIMIT 1').first()
+            for table in SHARD_TABLES if table.name in present)
+
+
+# Engines of the shards of the main database's engine. Users are placed by
+# their id modulo the number of shards, so once a database has been split
+# (see shards.py) it must keep being opened with the same count. The shard
+# files are only created for a main database without per-user rows, or
+# when splitting is set by shards.py, which moves the rows into them;
+# otherwise every read would go to empty shards.
+def make_shard_engines(main_engine, count, echo, profile, pool_size,
+                       splitting=False):
+    url = main_engine.url
+    if _in_memory(url):
+        if count > 1:
+            raise ShardCountError("An in-memory database cannot be sharded.")
+        return []
+    existing = 0
+    while os.path.exists(shard_url(url, existing).database):
+        existing += 1
+    if existing and existing != count:
+        raise ShardCountError(
+            f"The database is split into {existing} shards, not {count}; "
+            f"set HEALTH_DB_SHARDS to match.")
+    if count < 2:
+        return []
+    if not existing and not splitting and _has_user_rows(main_engine):
+        raise ShardCountError(
+            f"The database has not been split into {count} shards yet; "
+            f"run shards.py split first.")
+    common_path = os.path.abspath(url.database)
+    engines = []
+    for index in range(count):
+        shard_engine = make_engine(shard_url(url, index), echo=echo,
+                                   profile=profile, pool_size=pool_size)
+        attach_common(shard_engine, common_path, index, count)
+        engines.append(shard_engine)
+    return engines
+
+
+# Create the engines and the schema. Introspection only happens when the
+# stored schema version is older than SCHEMA_VERSION, so starting against an
+# up-to-date database costs a single PRAGMA per file. shards overrides
+# HEALTH_DB_SHARDS; splitting lets shards.py create the shard files of a
+# database it is about to split (see make_shard_engines).
+def init_db(url=None, echo=None, profile=None, pool_size=None, shards=None,
+            splitting=False):
+    global engine, shard_engines, instrumentation
+    if engine is None or url is not None or echo is not None \
+            or profile is not None or pool_size is not None \
+            or shards is not None or splitting:
+        echo = echo_from_env() if echo is None else echo
+        profile = profile or os.environ.get('HEALTH_DB_PROFILE', 'default')
+        engine = make_engine(url, echo=echo, profile=profile,
+                             pool_size=pool_size)
+        shard_engines = make_shard_engines(
+            engine,
+            shards or int(os.environ.get('HEALTH_DB_SHARDS', SHARD_COUNT)),
+            echo, profile, pool_size, splitting)
+        slow_query_ms = os.environ.get('HEALTH_DB_SLOW_QUERY_MS')
+        if slow_query_ms:
+            instrumentation = instrument(engine, float(slow_query_ms))
+        Session.configure(bind=engine)
+        ReadSession.configure(bind=engine)
+
+    with engine.begin() as connection:
+        upgrade_schema(connection)
+    for shard_engine in shard_engines:
+        with shard_engine.begin() as connection:
+            upgrade_schema(connection, SHARD_TABLES, COMMON_MIGRATIONS)
+    return engine
+
+
+# Engine created by init_db(), initializing the database on first use
+def get_engine():
+    return engine if engine is not None else init_db()
 
 
 # User registration and login functions
+# auth.register and auth.login are versions that are safe to call from many
+# threads at once and return their results instead of printing them
 
 # User registration
 def register_user(username, email, password):
@@ -465,3 +505,12 @@ def login_user(username, password):
         print(f"An error occurred while logging in: {e}")
     finally:
         session.close()
+
+
+# Create the schema and report how long a cold start takes
+if __name__ == "__main__":
+    started = time.perf_counter()
+    init_db()
+    elapsed = time.perf_counter() - started
+    print(f"Database schema version {SCHEMA_VERSION} ready in "
+          f"{elapsed * 1000:.1f} ms.")
@@ -0,0 +1,234 @@
+# User dashboard
+# The home screen shows the answers of all 14 query_data scenarios. Calling
+# the scenario functions one by one costs about 20 queries per page view;
+# get_user_dashboard computes the same answers with five: one row of
+# aggregates built from scalar subqueries over the user row and the daily
+# summaries, plus one query each for
+# the active goal, the recent workouts, the body composition history and the
+# latest body composition and health metrics from user_latest_state. A sixth
+# reads the latest health metrics when they have been moved to a partition.
+from create import read_session
+from partitions import sources
+from archive import archived_rows
+from query_data import (
+    INTENSITY_SCORES, summary_average, food_item_count_since, moved_reading,
+    recommended_water_intake, calorie_intake_suggestion,
+    fitness_level_feedback, sleep_duration_feedback,
+    sleep_consistency_feedback, dietary_diversity_feedback,
+    goal_progress, goal_progress_feedback, bmi_feedback
+)
+from models import (
+    User, Workout, HealthMetric, BodyComposition, Goal, DailyUserSummary,
+    UserLatestState
+)
+from sqlalchemy import or_
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Optional
+
+
+@dataclass
+class UserDashboard:
+    user_id: int
+    # Scenario 1 and 14, over the dashboard's date range
+    workouts: list = field(default_factory=list)
+    frequent_workouts: list = field(default_factory=list)
+    # Scenario 2, over the dashboard's date range
+    average_daily_calories: Optional[float] = None
+    # Scenario 3
+    average_sleep_duration: Optional[float] = None
+    # Scenario 4, (date, weight) pairs
+    weight_history: list = field(default_factory=list)
+    # Scenario 5
+    last_health_metrics: Optional[HealthMetric] = None
+    # Scenario 6, liters per day
+    average_water_intake: Optional[float] = None
+    recommended_water_intake: Optional[float] = None
+    # Scenarios 7 to 13
+    calorie_suggestion: str = ""
+    fitness_level: str = ""
+    sleep_tips: str = ""
+    sleep_consistency_tips: str = ""
+    dietary_diversity_tips: str = ""
+    goal_progress: str = ""
+    bmi: str = ""
+
+
+# Scalar subquery averaging a daily_user_summary total over a date filter
+def _summary_average(session, user_id, total, count, date_filter):
+    return session.query(summary_average(total, count)).filter(
+        DailyUserSummary.user_id == user_id, date_filter).scalar_subquery()
+
+
+# Compute every scenario's answer for one user. start_date and end_date
+# bound the workout listing and summary and the calorie average; they default
+# to the last 30 days, the window the recommendation scenarios use. The five
+# queries run on one short-lived read session, or on session if given.
+def get_user_dashboard(user_id, start_date=None, end_date=None, session=None):
+    with read_session(session, user_id) as session:
+        return _build_dashboard(session, user_id, start_date, end_date)
+
+
+def _build_dashboard(session, user_id, start_date, end_date):
+    now = datetime.now()
+    one_month_ago = now - timedelta(days=30)
+    one_year_ago = now - timedelta(days=365)
+    start_date = start_date or one_month_ago
+    end_date = end_date or now
+    dashboard = UserDashboard(user_id=user_id)
+
+    # 1. One row of aggregates over the user and their daily summaries
+    summary = DailyUserSummary
+    aggregates = session.query(
+        User.height,
+        User.gender,
+        _summary_average(session, user_id, summary.water,
+                         summary.water_intake_count,
+                         summary.date >= now - timedelta(days=7)),
+        _summary_average(session, user_id, summary.calories_in,
+                         summary.meal_food_item_count,
+                         summary.date.between(start_date, end_date)),
+        _summary_average(session, user_id, summary.calories_in,
+                         summary.meal_food_item_count,
+                         summary.date.between(one_month_ago, now)),
+        # the meals of the last month may start in a partition
+        food_item_count_since(
+            sources(session.connection(), one_month_ago)).scalar_subquery(),
+        _summary_average(session, user_id, summary.sleep_hours,
+                         summary.sleep_log_count,
+                         summary.date >= one_month_ago),
+        _summary_average(session, user_id, summary.bedtime_hour_total,
+                         summary.sleep_log_count,
+                         summary.date >= one_month_ago),
+        _summary_average(session, user_id, summary.wakeup_hour_total,
+                         summary.sleep_log_count,
+                         summary.date >= one_month_ago),
+    ).filter(User.id == user_id).params(
+        user_id=user_id, since=one_month_ago).first()
+    (height, gender, water, range_calories, month_calories, food_item_count,
+     sleep_duration, bedtime, wakeup) = aggregates or (None,) * 9
+    if aggregates is None:
+        # unknown user: the scenario functions still answer from other tables
+        food_item_count = 0
+
+    # 2. The active goal with the latest deadline, the newest on a tie
+    goal = session.query(Goal).filter(
+        Goal.user_id == user_id,
+        Goal.deadline >= now
+    ).order_by(Goal.deadline.desc(), Goal.id.desc()).first()
+
+    # 3. Workouts covering both the dashboard range and the last month
+    workouts = session.query(Workout).filter(
+        Workout.user_id == user_id,
+        or_(Workout.date.between(start_date, end_date),
+            Workout.date >= one_month_ago)
+    ).order_by(Workout.date).all()
+    # the dashboard range may reach back into archived months
+    archived = archived_rows(session.connection(), Workout, [user_id],
+                             start_date, end_date)
+    if archived:
+        workouts = sorted(archived + workouts,
+                          key=lambda workout: workout.date)
+
+    # 4. Body compositions of the past year
+    compositions = session.query(
+        BodyComposition.date, BodyComposition.weight
+    ).filter(
+        BodyComposition.user_id == user_id,
+        BodyComposition.date >= one_year_ago
+    ).order_by(BodyComposition.date.asc(), BodyComposition.id.asc()).all()
+
+    # 5. Latest body composition values and health metrics
+    latest, dashboard.last_health_metrics = session.query(
+        UserLatestState, HealthMetric
+    ).outerjoin(
+        HealthMetric, HealthMetric.id == UserLatestState.health_metric_id
+    ).filter(UserLatestState.user_id == user_id).first() or (None, None)
+    if latest is not None and latest.health_metric_id is not None \
+            and dashboard.last_health_metrics is None:
+        dashboard.last_health_metrics = moved_reading(
+            session, latest.health_metric_id, latest.health_metric_date)
+    if latest is not None and latest.body_composition_id is None:
+        latest = None
+
+    # Workout scenarios
+    in_range = [workout for workout in workouts
+                if _between(workout.date, start_date, end_date)]
+    dashboard.workouts = in_range
+    dashboard.frequent_workouts = _summarize(in_range)
+    last_month = [workout for workout in workouts
+                  if _between(workout.date, one_month_ago, now)]
+    if last_month:
+        dashboard.fitness_level = fitness_level_feedback(
+            sum(INTENSITY_SCORES[workout.intensity] for workout in last_month)
+            / len(last_month))
+    else:
+        dashboard.fitness_level = fitness_level_feedback(None)
+
+    # Nutrition and hydration scenarios
+    dashboard.average_daily_calories = range_calories
+    dashboard.average_water_intake = water
+    dashboard.recommended_water_intake = recommended_water_intake(gender)
+    if latest is None or latest.basal_metabolic_rate is None:
+        dashboard.calorie_suggestion = "No body composition data available to suggest nutritional improvements."
+    else:
+        dashboard.calorie_suggestion = calorie_intake_suggestion(
+            month_calories, latest.basal_metabolic_rate)
+    dashboard.dietary_diversity_tips = dietary_diversity_feedback(
+        food_item_count)
+
+    # Sleep scenarios
+    dashboard.average_sleep_duration = sleep_duration
+    dashboard.sleep_tips = sleep_duration_feedback(sleep_duration)
+    dashboard.sleep_consistency_tips = sleep_consistency_feedback(
+        bedtime, wakeup)
+
+    # Body composition scenarios
+    dashboard.weight_history = [
+        (row.date, row.weight) for row in compositions
+        if _on_or_after(row.date, one_year_ago)]
+    dashboard.bmi = bmi_feedback(user_id, height,
+                                 latest.weight if latest else None)
+    progress = None
+    if goal is not None:
+        recent = [workout for workout in workouts
+                  if _on_or_after(workout.date, one_month_ago)]
+        progress = goal_progress(
+            goal,
+            latest_weight=latest.weight if latest else None,
+            latest_muscle_mass=latest.skeletal_muscle_mass if latest else None,
+            total_intensity=sum(INTENSITY_SCORES[workout.intensity]
+                                for workout in recent),
+            workout_count=len(recent))
+    dashboard.goal_progress = goal_progress_feedback(goal, progress)
+    return dashboard
+
+
+# SQLite compares dates with the datetime bounds the scenarios pass in as
+# ISO strings, so '2024-01-31' sorts before '2024-01-31 10:00:00'. These
+# helpers apply the same rule in Python so filtering the fetched rows agrees
+# with the scenario queries.
+def _as_sql_text(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    return str(value)
+
+
+def _on_or_after(day, bound):
+    return _as_sql_text(day) >= _as_sql_text(bound)
+
+
+def _between(day, start, end):
+    return _as_sql_text(start) <= _as_sql_text(day) <= _as_sql_text(end)
+
+
+# Scenario 14 over already fetched workouts
+def _summarize(workouts):
+    summary = {}
+    for workout in workouts:
+        entry = summary.setdefault(workout.type, {
+            "workout_type": workout.type, "sessions": 0,
+            "total_duration": 0})
+        entry["sessions"] += 1
+        entry["total_duration"] += workout.duration
+    return sorted(summary.values(), key=lambda entry: -entry["sessions"])
@@ -0,0 +1,171 @@
+# Streaming user export
+# Writes everything a user has logged, their profile and every row of the
+# per-user tables, as newline-delimited JSON, one object per row:
+#
+#     {"table": "workouts", "row": {"id": 17, "user_id": 42, ...}}
+#
+# Loading the User relationships would build an ORM object per row of the
+# whole history before writing the first line. Instead each table is read
+# straight from the DB-API cursor in keyset chunks of CHUNK_SIZE rows
+# ordered by its key (see EXPORTED_TABLES), every chunk on a connection of
+# its own, and written as it arrives: memory stays flat whatever the size of
+# the history, and a long export never holds a read transaction that would
+# keep SQLite from checkpointing the WAL. The values are SQLite's own, dates
+# and times as ISO text. Rows moved into partitions (see partitions.py) or
+# the cold store (see archive.py) are exported too, each table's archived
+# months first, then its partitions, oldest first, then the main file.
+#
+#     python3 export.py 42 --output user42.ndjson.gz
+import create
+from create import init_db
+from models import Base
+from partitions import PARTITIONED_TABLES, sources
+from archive import ARCHIVED_MODELS, archived_batches
+import argparse
+import gzip
+import json
+import sys
+import time
+
+# Per-user tables exported, with the key their rows are read in, a prefix
+# of the columns of the table's user_id index followed by the id, so every
+# chunk is a range of the index
+EXPORTED_TABLES = {
+    'workouts': ('date', 'id'),
+    'meals': ('date', 'id'),
+    'water_intake': ('date', 'id'),
+    'nutrition_logs': ('date', 'id'),
+    'medications': ('id',),
+    'sleep_logs': ('date', 'id'),
+    'health_metrics': ('date', 'time', 'id'),
+    'body_compositions': ('date', 'id'),
+    'goals': ('id',),
+}
+
+# Tables exported with the rows of an exported table they belong to: table
+# -> (foreign key column, exported table)
+EXPORT_CHILDREN = {'meal_food_items': ('meal_id', 'meals')}
+
+# Columns never exported
+PRIVATE_COLUMNS = {'users': {'password_hash'}}
+
+# Rows read per query
+CHUNK_SIZE = 5000
+
+
+class ExportError(RuntimeError):
+    pass
+
+
+def _columns(table):
+    return [name for name in Base.metadata.tables[table].columns.keys()
+            if name not in PRIVATE_COLUMNS.get(table, ())]
+
+
+# The rows of a user in one copy of a table, main or a partition's, in key
+# order, as (table, columns, rows) chunks, each followed by the rows of its
+# children
+def _keyset_chunks(engine, schema, table, user_id, chunk_size):
+    columns = _columns(table)
+    key = EXPORTED_TABLES[table]
+    positions = [columns.index(name) for name in key]
+    query = f'SELECT {", ".join(columns)} FROM {schema}.{table} ' \
+            f'WHERE user_id = ?'
+    order = f' ORDER BY {", ".join(key)} LIMIT ?'
+    after = ()
+    while True:
+        with engine.connect() as connection:
+            if after:
+                rows = connection.exec_driver_sql(
+                    f'{query} AND ({", ".join(key)}) > '
+                    f'({", ".join("?" * len(key))}){order}',
+                    (user_id, *after, chunk_size)).all()
+            else:
+                rows = connection.exec_driver_sql(
+                    query + order, (user_id, chunk_size)).all()
+            if not rows:
+                return
+            yield table, columns, rows
+            for child, (column, parent) in EXPORT_CHILDREN.items():
+                if parent == table:
+                    ids = [row[columns.index('id')] for row in rows]
+                    yield child, _columns(child), connection.exec_driver_sql(
+                        f'SELECT {", ".join(_columns(child))} '
+                        f'FROM {schema}.{child} WHERE {column} IN '
+                        f'({", ".join("?" * len(ids))}) ORDER BY {column}, id',
+                        tuple(ids)).all()
+        if len(rows) < chunk_size:
+            return
+        after = tuple(rows[-1][position] for position in positions)
+
+
+# Every row of a user as (table, columns, rows) chunks: the user's own row,
+# then each exported table, archived months, partitions and main file in
+# turn
+def user_chunks(user_id, chunk_size=CHUNK_SIZE):
+    with create.get_engine().connect() as connection:
+        columns = _columns('users')
+        user = connection.exec_driver_sql(
+            f'SELECT {", ".join(columns)} FROM main.users WHERE id = ?',
+            (user_id,)).all()
+    if not user:
+        raise ExportError(f"There is no user {user_id}.")
+    yield 'users', columns, user
+
+    engine = create.user_engine(user_id)
+    for table in EXPORTED_TABLES:
+        with engine.connect() as connection:
+            schemas = sources(connection) if table in PARTITIONED_TABLES \
+                else (None,)
+            if table in ARCHIVED_MODELS:
+                for batch in archived_batches(connection, table, [user_id]):
+                    for name, rows in batch.items():
+                        yield name, rows['columns'], rows['rows']
+        for schema in schemas:
+            yield from _keyset_chunks(engine, schema or 'main', table,
+                                      user_id, chunk_size)
+
+
+# Write a user's rows to a text stream as NDJSON, a chunk at a time.
+# Returns the rows written per table.
+def export_user(user_id, output, chunk_size=CHUNK_SIZE):
+    encode = json.JSONEncoder(separators=(',', ':')).encode
+    written = {}
+    for table, columns, rows in user_chunks(user_id, chunk_size):
+        output.writelines(
+            encode({'table': table, 'row': dict(zip(columns, row))}) + '\n'
+            for row in rows)
+        written[table] = written.get(table, 0) + len(rows)
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export a user's rows as newline-delimited JSON.")
+    parser.add_argument('user_id', type=int, help="user to export")
+    parser.add_argument('--output', default='-',
+                        help="file to write, gzip-compressed when it ends "
+                             "with .gz (default: standard output)")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help=f"rows read per query (default: {CHUNK_SIZE})")
+    args = parser.parse_args()
+    init_db()
+
+    if args.output == '-':
+        output = sys.stdout
+    elif args.output.endswith('.gz'):
+        output = gzip.open(args.output, 'wt', encoding='utf-8')
+    else:
+        output = open(args.output, 'w', encoding='utf-8')
+    started = time.perf_counter()
+    try:
+        written = export_user(args.user_id, output, args.chunk_size)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - started
+    rows = sum(written.values())
+    print(', '.join(f"{count} {table}" for table, count in written.items()),
+          file=sys.stderr)
+    print(f"Exported {rows} rows in {elapsed:.2f}s "
+          f"({rows / elapsed:,.0f} rows/s)", file=sys.stderr)
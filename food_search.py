@@ -0,0 +1,78 @@
+# Food catalog search
+# Type-ahead lookups of food items by name through the food_search FTS5
+# index (see create.create_food_search). Every word typed must match a word
+# of the name, the last one as a prefix while it is still being typed, so
+# "chick" finds "Grilled Chicken" and "grilled chi" narrows it down. Results
+# are ranked by bm25, best match first, and capped at MAX_RESULTS.
+#
+# Ranking costs about a microsecond per matching row, and the first letter
+# typed matches a good part of the catalog. Only the first MAX_CANDIDATES
+# matches, in id order, are ranked, which keeps every keystroke in the
+# milliseconds; from the second or third letter on, most queries match fewer
+# rows than that and are ranked in full.
+from create import init_db, read_session
+from models import FoodItem
+from sqlalchemy import Float, Integer, select, text
+import re
+
+# Results returned when the caller does not ask for a number
+DEFAULT_RESULTS = 10
+# Most results a search returns, whatever the caller asks for
+MAX_RESULTS = 50
+# Most matching rows ranked per search
+MAX_CANDIDATES = 2000
+
+# The characters the unicode61 tokenizer keeps in a token
+_WORD = re.compile(r'[^\W_]+')
+
+# The best of the first :candidates matches of an FTS5 query; ties go to the
+# lowest id
+_RANKED = text("""
+    SELECT rowid AS id, rank
+    FROM food_search
+    WHERE food_search MATCH :query AND rowid <= (
+        SELECT max(rowid) FROM (
+            SELECT rowid FROM food_search WHERE food_search MATCH :query
+            LIMIT :candidates))
+    ORDER BY rank, rowid
+    LIMIT :limit
+""").columns(id=Integer, rank=Float).subquery()
+
+
+# FTS5 query for what the user typed, or None when it has no words. Each
+# word is quoted so punctuation never reads as query syntax; the last one is
+# a prefix unless the text ends in a space.
+def match_query(typed):
+    words = _WORD.findall(typed)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    if not typed[-1].isspace():
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+
+# Food items whose names match what the user typed, best match first, at
+# most limit of them (capped at MAX_RESULTS). Reads through a short-lived
+# read session, or session if given.
+def search_food_items(typed, limit=DEFAULT_RESULTS, session=None):
+    query = match_query(typed)
+    if query is None:
+        return []
+    limit = max(1, min(limit, MAX_RESULTS))
+    with read_session(session) as session:
+        return session.scalars(
+            select(FoodItem).join(_RANKED, _RANKED.c.id == FoodItem.id)
+            .order_by(_RANKED.c.rank, _RANKED.c.id),
+            {'query': query, 'limit': limit,
+             'candidates': MAX_CANDIDATES}).all()
+
+
+# Usage example
+if __name__ == "__main__":
+    init_db()
+    with read_session() as session:
+        name = session.scalar(select(FoodItem.name).order_by(FoodItem.id))
+    # as the name is typed
+    for typed in (name[:1], name[:3], name):
+        print(typed, [item.name for item in search_food_items(typed)])
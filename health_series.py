@@ -0,0 +1,258 @@
+# Health metric time series
+# Loads HealthMetric readings straight from the cursor into NumPy arrays,
+# one array per column, instead of materializing an ORM object per reading.
+# Timestamps become datetime64[us] and NULL readings NaN, so years of
+# wearable data per user can be analyzed with the vectorized rolling
+# statistics and resting heart rate estimate below.
+import create
+from create import get_engine
+from models import HEALTH_METRIC_VITALS, HealthMetric
+from partitions import sources, entity
+from archive import archived_rows
+from shards import fan_out, ids_by_shard
+from sqlalchemy import select, union_all, type_coerce, String
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+import numpy as np
+
+# Rows fetched from the cursor per batch while streaming
+CHUNK_SIZE = 50000
+
+# SQLite caps the number of bound parameters in one statement (32766 since
+# 3.32), so explicit id lists are split into chunks of this size
+MAX_IDS_PER_QUERY = 30000
+
+# Reading columns loaded as float64 arrays
+METRIC_COLUMNS = HEALTH_METRIC_VITALS
+
+# Resting heart rate is estimated as this percentile of a day's readings,
+# which ignores the elevated readings taken during activity
+RESTING_HEART_RATE_PERCENTILE = 10
+
+
+# One user's readings in time order, one array per column
+@dataclass
+class HealthMetricSeries:
+    user_id: int
+    time: np.ndarray
+    heart_rate: np.ndarray
+    systolic_blood_pressure: np.ndarray
+    diastolic_blood_pressure: np.ndarray
+    blood_oxygen_level: np.ndarray
+    blood_glucose_level: np.ndarray
+    body_temperature: np.ndarray
+
+    def __len__(self):
+        return len(self.time)
+
+
+# Empty arrays for a user without readings
+def _empty_series(user_id):
+    columns = {name: np.empty(0) for name in METRIC_COLUMNS}
+    return HealthMetricSeries(user_id, np.empty(0, dtype='datetime64[us]'),
+                              **columns)
+
+
+# SELECT of the raw reading columns in time order per user, from the given
+# sources of the readings (see partitions.sources), of the given users or
+# every user if None. The timestamp, the reading's date plus the time of
+# day, is read as ISO text so NumPy parses it in bulk instead of the driver
+# building a datetime per row.
+def _series_select(schemas, start_date, end_date, user_ids=None):
+    selects = []
+    for schema in schemas:
+        reading = entity(HealthMetric, schema)
+        taken_at = type_coerce(reading.date, String) + ' ' \
+            + reading.time_of_day
+        query = select(
+            reading.user_id,
+            taken_at.label('taken_at'),
+            *[getattr(reading, name) for name in METRIC_COLUMNS]
+        ).order_by(reading.user_id, reading.date, reading.time_of_day)
+        if start_date is not None:
+            query = query.where(reading.date >= start_date)
+        if end_date is not None:
+            query = query.where(reading.date <= end_date)
+        if user_ids is not None:
+            query = query.where(reading.user_id.in_(user_ids))
+        selects.append(query)
+    if len(selects) == 1:
+        return selects[0]
+    # SQLite merges the sorted sources
+    readings = union_all(*[query.order_by(None) for query in selects])
+    return readings.order_by(readings.selected_columns.user_id,
+                             readings.selected_columns.taken_at)
+
+
+# Stream the rows of a query into one list of array chunks per column
+def _fetch_columns(connection, query, columns, chunk_size):
+    result = connection.execute(
+        query.execution_options(yield_per=chunk_size))
+    for rows in result.partitions():
+        user_ids, times, *values = zip(*rows)
+        columns[0].append(np.array(user_ids, dtype=np.int64))
+        columns[1].append(np.array(times, dtype='datetime64[us]'))
+        for chunks, column in zip(columns[2:], values):
+            # None becomes NaN
+            chunks.append(np.array(column, dtype=np.float64))
+
+
+# Append the readings of archived months (see archive.py) of the given
+# users, or every user if None, to the lists of array chunks per column;
+# returns whether there were any
+def _fetch_archived(connection, user_ids, start_date, end_date, columns):
+    readings = archived_rows(connection, HealthMetric, user_ids, start_date,
+                             end_date)
+    if not readings:
+        return False
+    columns[0].append(np.array([reading.user_id for reading in readings],
+                               dtype=np.int64))
+    columns[1].append(np.array(
+        [datetime.combine(reading.date, reading.time_of_day)
+         for reading in readings], dtype='datetime64[us]'))
+    for chunks, name in zip(columns[2:], METRIC_COLUMNS):
+        chunks.append(np.array([getattr(reading, name)
+                                for reading in readings], dtype=np.float64))
+    return True
+
+
+# Load the readings of the given users (every user if None) between two
+# dates into a dict of HealthMetricSeries keyed by user id. Users without
+# readings get empty arrays. Without a bind, a sharded database is read on
+# every shard at once.
+def load_health_metrics(user_ids=None, start_date=None, end_date=None,
+                        bind=None, chunk_size=CHUNK_SIZE):
+    main_engine = bind or get_engine()
+    if bind is None and create.shard_engines:
+        grouped = None if user_ids is None else ids_by_shard(user_ids)
+        series = {}
+        for shard_series in fan_out(
+                lambda index, shard_engine: load_health_metrics(
+                    None if grouped is None else grouped[index],
+                    start_date, end_date, shard_engine, chunk_size)):
+            series.update(shard_series)
+        return series
+    bind = main_engine
+    columns = [[] for _ in range(len(METRIC_COLUMNS) + 2)]
+    with bind.connect() as connection:
+        schemas = sources(connection, start_date, end_date)
+        if user_ids is None:
+            _fetch_columns(
+                connection, _series_select(schemas, start_date, end_date),
+                columns, chunk_size)
+            archived = _fetch_archived(connection, None, start_date,
+                                       end_date, columns)
+        else:
+            archived = False
+            user_ids = sorted(set(user_ids))
+            # each source of a union takes its own copy of the ids
+            ids_per_query = MAX_IDS_PER_QUERY // len(schemas)
+            for start in range(0, len(user_ids), ids_per_query):
+                chunk = user_ids[start:start + ids_per_query]
+                _fetch_columns(
+                    connection,
+                    _series_select(schemas, start_date, end_date, chunk),
+                    columns, chunk_size)
+                archived |= _fetch_archived(connection, chunk, start_date,
+                                            end_date, columns)
+
+    series = {user_id: _empty_series(user_id) for user_id in user_ids or []}
+    if not columns[0]:
+        return series
+    user_column, *arrays = [np.concatenate(chunks) for chunks in columns]
+    if archived:
+        # the archived readings come after the hot ones
+        order = np.lexsort((arrays[0], user_column))
+        user_column, *arrays = [array[order]
+                                for array in (user_column, *arrays)]
+    # rows arrive grouped by user, so each user's readings are one slice
+    users, starts = np.unique(user_column, return_index=True)
+    ends = np.append(starts[1:], len(user_column))
+    for user_id, start, end in zip(users.tolist(), starts, ends):
+        series[user_id] = HealthMetricSeries(
+            user_id, *[array[start:end] for array in arrays])
+    return series
+
+
+# Load one user's readings between two dates, from their shard when the
+# database is sharded
+def load_user_health_metrics(user_id, start_date=None, end_date=None,
+                             bind=None):
+    if bind is None:
+        get_engine()
+        bind = create.user_engine(user_id)
+    return load_health_metrics([user_id], start_date, end_date, bind)[user_id]
+
+
+# Index of the first reading inside each reading's trailing window
+# (time - window, time]
+def _window_starts(time, window):
+    if isinstance(window, timedelta):
+        window = np.timedelta64(window)
+    return np.searchsorted(time, time - window, side='right')
+
+
+# Mean of the non-NaN values in each reading's trailing time window
+def rolling_mean(time, values, window):
+    valid = ~np.isnan(values)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+    counts = np.concatenate(([0], np.cumsum(valid)))
+    starts = _window_starts(time, window)
+    ends = np.arange(1, len(values) + 1)
+    window_counts = counts[ends] - counts[starts]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (sums[ends] - sums[starts]) / window_counts
+    means[window_counts == 0] = np.nan
+    return means
+
+
+# Minimum or maximum over each reading's trailing time window. Windows of
+# any length are answered from power-of-two blocks: level k holds the
+# extreme of the 2**k values starting at each index, and a window of length
+# n is covered by two overlapping blocks of the largest 2**k <= n. Only one
+# level is kept at a time.
+def _rolling_extreme(time, values, window, reduce, fill):
+    block = np.where(np.isnan(values), fill, values)
+    result = np.full(len(values), fill)
+    if len(values) == 0:
+        return result
+    starts = _window_starts(time, window)
+    ends = np.arange(len(values))
+    levels = np.floor(np.log2(ends - starts + 1)).astype(np.int64)
+    span = 1
+    for level in range(levels.max() + 1):
+        if level:
+            block = reduce(block[:-span], block[span:])
+            span *= 2
+        selected = np.flatnonzero(levels == level)
+        result[selected] = reduce(block[starts[selected]],
+                                  block[ends[selected] - span + 1])
+    # windows with no readings
+    result[result == fill] = np.nan
+    return result
+
+
+# Minimum of the non-NaN values in each reading's trailing time window
+def rolling_min(time, values, window):
+    return _rolling_extreme(time, values, window, np.minimum, np.inf)
+
+
+# Maximum of the non-NaN values in each reading's trailing time window
+def rolling_max(time, values, window):
+    return _rolling_extreme(time, values, window, np.maximum, -np.inf)
+
+
+# Resting heart rate per day, estimated as a low percentile of the day's
+# heart rate readings. Returns the days (datetime64[D]) with readings and
+# their estimates.
+def resting_heart_rate(series, percentile=RESTING_HEART_RATE_PERCENTILE):
+    valid = ~np.isnan(series.heart_rate)
+    days = series.time[valid].astype('datetime64[D]')
+    heart_rates = series.heart_rate[valid]
+    order = np.lexsort((heart_rates, days))
+    days, heart_rates = days[order], heart_rates[order]
+    unique_days, starts, counts = np.unique(days, return_index=True,
+                                            return_counts=True)
+    # lower percentile rank within each day's sorted readings
+    ranks = np.floor(percentile / 100 * (counts - 1)).astype(np.int64)
+    return unique_days, heart_rates[starts + ranks]
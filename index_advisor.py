@@ -0,0 +1,413 @@
+# Index advisor
+# Runs every query_data scenario against the database, reads the
+# EXPLAIN QUERY PLAN of each statement it issues and reports the steps that
+# do more work than an index lookup: full table or index scans, index
+# lookups that still read the table row, automatic indexes and temporary
+# B-trees built to sort or group. For each one it proposes a composite
+# index (the equality columns, then the ORDER BY, GROUP BY or range
+# columns) made covering when the statement only needs a few more columns
+# of the table. Proposals an existing index already satisfies are left out.
+#
+# Accepted proposals go into the models as Index(...) entries, with a
+# migration creating them on existing databases (see create.MIGRATIONS).
+#
+#   python3 index_advisor.py            report the scenarios with issues
+#   python3 index_advisor.py --all      also print the clean plans
+#   python3 index_advisor.py --check    exit with 1 if there are proposals
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import event, inspect, select, Integer
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import (
+    BinaryExpression, ColumnClause, Label, UnaryExpression
+)
+from sqlalchemy.sql.selectable import Select
+from sqlalchemy.schema import Table
+import argparse
+import re
+import sys
+
+from create import init_db, read_session
+from models import User
+import query_data
+
+# Scenario name -> function and the arguments of one call for a user, given
+# the start and end of a date range
+SCENARIOS = {
+    'get_workouts_by_user_and_date': (
+        query_data.get_workouts_by_user_and_date,
+        lambda user_id, start, end: (user_id, start, end)),
+    'average_daily_calories': (
+        query_data.average_daily_calories,
+        lambda user_id, start, end: (user_id, start, end)),
+    'average_sleep_duration_last_month': (
+        query_data.average_sleep_duration_last_month,
+        lambda user_id, start, end: (user_id,)),
+    'weight_change_past_year': (
+        query_data.weight_change_past_year,
+        lambda user_id, start, end: (user_id,)),
+    'last_recorded_health_metrics': (
+        query_data.last_recorded_health_metrics,
+        lambda user_id, start, end: (user_id,)),
+    'recommend_water_intake': (
+        query_data.recommend_water_intake,
+        lambda user_id, start, end: (user_id,)),
+    'suggest_calories_intake': (
+        query_data.suggest_calories_intake,
+        lambda user_id, start, end: (user_id,)),
+    'assess_fitness_level': (
+        query_data.assess_fitness_level,
+        lambda user_id, start, end: (user_id,)),
+    'sleep_duration_tips': (
+        query_data.sleep_duration_tips,
+        lambda user_id, start, end: (user_id,)),
+    'sleep_consistency_tips': (
+        query_data.sleep_consistency_tips,
+        lambda user_id, start, end: (user_id,)),
+    'dietary_diversity_tips': (
+        query_data.dietary_diversity_tips,
+        lambda user_id, start, end: (user_id,)),
+    'track_goal_progress': (
+        query_data.track_goal_progress,
+        lambda user_id, start, end: (user_id,)),
+    'calculate_user_bmi': (
+        query_data.calculate_user_bmi,
+        lambda user_id, start, end: (user_id,)),
+    'summarize_frequent_workouts': (
+        query_data.summarize_frequent_workouts,
+        lambda user_id, start, end: (user_id, start, end)),
+    'nutrient_intake_report': (
+        query_data.nutrient_intake_report,
+        lambda user_id, start, end: (user_id, start, end)),
+}
+
+# Most columns added to an index key to make it covering; statements that
+# need more read the table row
+MAX_COVERING_COLUMNS = 3
+
+# A plan step reading a table: "SCAN workouts",
+# "SEARCH goals USING INDEX idx_user_id_deadline_g (user_id=?)". The name is
+# the table's alias when the query gives it one.
+_TABLE_STEP = re.compile(
+    r'^(SCAN|SEARCH) (\S+)(?: USING (.*?))?(?: \(.*\))?$')
+# Plan steps producing the rows of a subquery, which SCAN steps then read
+# without touching a table
+_SUBQUERY_STEP = re.compile(r'^(?:CO-ROUTINE|MATERIALIZE) (\S+)')
+_TEMP_B_TREE = re.compile(r'^USE TEMP B-TREE FOR (.*)$')
+
+_EQUALITY = {operators.eq, operators.in_op}
+_RANGE = {operators.gt, operators.ge, operators.lt, operators.le,
+          operators.between_op}
+
+
+# Collect the distinct statements an engine executes inside the block, with
+# the parameters and compiled form of their first execution
+@contextmanager
+def capture_statements(engine):
+    statements = {}
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement not in statements:
+            statements[statement] = (parameters, context.compiled)
+
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+
+
+# EXPLAIN QUERY PLAN of a statement as (depth, detail) steps
+def query_plan(engine, statement, parameters):
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql(
+            f'EXPLAIN QUERY PLAN {statement}', parameters).all()
+    depth = {0: -1}
+    steps = []
+    for step_id, parent, _, detail in rows:
+        depth[step_id] = depth.get(parent, -1) + 1
+        steps.append((depth[step_id], detail))
+    return steps
+
+
+def format_plan(plan):
+    return ['  ' * depth + detail for depth, detail in plan]
+
+
+# Tables (or aliases) a plan reads in full, by table or by index
+def full_scans(plan):
+    subqueries, scans = set(), []
+    for _, detail in plan:
+        subquery = _SUBQUERY_STEP.match(detail)
+        if subquery:
+            subqueries.add(subquery.group(1))
+        step = _TABLE_STEP.match(detail)
+        if step and step.group(1) == 'SCAN' \
+                and step.group(2) not in subqueries \
+                and 'CONSTANT ROW' not in detail:
+            scans.append(step.group(2))
+    return scans
+
+
+# How a statement uses one table: the columns it compares with a value or
+# a join column, the columns it compares with a range, sorts or groups by,
+# and every column it reads
+class TableUsage:
+    def __init__(self, table):
+        self.table = table
+        self.equality = []
+        self.range = []
+        self.order_by = []
+        self.group_by = []
+        self.columns = set()
+
+    @staticmethod
+    def add(columns, name):
+        if name not in columns:
+            columns.append(name)
+
+
+def _table_column(element):
+    if isinstance(element, Label):
+        element = element.element
+    if isinstance(element, UnaryExpression):
+        element = element.element
+    if isinstance(element, ColumnClause) \
+            and getattr(element, 'table', None) is not None:
+        return element
+    return None
+
+
+def _base_table(selectable):
+    while not isinstance(selectable, Table):
+        selectable = getattr(selectable, 'element', None)
+        if selectable is None:
+            return None
+    return selectable
+
+
+# TableUsage of every table a compiled SELECT reads, keyed by the name the
+# query plan uses for it (its alias, if it has one)
+def table_usage(compiled):
+    statement = getattr(getattr(compiled, 'compile_state', None),
+                        'statement', None)
+    if not isinstance(statement, Select):
+        return {}
+    usage = {}
+
+    def use(column):
+        table = _base_table(column.table)
+        if table is None:
+            return None
+        entry = usage.setdefault(column.table.name, TableUsage(table))
+        entry.columns.add(column.name)
+        return entry
+
+    for element in visitors.iterate(statement):
+        column = _table_column(element)
+        if column is not None:
+            use(column)
+        elif isinstance(element, BinaryExpression):
+            for column in (_table_column(element.left),
+                           _table_column(element.right)):
+                if column is None:
+                    continue
+                entry = use(column)
+                if entry is None:
+                    continue
+                if element.operator in _EQUALITY:
+                    TableUsage.add(entry.equality, column.name)
+                elif element.operator in _RANGE:
+                    TableUsage.add(entry.range, column.name)
+        if isinstance(element, Select):
+            for clauses, attribute in (
+                    (element._order_by_clauses, 'order_by'),
+                    (element._group_by_clauses, 'group_by')):
+                columns = [_table_column(clause) for clause in clauses]
+                # only an index on a single table can provide the order
+                if columns and all(column is not None for column in columns) \
+                        and len({column.table.name
+                                 for column in columns}) == 1:
+                    entry = use(columns[0])
+                    if entry is not None:
+                        for column in columns:
+                            TableUsage.add(getattr(entry, attribute),
+                                           column.name)
+    return usage
+
+
+# Column lists of the indexes of a table in the database
+def existing_indexes(engine, table):
+    inspector = inspect(engine)
+    return [index['column_names']
+            for index in inspector.get_indexes(table.name)]
+
+
+# Key and extra covering columns of an index serving a table's usage, or
+# None if no index would help or an existing one already does. The key holds
+# the equality columns, then the range column, or the ORDER BY or GROUP BY
+# columns when the only range is on those.
+def propose_columns(usage, indexes):
+    table = usage.table
+    primary_key = {column.name for column in table.primary_key}
+    # a rowid lookup is already as cheap as it gets
+    if set(usage.equality) & primary_key:
+        return None
+    key = list(usage.equality)
+    ordering = usage.order_by or usage.group_by
+    ranges = [column for column in usage.range if column not in key]
+    if ordering and all(column in ordering for column in ranges):
+        for column in ordering:
+            TableUsage.add(key, column)
+    elif ranges:
+        key.append(ranges[0])
+    if not key:
+        return None
+
+    extra = sorted(usage.columns - set(key) - primary_key)
+    every_column = {column.name for column in table.columns} - primary_key
+    # statements loading whole rows are better served by the table
+    if len(extra) > MAX_COVERING_COLUMNS \
+            or usage.columns - primary_key == every_column:
+        extra = []
+
+    # SQLite ends every index entry with the rowid, which an INTEGER
+    # PRIMARY KEY column is
+    rowid = [column.name for column in table.primary_key]
+    if len(rowid) != 1 or not isinstance(
+            table.columns[rowid[0]].type, Integer):
+        rowid = []
+    for index in indexes:
+        covered = index + [name for name in rowid if name not in index]
+        if covered[:len(key)] == key and set(extra) <= set(covered):
+            return None
+    return key, extra
+
+
+def index_name(table, columns):
+    initials = ''.join(word[0] for word in table.name.split('_'))
+    return f"idx_{'_'.join(columns)}_{initials}"
+
+
+# Issues of one statement's plan, and the (key, extra columns) proposed for
+# the tables involved
+def advise(engine, statement, parameters, compiled, indexes_of):
+    plan = query_plan(engine, statement, parameters)
+    usage = table_usage(compiled)
+    issues, proposals = [], {}
+
+    def propose(name):
+        entry = usage.get(name)
+        proposal = entry and propose_columns(entry, indexes_of(entry.table))
+        if proposal:
+            proposals[name] = (entry.table, *proposal)
+        return proposal
+
+    scanned = set(full_scans(plan))
+    for _, detail in plan:
+        step = _TABLE_STEP.match(detail)
+        temp_b_tree = _TEMP_B_TREE.match(detail)
+        if step:
+            kind, name, using = step.groups()
+            using = using or ''
+            if name in scanned:
+                issues.append(f"full scan of {name}" if not using
+                              else f"full index scan of {name}")
+                propose(name)
+            elif using.startswith('AUTOMATIC'):
+                issues.append(f"automatic index on {name}")
+                propose(name)
+            elif kind == 'SEARCH' and using.startswith('INDEX'):
+                if propose(name):
+                    issues.append(f"table lookups on {name}")
+        elif temp_b_tree:
+            issues.append(f"temporary B-tree for {temp_b_tree.group(1)}")
+            for name, entry in usage.items():
+                if entry.order_by or entry.group_by:
+                    propose(name)
+    return plan, issues, list(proposals.values())
+
+
+# Fold each proposal into another on the same table whose key starts with
+# its key, so one index serves both
+def merge_proposals(proposals):
+    merged = {}
+    for (table_name, key), proposal in sorted(
+            proposals.items(), key=lambda item: -len(item[0][1])):
+        for (other_table, other_key), (_, columns, scenarios) in \
+                merged.items():
+            if other_table == table_name and other_key[:len(key)] == key:
+                columns.update(set(proposal[1]) - set(other_key))
+                scenarios.update(proposal[2])
+                break
+        else:
+            merged[(table_name, key)] = proposal
+    return merged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Propose indexes for the query scenarios.")
+    parser.add_argument('--user', type=int,
+                        help="user the scenarios run for (default: the "
+                             "first user)")
+    parser.add_argument('--all', action='store_true',
+                        help="also print the plans without issues")
+    parser.add_argument('--check', action='store_true',
+                        help="exit with status 1 if any index is proposed")
+    args = parser.parse_args(argv)
+
+    engine = init_db()
+    with read_session() as session:
+        user_id = args.user or session.scalar(select(User.id).order_by(
+            User.id).limit(1))
+    end = datetime.now()
+    start = end - timedelta(days=365)
+    cache = {}
+
+    def indexes_of(table):
+        if table.name not in cache:
+            cache[table.name] = existing_indexes(engine, table)
+        return cache[table.name]
+
+    # (table name, key) -> table, extra columns, scenarios
+    proposals = {}
+    for name, (function, call) in SCENARIOS.items():
+        with capture_statements(engine) as statements:
+            function(*call(user_id, start, end))
+        for statement, (parameters, compiled) in statements.items():
+            plan, issues, proposed = advise(engine, statement, parameters,
+                                            compiled, indexes_of)
+            # proposals with the same key become one index covering the
+            # columns of all of them
+            for table, key, extra in proposed:
+                _, columns, scenarios = proposals.setdefault(
+                    (table.name, tuple(key)), (table, set(), set()))
+                columns.update(extra)
+                scenarios.add(name)
+            if issues or args.all:
+                print(f"{name}: {' '.join(statement.split())}")
+                for line in format_plan(plan):
+                    print(f"    {line}")
+                for issue in issues:
+                    print(f"  ! {issue}")
+                print()
+
+    proposals = merge_proposals(proposals)
+    if not proposals:
+        print("No indexes to propose.")
+        return 0
+    print("Proposed indexes:")
+    for (table_name, key), (table, extra, scenarios) in proposals.items():
+        columns = list(key) + sorted(extra)
+        name = index_name(table, columns)
+        quoted = ', '.join(f"'{column}'" for column in columns)
+        print(f"  {table_name}: Index('{name}', {quoted})")
+        print(f"    CREATE INDEX {name} ON {table_name} "
+              f"({', '.join(columns)});")
+        print(f"    for {', '.join(sorted(scenarios))}")
+    return 1 if args.check else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
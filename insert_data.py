@@ -1,72 +1,186 @@
-from create import (
-    Base, engine, Session,
+import create
+from create import Session, init_db, TUNING_PROFILES
+from rollups import rebuild_rollups
+import shards
+from models import (
     User, Workout, FoodItem, Vitamin, Mineral,
     FoodItemVitamin, FoodItemMineral, Meal, MealFoodItem,
     WaterIntake, NutritionLog, Medication, SleepLog,
     HealthMetric, BodyComposition, Goal, GoalStatusEnum, GoalTypesEnum
 )
+from sqlalchemy import insert, select, func
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
 from contextlib import contextmanager
-from faker import Faker
-from datetime import timedelta
+from datetime import date, datetime, time, timedelta
+from itertools import islice, repeat
+import argparse
+import os
 import random
-import bcrypt
+import time as timer
+
+
+# Faker and bcrypt are slow to import and only needed once rows are
+# generated, so both are imported on first use
+class LazyFaker:
+    def __init__(self):
+        self._faker = None
+
+    def __getattr__(self, name):
+        if self._faker is None:
+            from faker import Faker
+            self._faker = Faker()
+        return getattr(self._faker, name)
 
-# Initialize Faker instance
-fake = Faker()
 
-# Connect to the database and create a session
-Base.metadata.create_all(engine)
-session = Session()
+# Initialize Faker instance
+fake = LazyFaker()
+
+# Default number of rows generated per table. These are the sizes of the
+# example dataset; the bulk loader scales them to build load-test databases.
+DEFAULT_SCALE = {
+    'users': 50,
+    'food_items': 100,
+    'vitamins': 10,
+    'minerals': 10,
+    'meals': 200,
+    'water_intakes': 200,
+    'nutrition_logs': 200,
+    'medications': 50,
+    'workouts': 200,
+    'sleep_logs': 200,
+    'health_metrics': 500,
+    'body_compositions': 200,
+    'goals': 100,
+}
+
+# Catalog tables keep their size when the dataset is scaled up
+CATALOG_TABLES = ('vitamins', 'minerals')
+
+# Rows per executemany batch in the bulk loader
+BULK_CHUNK_SIZE = 10000
+
+# Users per generation shard in the parallel loader. Shards are the unit of
+# seeding, so the generated dataset depends on the seed and the shard size
+# but not on how many worker processes share the work.
+SHARD_SIZE = 1000
+
+# Day that generated dates are relative to; None means today. The parallel
+# loader pins it so a seed reproduces the same dates on any day.
+anchor_date = None
+
+
+# Users whose passwords are hashed together; each batch is one pool.map
+HASH_BATCH_SIZE = 1000
 
 
 # Helper function to hash passwords
-def hash_password(password):
-    return bcrypt.hashpw(password.encode('utf-8'),
-                         bcrypt.gensalt()).decode('utf-8')
+# rounds=None keeps bcrypt's default cost, the one User.set_password uses.
+# Seeding may pass a lower cost for test data (bcrypt's minimum is 4).
+def hash_password(password, rounds=None):
+    import bcrypt
+    salt = bcrypt.gensalt() if rounds is None else bcrypt.gensalt(rounds)
+    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
 
 
-# Function to create fake users
-def create_users(num_users=50):
-    users = []
-    for _ in range(num_users):
-        password = fake.password()
-        hashed_password = hash_password(password)
-        user = User(
-            username=fake.user_name(),
-            email=fake.email(),
-            password_hash=hashed_password,
-            name=fake.name(),
-            age=random.randint(18, 80),
-            gender=random.choice(['Male', 'Female', 'Other']),
-            initial_weight=random.uniform(50, 100),
-            height=random.uniform(150, 200)
-        )
-        users.append(user)
-    return users
+# Hash a list of passwords, in a process pool when executor is given
+def hash_passwords(passwords, rounds=None, executor=None):
+    if executor is None:
+        return [hash_password(password, rounds) for password in passwords]
+    chunksize = max(1, len(passwords) // (4 * (os.cpu_count() or 1)))
+    return list(executor.map(hash_password, passwords, repeat(rounds),
+                             chunksize=chunksize))
 
 
-# Function to create fake workouts
-def create_workouts(users, num_workouts=200):
-    workouts = []
+# Precompute a pool of hashes that generated users reuse round-robin.
+# Generated passwords then no longer match their hashes, which is fine for
+# load-test data that nobody logs in with.
+def precompute_hash_pool(size, rounds=None, workers=1):
+    passwords = [fake.password() for _ in range(size)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return hash_passwords(passwords, rounds, executor)
+    return hash_passwords(passwords, rounds)
+
+
+# Helpers to draw random dates and times. They are much cheaper than
+# fake.date_between, which re-parses its '-1y' arguments on every call.
+def today():
+    return anchor_date or date.today()
+
+
+def past_date(days=365):
+    return today() - timedelta(days=random.randint(0, days))
+
+
+def future_date(days=365):
+    return today() + timedelta(days=random.randint(0, days))
+
+
+def time_on(day, earliest_hour=0, latest_hour=23):
+    return datetime.combine(day, time(random.randint(earliest_hour,
+                                                     latest_hour),
+                                      random.randint(0, 59),
+                                      random.randint(0, 59)))
+
+
+# Row generators
+# Each yields plain dicts keyed by column name. The create_* functions below
+# wrap them in ORM objects, and the bulk loader passes them straight to Core
+# insert() statements.
+
+# Passwords are hashed a batch at a time: taken round-robin from hash_pool
+# if one is given, otherwise with bcrypt at the given cost, spread over
+# hash_workers processes.
+def user_rows(num_users=50, start=0, rounds=None, hash_pool=None,
+              hash_workers=1):
+    executor = None
+    if hash_pool is None and hash_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=hash_workers)
+    try:
+        for batch_start in range(start, start + num_users, HASH_BATCH_SIZE):
+            batch_end = min(batch_start + HASH_BATCH_SIZE, start + num_users)
+            rows, passwords = [], []
+            for index in range(batch_start, batch_end):
+                # the running index keeps usernames and emails unique
+                passwords.append(fake.password())
+                rows.append(dict(
+                    username=f'{fake.user_name()}{index}',
+                    email=f'{index}.{fake.email()}',
+                    name=fake.name(),
+                    age=random.randint(18, 80),
+                    gender=random.choice(['Male', 'Female', 'Other']),
+                    initial_weight=random.uniform(50, 100),
+                    height=random.uniform(150, 200)
+                ))
+            if hash_pool:
+                hashes = [hash_pool[index % len(hash_pool)]
+                          for index in range(batch_start, batch_end)]
+            else:
+                hashes = hash_passwords(passwords, rounds, executor)
+            for row, password_hash in zip(rows, hashes):
+                row['password_hash'] = password_hash
+                yield row
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def workout_rows(user_ids, num_workouts=200):
     for _ in range(num_workouts):
-        user = random.choice(users)
-        workout = Workout(
-            user_id=user.id,
-            date=fake.date_between(start_date='-1y', end_date='today'),
+        yield dict(
+            user_id=random.choice(user_ids),
+            date=past_date(),
             type=random.choice(['Running', 'Cycling', 'Swimming', 'Gym']),
             duration=random.uniform(0.5, 2),
             intensity=random.choice(['Low', 'Medium', 'High']),
             calories_burned=random.randint(100, 1000)
         )
-        workouts.append(workout)
-    return workouts
 
 
-# Function to create fake food items
-def create_food_items(num_items=100):
-    food_items = []
+def food_item_rows(num_items=100):
     for _ in range(num_items):
-        food_item = FoodItem(
+        yield dict(
             name=fake.word().capitalize(),
             calories=random.randint(100, 500),
             proteins=random.uniform(0, 30),
@@ -74,149 +188,96 @@ def create_food_items(num_items=100):
             fats=random.uniform(0, 50),
             fiber=random.uniform(0, 10)
         )
-        food_items.append(food_item)
-    return food_items
 
 
-# Function to create fake vitamins
-def create_vitamins(num_vitamins=10):
-    vitamins = []
+def vitamin_rows(num_vitamins=10):
     for _ in range(num_vitamins):
-        vitamin = Vitamin(
-            name=f'Vitamin {fake.word().capitalize()}'
-        )
-        vitamins.append(vitamin)
-    return vitamins
+        yield dict(name=f'Vitamin {fake.word().capitalize()}')
 
 
-# Function to create fake minerals
-def create_minerals(num_minerals=10):
-    minerals = []
+def mineral_rows(num_minerals=10):
     for _ in range(num_minerals):
-        mineral = Mineral(
-            name=f'Mineral {fake.word().capitalize()}'
-        )
-        minerals.append(mineral)
-    return minerals
+        yield dict(name=f'Mineral {fake.word().capitalize()}')
 
 
-# Function to create fake food items vitamins
-def create_food_item_vitamins(food_items, vitamins):
-    food_item_vitamins = []
-    for food_item in food_items:
+def food_item_vitamin_rows(food_item_ids, vitamin_ids):
+    for food_item_id in food_item_ids:
         for _ in range(random.randint(1, 3)):  # Each item has 1-3 vitamins
-            vitamin = random.choice(vitamins)
-            food_item_vitamin = FoodItemVitamin(
-                food_item_id=food_item.id,
-                vitamin_id=vitamin.id,
+            yield dict(
+                food_item_id=food_item_id,
+                vitamin_id=random.choice(vitamin_ids),
                 amount=random.uniform(0.1, 100.0)  # Random amount of vitamin
             )
-            food_item_vitamins.append(food_item_vitamin)
-    return food_item_vitamins
 
 
-# Function to create fake food item minerals
-def create_food_item_minerals(food_items, minerals):
-    food_item_minerals = []
-    for food_item in food_items:
+def food_item_mineral_rows(food_item_ids, mineral_ids):
+    for food_item_id in food_item_ids:
         for _ in range(random.randint(1, 3)):  # Each item has 1-3 minerals
-            mineral = random.choice(minerals)
-            food_item_mineral = FoodItemMineral(
-                food_item_id=food_item.id,
-                mineral_id=mineral.id,
+            yield dict(
+                food_item_id=food_item_id,
+                mineral_id=random.choice(mineral_ids),
                 amount=random.uniform(0.1, 100.0)  # Random amount of mineral
             )
-            food_item_minerals.append(food_item_mineral)
-    return food_item_minerals
 
 
-# Function to create fake meals
-def create_meals(users, num_meals=200):
-    meals = []
+def meal_rows(user_ids, num_meals=200):
     for _ in range(num_meals):
-        user = random.choice(users)
-        meal = Meal(
-            user_id=user.id,
-            date=fake.date_between(start_date='-1y', end_date='today'),
+        meal_date = past_date()
+        yield dict(
+            user_id=random.choice(user_ids),
+            date=meal_date,
             meal_type=random.choice(['Breakfast', 'Lunch', 'Dinner', 'Snack']),
-            eating_time=fake.date_time()
+            eating_time=time_on(meal_date, 6, 22)
         )
-        meals.append(meal)
-    return meals
 
 
-# Function to create fake meal food items
-def create_meal_food_items(meals, food_items):
-    meal_food_items = []
-    for meal in meals:
+def meal_food_item_rows(meal_ids, food_item_ids):
+    for meal_id in meal_ids:
         for _ in range(random.randint(1, 5)):  # Each meal has 1-5 food items
-            food_item = random.choice(food_items)
-            meal_food_item = MealFoodItem(
-                meal_id=meal.id,
-                food_item_id=food_item.id,
+            yield dict(
+                meal_id=meal_id,
+                food_item_id=random.choice(food_item_ids),
                 servings_consumed=random.randint(1, 3)  # 1-3 servings per item
             )
-            meal_food_items.append(meal_food_item)
-    return meal_food_items
 
 
-# Function to create fake water intakes
-def create_water_intakes(users, num_intakes=200):
-    water_intakes = []
+def water_intake_rows(user_ids, num_intakes=200):
     for _ in range(num_intakes):
-        user = random.choice(users)
-        water_intake = WaterIntake(
-            user_id=user.id,
-            date=fake.date_between(start_date='-1y', end_date='today'),
+        yield dict(
+            user_id=random.choice(user_ids),
+            date=past_date(),
             amount=random.uniform(0.5, 5)  # Liters
         )
-        water_intakes.append(water_intake)
-    return water_intakes
 
 
-# Function to create fake nutrition logs
-def create_nutrition_logs(users, num_logs=200):
-    nutrition_logs = []
+def nutrition_log_rows(user_ids, num_logs=200):
     for _ in range(num_logs):
-        user = random.choice(users)
-        nutrition_log = NutritionLog(
-            user_id=user.id,
-            date=fake.date_between(start_date='-1y', end_date='today'),
+        yield dict(
+            user_id=random.choice(user_ids),
+            date=past_date(),
             summary=fake.text(max_nb_chars=500)
         )
-        nutrition_logs.append(nutrition_log)
-    return nutrition_logs
 
 
-# Function to create fake medications
-def create_medications(users, num_medications=50):
-    medications = []
+def medication_rows(user_ids, num_medications=50):
     for _ in range(num_medications):
-        user = random.choice(users)
-        medication = Medication(
-            user_id=user.id,
+        yield dict(
+            user_id=random.choice(user_ids),
             name=fake.word().capitalize(),
             dosage=f'{random.randint(1, 500)} mg',
             frequency=f'{random.randint(1, 4)} times a day',
-            start_date=fake.date_between(start_date='-1y', end_date='today'),
-            end_date=fake.date_between(
-                start_date='today', end_date='+1y') if random.choice(
-                    [True, False]) else None,
+            start_date=past_date(),
+            end_date=future_date() if random.choice([True, False]) else None,
             reason=fake.sentence()
         )
-        medications.append(medication)
-    return medications
 
 
-# Function to create fake sleep logs
-def create_sleep_logs(users, num_logs=200):
-    sleep_logs = []
+def sleep_log_rows(user_ids, num_logs=200):
     for _ in range(num_logs):
-        user = random.choice(users)
-        sleep_time = fake.date_time_between(start_date='-1y', end_date='now')
+        sleep_time = time_on(past_date(), 20, 23)
         wake_time = sleep_time + timedelta(hours=random.randint(6, 9))
-        sleep_log = SleepLog(
-            user_id=user.id,
+        yield dict(
+            user_id=random.choice(user_ids),
             date=sleep_time.date(),
             time_fell_asleep=sleep_time,
             time_woke_up=wake_time,
@@ -227,19 +288,15 @@ def create_sleep_logs(users, num_logs=200):
             sleep_quality_index=random.randint(1, 100),
             notes=fake.sentence()
         )
-        sleep_logs.append(sleep_log)
-    return sleep_logs
 
 
-# Function to create fake health metrics
-def create_health_metrics(users, num_metrics=500):
-    health_metrics = []
+def health_metric_rows(user_ids, num_metrics=500):
     for _ in range(num_metrics):
-        user = random.choice(users)
-        health_metric = HealthMetric(
-            user_id=user.id,
-            date=fake.date_between(start_date='-1y', end_date='today'),
-            time=fake.date_time_between(start_date='-1y', end_date='now'),
+        metric_date = past_date()
+        yield dict(
+            user_id=random.choice(user_ids),
+            date=metric_date,
+            time=time_on(metric_date),
             heart_rate=random.randint(60, 100),
             systolic_blood_pressure=random.randint(90, 120),
             diastolic_blood_pressure=random.randint(60, 80),
@@ -247,19 +304,13 @@ def create_health_metrics(users, num_metrics=500):
             blood_glucose_level=random.uniform(70, 140),
             body_temperature=random.uniform(36.5, 37.5)
         )
-        health_metrics.append(health_metric)
-    return health_metrics
 
 
-# Function to create fake body compositions
-def create_body_compositions(users, num_compositions=200):
-    body_compositions = []
+def body_composition_rows(user_ids, num_compositions=200):
     for _ in range(num_compositions):
-        user = random.choice(users)
-        print(user.id)  # Debugging: Ensure this is not None
-        body_composition = BodyComposition(
-            user_id=user.id,
-            date=fake.date_between(start_date='-1y', end_date='today'),
+        yield dict(
+            user_id=random.choice(user_ids),
+            date=past_date(),
             weight=random.uniform(50, 100),
             body_fat_percentage=random.uniform(10, 30),
             skeletal_muscle_mass=random.uniform(10, 40),
@@ -270,25 +321,120 @@ def create_body_compositions(users, num_compositions=200):
             basal_metabolic_rate=random.randint(1200, 2000),
             metabolic_age=random.randint(20, 60)
         )
-        body_compositions.append(body_composition)
-    return body_compositions
 
 
-# Function to create fake goals
-def create_goals(users, num_goals=100):
-    goals = []
+def goal_rows(user_ids, num_goals=100):
     for _ in range(num_goals):
-        user = random.choice(users)
-        goal = Goal(
-            user_id=user.id,
+        yield dict(
+            user_id=random.choice(user_ids),
             goal_type=random.choice(list(GoalTypesEnum)),
             target_value=random.uniform(5, 20),
             current_value=random.uniform(0, 5),
-            deadline=fake.date_between(start_date='today', end_date='+1y'),
+            deadline=future_date(),
             status=random.choice(list(GoalStatusEnum))
         )
-        goals.append(goal)
-    return goals
+
+
+# Function to create fake users
+def create_users(num_users=50, rounds=None, hash_pool=None, hash_workers=1):
+    rows = user_rows(num_users, rounds=rounds, hash_pool=hash_pool,
+                     hash_workers=hash_workers)
+    return [User(**row) for row in rows]
+
+
+# Function to create fake workouts
+def create_workouts(users, num_workouts=200):
+    user_ids = [user.id for user in users]
+    return [Workout(**row) for row in workout_rows(user_ids, num_workouts)]
+
+
+# Function to create fake food items
+def create_food_items(num_items=100):
+    return [FoodItem(**row) for row in food_item_rows(num_items)]
+
+
+# Function to create fake vitamins
+def create_vitamins(num_vitamins=10):
+    return [Vitamin(**row) for row in vitamin_rows(num_vitamins)]
+
+
+# Function to create fake minerals
+def create_minerals(num_minerals=10):
+    return [Mineral(**row) for row in mineral_rows(num_minerals)]
+
+
+# Function to create fake food items vitamins
+def create_food_item_vitamins(food_items, vitamins):
+    rows = food_item_vitamin_rows([item.id for item in food_items],
+                                  [vitamin.id for vitamin in vitamins])
+    return [FoodItemVitamin(**row) for row in rows]
+
+
+# Function to create fake food item minerals
+def create_food_item_minerals(food_items, minerals):
+    rows = food_item_mineral_rows([item.id for item in food_items],
+                                  [mineral.id for mineral in minerals])
+    return [FoodItemMineral(**row) for row in rows]
+
+
+# Function to create fake meals
+def create_meals(users, num_meals=200):
+    user_ids = [user.id for user in users]
+    return [Meal(**row) for row in meal_rows(user_ids, num_meals)]
+
+
+# Function to create fake meal food items
+def create_meal_food_items(meals, food_items):
+    rows = meal_food_item_rows([meal.id for meal in meals],
+                               [item.id for item in food_items])
+    return [MealFoodItem(**row) for row in rows]
+
+
+# Function to create fake water intakes
+def create_water_intakes(users, num_intakes=200):
+    user_ids = [user.id for user in users]
+    return [WaterIntake(**row)
+            for row in water_intake_rows(user_ids, num_intakes)]
+
+
+# Function to create fake nutrition logs
+def create_nutrition_logs(users, num_logs=200):
+    user_ids = [user.id for user in users]
+    return [NutritionLog(**row)
+            for row in nutrition_log_rows(user_ids, num_logs)]
+
+
+# Function to create fake medications
+def create_medications(users, num_medications=50):
+    user_ids = [user.id for user in users]
+    return [Medication(**row)
+            for row in medication_rows(user_ids, num_medications)]
+
+
+# Function to create fake sleep logs
+def create_sleep_logs(users, num_logs=200):
+    user_ids = [user.id for user in users]
+    return [SleepLog(**row) for row in sleep_log_rows(user_ids, num_logs)]
+
+
+# Function to create fake health metrics
+def create_health_metrics(users, num_metrics=500):
+    user_ids = [user.id for user in users]
+    return [HealthMetric(**row)
+            for row in health_metric_rows(user_ids, num_metrics)]
+
+
+# Function to create fake body compositions
+def create_body_compositions(users, num_compositions=200):
+    user_ids = [user.id for user in users]
+    return [BodyComposition(**row)
+            for row in body_composition_rows(user_ids, num_compositions)]
+
+
+# Function to create fake goals
+def create_goals(users, num_goals=100):
+    user_ids = [user.id for user in users]
+    return [Goal(**row) for row in goal_rows(user_ids, num_goals)]
 
 # use context manager and transactions
 @contextmanager
@@ -306,10 +452,11 @@ def transactional_session():
 
 
 # Insert data into the database
-def insert_data():
+def insert_data(**hashing):
+    init_db()
     with transactional_session() as session:
         # Users must be committed to assign IDs before referencing them
-        users = create_users(num_users=50)
+        users = create_users(num_users=50, **hashing)
         session.add_all(users)
         session.commit()  # Ensure users are persisted and have IDs
 
@@ -367,5 +514,338 @@ def insert_data():
         goals = create_goals(users)
         session.add_all(goals)
 
+
+# Bulk loading
+# The ORM path above builds one object per row, which is fine for the example
+# dataset but far too slow for load-test databases with millions of rows.
+# The bulk path streams row dicts into Core insert() statements, executemany
+# in chunks, and uses RETURNING only where child rows need the new IDs.
+
+# Scale the default row counts by a factor; explicit counts win
+def scaled_counts(factor=1, **counts):
+    scaled = {table: count if table in CATALOG_TABLES else int(count * factor)
+              for table, count in DEFAULT_SCALE.items()}
+    scaled.update(counts)
+    return scaled
+
+
+# Split an iterable of rows into lists of at most chunk_size rows
+def chunked(rows, chunk_size=BULK_CHUNK_SIZE):
+    rows = iter(rows)
+    while chunk := list(islice(rows, chunk_size)):
+        yield chunk
+
+
+# Insert rows in chunks; returns the new primary keys when returning=True
+def bulk_insert(connection, table, rows, chunk_size=BULK_CHUNK_SIZE,
+                returning=False):
+    ids = []
+    inserted = 0
+    for chunk in chunked(rows, chunk_size):
+        if returning:
+            statement = insert(table).returning(
+                table.c.id, sort_by_parameter_order=True)
+            ids.extend(connection.execute(statement, chunk).scalars())
+        else:
+            connection.execute(insert(table), chunk)
+        inserted += len(chunk)
+    return ids if returning else inserted
+
+
+# Insert a complete synthetic dataset through the bulk path
+# hashing takes the rounds, hash_pool and hash_workers options of user_rows
+def bulk_insert_data(counts=None, chunk_size=BULK_CHUNK_SIZE, bind=None,
+                     **hashing):
+    bind = bind or init_db()
+    counts = dict(DEFAULT_SCALE, **(counts or {}))
+    report = {}
+
+    def load(table, rows, returning=False):
+        started = timer.perf_counter()
+        # one short transaction per table keeps the write lock bounded
+        with bind.begin() as connection:
+            result = bulk_insert(connection, table, rows, chunk_size,
+                                 returning)
+        elapsed = timer.perf_counter() - started
+        inserted = len(result) if returning else result
+        report[table.name] = (inserted, elapsed)
+        print(f"{table.name}: {inserted} rows in {elapsed:.2f}s "
+              f"({inserted / elapsed if elapsed else 0:.0f} rows/s)")
+        return result
+
+    # continue the username sequence after any existing users
+    with bind.connect() as connection:
+        last_user_id = connection.scalar(
+            select(func.coalesce(func.max(User.id), 0)))
+
+    user_ids = load(User.__table__,
+                    user_rows(counts['users'], start=last_user_id,
+                              **hashing),
+                    returning=True)
+    food_item_ids = load(FoodItem.__table__,
+                         food_item_rows(counts['food_items']), returning=True)
+    vitamin_ids = load(Vitamin.__table__, vitamin_rows(counts['vitamins']),
+                       returning=True)
+    mineral_ids = load(Mineral.__table__, mineral_rows(counts['minerals']),
+                       returning=True)
+    load(FoodItemVitamin.__table__,
+         food_item_vitamin_rows(food_item_ids, vitamin_ids))
+    load(FoodItemMineral.__table__,
+         food_item_mineral_rows(food_item_ids, mineral_ids))
+
+    meal_ids = load(Meal.__table__, meal_rows(user_ids, counts['meals']),
+                    returning=True)
+    load(MealFoodItem.__table__, meal_food_item_rows(meal_ids, food_item_ids))
+
+    load(WaterIntake.__table__,
+         water_intake_rows(user_ids, counts['water_intakes']))
+    load(NutritionLog.__table__,
+         nutrition_log_rows(user_ids, counts['nutrition_logs']))
+    load(Medication.__table__,
+         medication_rows(user_ids, counts['medications']))
+    load(Workout.__table__, workout_rows(user_ids, counts['workouts']))
+    load(SleepLog.__table__, sleep_log_rows(user_ids, counts['sleep_logs']))
+    load(HealthMetric.__table__,
+         health_metric_rows(user_ids, counts['health_metrics']))
+    load(BodyComposition.__table__,
+         body_composition_rows(user_ids, counts['body_compositions']))
+    load(Goal.__table__, goal_rows(user_ids, counts['goals']))
+
+    # Core inserts bypass the ORM flush events that maintain the rollups
+    with bind.begin() as connection:
+        rebuild_rollups(connection)
+
+    total_rows = sum(inserted for inserted, _ in report.values())
+    total_time = sum(elapsed for _, elapsed in report.values())
+    print(f"Inserted {total_rows} rows in {total_time:.2f}s")
+    return report
+
+
+# Parallel generation
+# Faker becomes the bottleneck once writes are batched, so the parallel loader
+# splits users into fixed-size shards and generates each shard's rows in a
+# process pool. Every shard reseeds Faker and random from (seed, shard) and
+# the parent process writes the shards in order, so a seed reproduces the same
+# dataset whatever the number of workers. Shards refer to users and meals by
+# their position; the writer turns positions into explicit primary keys.
+
+# Tables whose rows are generated per user shard, in insert order
+SHARDED_TABLES = (
+    (WaterIntake, 'water_intakes', water_intake_rows),
+    (NutritionLog, 'nutrition_logs', nutrition_log_rows),
+    (Medication, 'medications', medication_rows),
+    (Workout, 'workouts', workout_rows),
+    (SleepLog, 'sleep_logs', sleep_log_rows),
+    (HealthMetric, 'health_metrics', health_metric_rows),
+    (BodyComposition, 'body_compositions', body_composition_rows),
+    (Goal, 'goals', goal_rows),
+)
+
+
+# Reseed the module-level generators for one shard (-1 is the catalog)
+def seed_generators(seed, shard):
+    shard_seed = seed * 1000003 + shard + 1
+    random.seed(shard_seed)
+    fake.seed_instance(shard_seed)
+
+
+# Share of a table's rows that falls to users [first_user, last_user)
+def shard_count(count, first_user, last_user, total_users):
+    return (count * last_user // total_users
+            - count * first_user // total_users)
+
+
+# Generate all user-owned rows for one shard; runs in a worker process
+def generate_shard(task):
+    global anchor_date
+    (shard, seed, first_user, last_user, counts, food_item_ids, user_base,
+     anchor, rounds, hash_pool) = task
+    anchor_date = anchor
+    seed_generators(seed, shard)
+    total_users = counts['users']
+    positions = list(range(first_user, last_user))
+
+    def share(table):
+        return shard_count(counts[table], first_user, last_user, total_users)
+
+    # user_id and meal_id hold positions until the writer assigns keys
+    rows = {'users': list(user_rows(len(positions),
+                                    start=user_base + first_user,
+                                    rounds=rounds, hash_pool=hash_pool))}
+    rows['meals'] = list(meal_rows(positions, share('meals')))
+    rows['meal_food_items'] = list(meal_food_item_rows(
+        range(len(rows['meals'])), food_item_ids))
+    for _, table, generator in SHARDED_TABLES:
+        rows[table] = list(generator(positions, share(table)))
+    return shard, rows
+
+
+# Like executor.map, but keeps at most `window` shards in flight so a slow
+# writer does not pile generated rows up in memory
+def ordered_map(executor, function, tasks, window):
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(function, task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+# Insert a reproducible synthetic dataset generated by a pool of workers
+def parallel_insert_data(counts=None, seed=0, workers=None,
+                         shard_size=SHARD_SIZE, chunk_size=BULK_CHUNK_SIZE,
+                         anchor=None, bind=None, rounds=None,
+                         hash_pool=None):
+    bind = bind or init_db()
+    counts = dict(DEFAULT_SCALE, **(counts or {}))
+    anchor = anchor or date.today()
+    workers = workers or os.cpu_count()
+    started = timer.perf_counter()
+    inserted = dict.fromkeys(['users', 'meals', 'meal_food_items'] + [
+        table for _, table, _ in SHARDED_TABLES], 0)
+
+    # the shared catalogs are small and generated up front by the writer
+    global anchor_date
+    anchor_date = anchor
+    seed_generators(seed, -1)
+    with bind.begin() as connection:
+        food_item_ids = bulk_insert(connection, FoodItem.__table__,
+                                    food_item_rows(counts['food_items']),
+                                    chunk_size, returning=True)
+        vitamin_ids = bulk_insert(connection, Vitamin.__table__,
+                                  vitamin_rows(counts['vitamins']),
+                                  chunk_size, returning=True)
+        mineral_ids = bulk_insert(connection, Mineral.__table__,
+                                  mineral_rows(counts['minerals']),
+                                  chunk_size, returning=True)
+        bulk_insert(connection, FoodItemVitamin.__table__,
+                    food_item_vitamin_rows(food_item_ids, vitamin_ids),
+                    chunk_size)
+        bulk_insert(connection, FoodItemMineral.__table__,
+                    food_item_mineral_rows(food_item_ids, mineral_ids),
+                    chunk_size)
+        user_base = connection.scalar(
+            select(func.coalesce(func.max(User.id), 0)))
+        next_meal_id = connection.scalar(
+            select(func.coalesce(func.max(Meal.id), 0))) + 1
+
+    tasks = ((shard, seed, first_user,
+              min(first_user + shard_size, counts['users']),
+              counts, food_item_ids, user_base, anchor, rounds, hash_pool)
+             for shard, first_user in enumerate(
+                 range(0, counts['users'], shard_size)))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for shard, rows in ordered_map(executor, generate_shard, tasks,
+                                       window=2 * workers):
+            # turn user and meal positions into primary keys
+            for position, row in enumerate(rows['users']):
+                row['id'] = user_base + shard * shard_size + position + 1
+            for table, table_rows in rows.items():
+                if table != 'users':
+                    for row in table_rows:
+                        if 'user_id' in row:
+                            row['user_id'] += user_base + 1
+            for position, row in enumerate(rows['meals']):
+                row['id'] = next_meal_id + position
+            for row in rows['meal_food_items']:
+                row['meal_id'] += next_meal_id
+            next_meal_id += len(rows['meals'])
+
+            # one transaction per shard keeps the write lock short
+            with bind.begin() as connection:
+                for model, table in ((User, 'users'), (Meal, 'meals'),
+                                     (MealFoodItem, 'meal_food_items')):
+                    inserted[table] += bulk_insert(
+                        connection, model.__table__, rows[table], chunk_size)
+                for model, table, _ in SHARDED_TABLES:
+                    inserted[table] += bulk_insert(
+                        connection, model.__table__, rows[table], chunk_size)
+
+    # Core inserts bypass the ORM flush events that maintain the rollups
+    with bind.begin() as connection:
+        rebuild_rollups(connection)
+
+    elapsed = timer.perf_counter() - started
+    total_rows = sum(inserted.values())
+    print(f"Inserted {total_rows} rows with {workers} workers in "
+          f"{elapsed:.2f}s ({total_rows / elapsed:.0f} rows/s)")
+    return inserted
+
+
+# Parse "table=count" overrides from the command line
+def parse_count(value):
+    table, _, count = value.partition('=')
+    if table not in DEFAULT_SCALE or not count.isdigit():
+        raise argparse.ArgumentTypeError(
+            f"expected TABLE=COUNT with TABLE one of {', '.join(DEFAULT_SCALE)}")
+    return table, int(count)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Insert synthetic data into the health and fitness "
+                    "database.")
+    parser.add_argument('--bulk', action='store_true',
+                        help="use the Core bulk loader instead of the ORM")
+    parser.add_argument('--scale', type=float, default=1,
+                        help="multiply the default row counts (bulk only)")
+    parser.add_argument('--count', type=parse_count, action='append',
+                        default=[], metavar='TABLE=COUNT',
+                        help="row count for one table (bulk only)")
+    parser.add_argument('--chunk-size', type=int, default=BULK_CHUNK_SIZE,
+                        help="rows per executemany batch (bulk only)")
+    parser.add_argument('--workers', type=int,
+                        help="generate shards in this many processes; "
+                             "implies --bulk")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed for the parallel generator")
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE,
+                        help="users per generation shard")
+    parser.add_argument('--profile', choices=TUNING_PROFILES,
+                        default='bulk_load',
+                        help="SQLite tuning profile for bulk loads")
+    parser.add_argument('--bcrypt-rounds', type=int,
+                        help="bcrypt cost for generated users (4-31, "
+                             "default bcrypt's own); test data only")
+    parser.add_argument('--hash-workers', type=int, default=1,
+                        help="hash generated passwords in this many "
+                             "processes")
+    parser.add_argument('--hash-pool', type=int, metavar='SIZE',
+                        help="precompute SIZE hashes and reuse them for "
+                             "all generated users")
+    parser.add_argument('--anchor-date', type=date.fromisoformat,
+                        help="day generated dates are relative to "
+                             "(YYYY-MM-DD, default today)")
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
-    insert_data()
+    args = parse_args()
+    counts = scaled_counts(args.scale, **dict(args.count))
+    hash_pool = None
+    if args.hash_pool:
+        hash_pool = precompute_hash_pool(args.hash_pool, args.bcrypt_rounds,
+                                         args.hash_workers)
+    if args.workers or args.bulk:
+        bulk_engine = init_db(profile=args.profile)
+    if args.workers:
+        # shards already run in a process pool, so they hash serially
+        parallel_insert_data(counts, seed=args.seed, workers=args.workers,
+                             shard_size=args.shard_size,
+                             chunk_size=args.chunk_size,
+                             anchor=args.anchor_date, bind=bulk_engine,
+                             rounds=args.bcrypt_rounds, hash_pool=hash_pool)
+    else:
+        hashing = dict(rounds=args.bcrypt_rounds, hash_pool=hash_pool,
+                       hash_workers=args.hash_workers)
+        if args.bulk:
+            bulk_insert_data(counts, chunk_size=args.chunk_size,
+                             bind=bulk_engine, **hashing)
+        else:
+            insert_data(**hashing)
+    # the loaders fill the main database; with user shards (see shards.py)
+    # each user's rows then move to their shard
+    if create.shard_engines:
+        shards.split()
@@ -0,0 +1,287 @@
+# Query instrumentation
+# Per-statement statistics gathered from the engine's cursor events, cheap
+# enough to leave on in production instead of echo=True. Statements are
+# grouped by their normalized SQL and the application function that issued
+# them. Each group keeps a count, the rows returned or changed, and a
+# latency histogram. Statements slower than a threshold are written to the
+# slow-query log. snapshot() returns the groups, busiest first.
+#
+# A statement's latency covers executing it and fetching its rows, which is
+# where SQLite does most of the work of a SELECT. It is recorded once the
+# result is read to the end or closed.
+#
+# Set HEALTH_DB_SLOW_QUERY_MS to have create.init_db() instrument its engine,
+# or call instrument(engine) directly.
+from sqlalchemy import event
+from sqlalchemy.engine.cursor import CursorFetchStrategy
+from functools import lru_cache
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+# Statements at least this slow are written to the slow-query log
+SLOW_QUERY_MS = 100
+
+# Upper bounds of the latency histogram buckets in milliseconds; a last
+# bucket holds everything slower
+HISTOGRAM_BOUNDS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500,
+                       1000, 2500, 5000, 10000)
+
+slow_query_log = logging.getLogger('health_db.slow_queries')
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+_WHITESPACE = re.compile(r'\s+')
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r'\(\?(?: ?, ?\?)+\)')
+_VALUES_LIST = re.compile(r'(\(\?\.\.\.\))(?: ?, ?\(\?\.\.\.\))+')
+
+
+# SQL with literals replaced by ? and lists of placeholders, as in
+# IN (?, ?, ?) or multi-row VALUES, collapsed so every length groups together
+@lru_cache(maxsize=4096)
+def normalize_sql(statement):
+    sql = _WHITESPACE.sub(' ', statement).strip()
+    sql = _LITERAL.sub('?', sql)
+    sql = _PLACEHOLDER_LIST.sub('(?...)', sql)
+    return _VALUES_LIST.sub(r'\1...', sql)
+
+
+# Module and name of the innermost application function on the stack
+def _caller():
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(APP_ROOT) and filename != __file__ \
+                and 'site-packages' not in filename:
+            return f"{frame.f_globals.get('__name__')}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return None
+
+
+# Statistics of one (normalized SQL, caller) group
+class QueryStats:
+    __slots__ = ('sql', 'caller', 'count', 'rows', 'total_ms', 'max_ms',
+                 'buckets')
+
+    def __init__(self, sql, caller):
+        self.sql = sql
+        self.caller = caller
+        self.count = 0
+        self.rows = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+
+    def add(self, elapsed_ms, rows):
+        self.count += 1
+        self.rows += rows
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        bucket = 0
+        while bucket < len(HISTOGRAM_BOUNDS_MS) \
+                and elapsed_ms > HISTOGRAM_BOUNDS_MS[bucket]:
+            bucket += 1
+        self.buckets[bucket] += 1
+
+    # Upper bound of the bucket holding the given fraction of the calls
+    def percentile(self, fraction):
+        rank = max(1, round(fraction * self.count))
+        seen = 0
+        for bound, count in zip(HISTOGRAM_BOUNDS_MS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def as_dict(self):
+        return {
+            "sql": self.sql,
+            "caller": self.caller,
+            "count": self.count,
+            "rows": self.rows,
+            "total_ms": self.total_ms,
+            "mean_ms": self.total_ms / self.count if self.count else 0.0,
+            "max_ms": self.max_ms,
+            "p50_ms": self.percentile(0.50),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "histogram": dict(zip(
+                [*map(str, HISTOGRAM_BOUNDS_MS), 'inf'], self.buckets)),
+        }
+
+
+# One execution, recorded when its result is exhausted or closed
+class _Measurement:
+    __slots__ = ('instrumentation', 'statement', 'caller', 'elapsed',
+                 'rows', 'finished')
+
+    def __init__(self, instrumentation, statement, caller, elapsed):
+        self.instrumentation = instrumentation
+        self.statement = statement
+        self.caller = caller
+        self.elapsed = elapsed
+        self.rows = 0
+        self.finished = False
+
+    def finish(self):
+        if not self.finished:
+            self.finished = True
+            self.instrumentation.record(self.statement, self.caller,
+                                        self.elapsed, self.rows)
+
+
+# The default fetch strategy, also timing the fetches and counting the rows
+class _MeasuredFetch(CursorFetchStrategy):
+    __slots__ = ('measurement',)
+
+    def __init__(self, measurement):
+        self.measurement = measurement
+
+    def soft_close(self, result, dbapi_cursor):
+        super().soft_close(result, dbapi_cursor)
+        self.measurement.finish()
+
+    def hard_close(self, result, dbapi_cursor):
+        super().hard_close(result, dbapi_cursor)
+        self.measurement.finish()
+
+    def yield_per(self, result, dbapi_cursor, num):
+        # rows fetched in batches from here on are not counted
+        super().yield_per(result, dbapi_cursor, num)
+        self.measurement.finish()
+
+    def fetchone(self, result, dbapi_cursor, hard_close=False):
+        started = time.perf_counter()
+        row = super().fetchone(result, dbapi_cursor, hard_close)
+        self.measurement.elapsed += time.perf_counter() - started
+        if row is not None:
+            self.measurement.rows += 1
+        return row
+
+    def fetchmany(self, result, dbapi_cursor, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(result, dbapi_cursor, size)
+        self.measurement.elapsed += time.perf_counter() - started
+        self.measurement.rows += len(rows)
+        return rows
+
+    def fetchall(self, result, dbapi_cursor):
+        started = time.perf_counter()
+        # the rows are counted before fetchall soft-closes the result
+        try:
+            rows = dbapi_cursor.fetchall()
+        except BaseException as e:
+            self.handle_exception(result, dbapi_cursor, e)
+        self.measurement.elapsed += time.perf_counter() - started
+        self.measurement.rows += len(rows)
+        result._soft_close()
+        return rows
+
+
+# Statistics of the statements run by the engines it is attached to
+class Instrumentation:
+    def __init__(self, slow_query_ms=SLOW_QUERY_MS):
+        self.slow_query_ms = slow_query_ms
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.engines = []
+
+    def attach(self, engine):
+        event.listen(engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute',
+                     self._after_cursor_execute)
+        event.listen(engine, 'handle_error', self._handle_error)
+        self.engines.append(engine)
+        return self
+
+    def detach(self):
+        for engine in self.engines:
+            event.remove(engine, 'before_cursor_execute',
+                         self._before_cursor_execute)
+            event.remove(engine, 'after_cursor_execute',
+                         self._after_cursor_execute)
+            event.remove(engine, 'handle_error', self._handle_error)
+        self.engines = []
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        measurement = _Measurement(self, statement, _caller(), elapsed)
+        options = context.execution_options if context is not None else {}
+        if cursor.description is not None and not context.is_crud \
+                and not options.get('stream_results') \
+                and not options.get('yield_per') \
+                and type(context.cursor_fetch_strategy) \
+                is CursorFetchStrategy:
+            # the rows are still to be fetched
+            context.cursor_fetch_strategy = _MeasuredFetch(measurement)
+        else:
+            measurement.rows = max(cursor.rowcount, 0)
+            measurement.finish()
+
+    # A failed statement is not recorded; forget when it started
+    def _handle_error(self, exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get('query_started'):
+            connection.info['query_started'].pop()
+
+    def record(self, statement, caller, elapsed, rows):
+        sql = normalize_sql(statement)
+        elapsed_ms = elapsed * 1000
+        with self.lock:
+            stats = self.stats.get((sql, caller))
+            if stats is None:
+                stats = self.stats[(sql, caller)] = QueryStats(sql, caller)
+            stats.add(elapsed_ms, rows)
+        if self.slow_query_ms is not None \
+                and elapsed_ms >= self.slow_query_ms:
+            slow_query_log.warning("%.1f ms, %d rows, %s: %s", elapsed_ms,
+                                   rows, caller or 'unknown caller', sql)
+
+    # Statistics of every statement group, by total time spent, busiest
+    # first; reset starts counting afresh
+    def snapshot(self, reset=False):
+        with self.lock:
+            groups = [stats.as_dict() for stats in self.stats.values()]
+            if reset:
+                self.stats = {}
+        return sorted(groups, key=lambda group: -group["total_ms"])
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+
+# Instrument an engine (for an AsyncEngine pass its sync_engine). Statements
+# at least slow_query_ms long are logged; None turns the log off.
+def instrument(engine, slow_query_ms=SLOW_QUERY_MS):
+    return Instrumentation(slow_query_ms).attach(engine)
+
+
+# Run the query_data examples for a few users and print the busiest
+# statements
+if __name__ == "__main__":
+    from create import init_db
+    import query_data
+
+    logging.basicConfig(format='%(levelname)s %(name)s: %(message)s')
+    instrumentation = instrument(init_db())
+    for user_id in range(1, 51):
+        query_data.track_goal_progress(user_id)
+        query_data.calculate_user_bmi(user_id)
+        query_data.recommend_water_intake(user_id)
+        query_data.get_workouts_by_user_and_date(user_id, '2023-04-01',
+                                                 '2024-01-31')
+    for group in instrumentation.snapshot()[:10]:
+        print(f"{group['count']:>5} calls {group['total_ms']:8.1f} ms "
+              f"p95 {group['p95_ms']:6.2f} ms {group['rows']:>6} rows  "
+              f"{group['caller']}\n      {group['sql'][:100]}")
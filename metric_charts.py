@@ -0,0 +1,131 @@
+# Health metric charts
+# Chart points for one vital of one user over a time range. The caller
+# names the resolution the chart needs and get_metric_chart reads the
+# coarsest tier whose buckets are no wider than that: health_metric_daily,
+# health_metric_hourly, or the raw health_metrics readings. A year of heart
+# rate at daily resolution reads about 365 rows instead of every reading.
+# The tiers cover the days moved to partitions (see partitions.py); raw
+# readings are read from the partitions overlapping the range.
+from create import init_db, read_session
+from partitions import sources, entity
+from archive import archived_rows
+from models import (
+    HEALTH_METRIC_VITALS, HealthMetric, HealthMetricHourly, HealthMetricDaily
+)
+from sqlalchemy import tuple_
+from datetime import date, datetime, time, timedelta
+
+# Aggregate tiers from coarsest to finest, with the width of their buckets
+TIERS = [
+    ('daily', timedelta(days=1)),
+    ('hourly', timedelta(hours=1)),
+]
+
+
+# The coarsest tier whose buckets fit the requested resolution, or 'raw'
+def choose_tier(resolution):
+    for tier, width in TIERS:
+        if width <= resolution:
+            return tier
+    return 'raw'
+
+
+# Range bounds may be dates; a date end bound includes that whole day
+def _as_datetime(value, end=False):
+    if isinstance(value, datetime):
+        return value
+    return datetime.combine(value, time.max if end else time.min)
+
+
+# Count, min, max, mean and last columns of a vital in a tier
+def _statistics(model, vital):
+    return [getattr(model, f'{vital}_{statistic}')
+            for statistic in ('count', 'min', 'max', 'mean', 'last')]
+
+
+def _point(start, count, minimum, maximum, mean, last):
+    return {"start": start, "count": count, "min": minimum, "max": maximum,
+            "mean": mean, "last": last}
+
+
+# Points of one vital for a user between start and end, one per bucket of
+# the chosen tier that has readings, in time order. Each point holds the
+# bucket start and the count, min, max, mean and last reading; raw points
+# are single readings. Reads through a short-lived read session, or session
+# if given.
+def get_metric_chart(user_id, vital, start, end, resolution, session=None):
+    with read_session(session, user_id) as session:
+        return _metric_chart(session, user_id, vital, start, end, resolution)
+
+
+def _metric_chart(session, user_id, vital, start, end, resolution):
+    if vital not in HEALTH_METRIC_VITALS:
+        raise ValueError(f"Unknown health metric: {vital}")
+    start = _as_datetime(start)
+    end = _as_datetime(end, end=True)
+    tier = choose_tier(resolution)
+
+    if tier == 'daily':
+        count, *statistics = _statistics(HealthMetricDaily, vital)
+        rows = session.query(
+            HealthMetricDaily.date, count, *statistics
+        ).filter(
+            HealthMetricDaily.user_id == user_id,
+            HealthMetricDaily.date.between(start.date(), end.date()),
+            count > 0
+        ).order_by(HealthMetricDaily.date)
+        return [_point(datetime.combine(day, time.min), *values)
+                for day, *values in rows]
+
+    if tier == 'hourly':
+        count, *statistics = _statistics(HealthMetricHourly, vital)
+        bucket = tuple_(HealthMetricHourly.date, HealthMetricHourly.hour)
+        rows = session.query(
+            HealthMetricHourly.date, HealthMetricHourly.hour, count,
+            *statistics
+        ).filter(
+            HealthMetricHourly.user_id == user_id,
+            HealthMetricHourly.date.between(start.date(), end.date()),
+            bucket >= (start.date(), start.hour),
+            bucket <= (end.date(), end.hour),
+            count > 0
+        ).order_by(HealthMetricHourly.date, HealthMetricHourly.hour)
+        return [_point(datetime.combine(day, time(hour)), *values)
+                for day, hour, *values in rows]
+
+    # a reading was taken at its date plus the time of day of its time
+    points = []
+    for schema in sources(session.connection(), start, end):
+        reading = entity(HealthMetric, schema)
+        column = getattr(reading, vital)
+        rows = session.query(reading.date, reading.time, column).filter(
+            reading.user_id == user_id,
+            reading.date.between(start.date(), end.date()),
+            column.isnot(None)
+        ).order_by(reading.date, reading.time_of_day)
+        for day, moment, value in rows:
+            taken_at = datetime.combine(day, moment.time())
+            if start <= taken_at <= end:
+                points.append(_point(taken_at, 1, value, value, value,
+                                     value))
+    # and the readings of archived months (see archive.py)
+    for reading in archived_rows(session.connection(), HealthMetric,
+                                 [user_id], start, end):
+        value = getattr(reading, vital)
+        taken_at = datetime.combine(reading.date, reading.time_of_day)
+        if value is not None and start <= taken_at <= end:
+            points.append(_point(taken_at, 1, value, value, value, value))
+    # in time order across the sources
+    points.sort(key=lambda point: point["start"])
+    return points
+
+
+# Usage example
+if __name__ == "__main__":
+    init_db()
+    # a year of heart rate, one point per day
+    print(get_metric_chart(27, 'heart_rate', date(2023, 4, 1),
+                           date(2024, 3, 31), timedelta(days=1)))
+    # two months of blood pressure, one point per hour
+    print(get_metric_chart(27, 'systolic_blood_pressure', date(2023, 12, 1),
+                           date(2024, 1, 31), timedelta(hours=1)))
@@ -0,0 +1,656 @@
+from sqlalchemy import Column, Date, DateTime, ForeignKey, func
+from sqlalchemy import Integer, String, Float, Enum, Index
+from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.schema import CheckConstraint
+from datetime import datetime
+import enum
+
+
+# Model definitions only; creating the engine and the tables is left to
+# create.init_db() so importing the models has no side effects.
+Base = declarative_base()
+
+# Version of the schema defined below, stored in SQLite's user_version.
+# Bump it whenever a table, column or index is added and register the
+# upgrade step in create.MIGRATIONS.
+SCHEMA_VERSION = 10
+
+# Scores used to average workout intensity
+INTENSITY_SCORES = {"Low": 1, "Medium": 2, "High": 3}
+
+# Per-serving food item columns totalled per meal in meal_nutrient_totals
+MEAL_NUTRIENTS = ['calories', 'proteins', 'carbs', 'fats', 'fiber']
+
+# Health metric readings aggregated in health_metric_hourly and _daily, and
+# copied from the latest reading into user_latest_state
+HEALTH_METRIC_VITALS = [
+    'heart_rate', 'systolic_blood_pressure', 'diastolic_blood_pressure',
+    'blood_oxygen_level', 'blood_glucose_level', 'body_temperature'
+]
+
+# Body composition values copied from the latest one into user_latest_state
+LATEST_BODY_COMPOSITION_VALUES = [
+    'weight', 'basal_metabolic_rate', 'skeletal_muscle_mass'
+]
+
+
+# User class
+# Static information about the user that does not change frequently
+class User(Base):
+    __tablename__ = 'users'
+    id = Column(Integer, primary_key=True)
+    username = Column(String(255), unique=True, nullable=False)  # For login
+    # For account recovery and notifications
+    email = Column(String(255), unique=True, nullable=False)
+    # Securely storing the hashed password
+    password_hash = Column(String(255), nullable=False)
+    # Name might not be strictly required
+    name = Column(String(255), nullable=True)
+    # Age is optional but, if provided, must be non-negative integer
+    age = Column(Integer, CheckConstraint('age>=0'), nullable=True)
+    # Gender is optional, I may consider using Enum for predefined values
+    gender = Column(String(50), nullable=True)
+    # non-negative initial weight and height
+    initial_weight = Column(Float, CheckConstraint('initial_weight>=0'),
+                            nullable=False)
+    # non-negative height
+    height = Column(Float, CheckConstraint('height>=0'), nullable=False)
+
+    # relationships with other tables
+    workouts = relationship("Workout", back_populates="user")
+    meals = relationship("Meal", back_populates="user")
+    water_intakes = relationship("WaterIntake", back_populates="user")
+    nutrition_logs = relationship("NutritionLog", back_populates="user")
+    medications = relationship("Medication", back_populates="user")
+    sleep_logs = relationship("SleepLog", back_populates="user")
+    health_metrics = relationship("HealthMetric", back_populates="user")
+    body_compositions = relationship(
+        "BodyComposition", back_populates="user")
+    goals = relationship("Goal", back_populates="user")
+    # For session management
+    sessions = relationship("UserSession", back_populates="user")
+
+    # Password hashing methods
+    # bcrypt is imported on first use to keep importing the models cheap
+    def set_password(self, password):
+        import bcrypt
+        self.password_hash = bcrypt.hashpw(password.encode('utf-8'),
+                                           bcrypt.gensalt())
+
+    def check_password(self, password):
+        import bcrypt
+        return bcrypt.checkpw(password.encode('utf-8'),
+                              self.password_hash.encode('utf-8'))
+
+
+# Session model
+class UserSession(Base):
+    __tablename__ = 'sessions'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), index=True,
+                     nullable=False)
+    # Ensuring uniqueness and non-nullability
+    token = Column(String(255), unique=True, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    # Ensure an expiration time is always provided
+    expires_at = Column(DateTime, nullable=False)
+    user = relationship("User", back_populates="sessions")
+
+    __table_args__ = (
+        CheckConstraint('expires_at > created_at',
+                        name='check_expiration_after_creation'),
+        # for sweeping expired sessions
+        Index('idx_expires_at_s', 'expires_at'),
+    )
+
+
+# The following classes are for the user's health and fitness data
+# They are related to the User class through foreign keys
+
+# FoodItem class
+# Names are searched through the food_search full-text index, created by
+# create.create_food_search (see food_search.py)
+class FoodItem(Base):
+    __tablename__ = 'food_items'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(255), nullable=False)
+    # nutritional information per serving
+    calories = Column(Float, CheckConstraint('calories>=0'), nullable=False)
+    proteins = Column(Float, CheckConstraint('proteins>=0'), nullable=False)
+    carbs = Column(Float, CheckConstraint('carbs>=0'), nullable=False)
+    fats = Column(Float, CheckConstraint('fats>=0'), nullable=False)
+    fiber = Column(Float, CheckConstraint('fiber>=0'))
+    # instead of using json, I created tables for vitamins and minerals
+    vitamins = relationship("FoodItemVitamin", back_populates="food_item")
+    minerals = relationship("FoodItemMineral", back_populates="food_item")
+    # relationships with other tables
+    meal_food_items = relationship("MealFoodItem", back_populates="food_item")
+
+
+# vitamins and minerals are separate classes to allow for more details
+class Vitamin(Base):
+    __tablename__ = 'vitamins'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(255), nullable=False)  # vitamine type/name
+    # Other relevant fields
+
+
+class Mineral(Base):
+    __tablename__ = 'minerals'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(255), nullable=False)  # mineral type/name
+    # Other relevant fields
+
+
+# FoodItemVitamin and FoodItemMineral classes (Association Objects)
+class FoodItemVitamin(Base):
+    __tablename__ = 'food_item_vitamins'
+    id = Column(Integer, primary_key=True)
+    food_item_id = Column(Integer, ForeignKey('food_items.id'), nullable=False,
+                          index=True)
+    vitamin_id = Column(Integer, ForeignKey('vitamins.id'), nullable=False,
+                        index=True)
+    amount = Column(Float, CheckConstraint('amount>=0'),
+                    nullable=False)  # e.g., amount in milligrams
+    food_item = relationship("FoodItem", back_populates="vitamins")
+    vitamin = relationship("Vitamin")
+
+
+class FoodItemMineral(Base):
+    __tablename__ = 'food_item_minerals'
+    id = Column(Integer, primary_key=True)
+    food_item_id = Column(Integer, ForeignKey('food_items.id'), nullable=False,
+                          index=True)
+    mineral_id = Column(Integer, ForeignKey('minerals.id'), nullable=False,
+                        index=True)
+    amount = Column(Float, nullable=False)  # e.g., amount in milligrams
+    food_item = relationship("FoodItem", back_populates="minerals")
+    mineral = relationship("Mineral")
+
+
+# Meal class
+class Meal(Base):
+    __tablename__ = 'meals'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    date = Column(Date, nullable=False)
+    meal_type = Column(String(255), nullable=False)  # Breakfast, Lunch, etc.
+    eating_time = Column(DateTime, nullable=False)
+    user = relationship("User", back_populates="meals")
+    food_items = relationship("MealFoodItem", back_populates="meal")
+
+    # indexing user_id and date for faster queries
+    # indexing by user_id first since it is more selective and commonly used
+    __table_args__ = (
+        Index('idx_user_id_date_m', 'user_id', 'date'),
+    )
+
+
+# MealFoodItem class (Association Object), many-to-many relationship
+# This allows recording which food items are part of which meals
+class MealFoodItem(Base):
+    __tablename__ = 'meal_food_items'
+    id = Column(Integer, primary_key=True)
+    meal_id = Column(Integer, ForeignKey('meals.id'), nullable=False)
+    food_item_id = Column(Integer, ForeignKey('food_items.id'), nullable=False,
+                          index=True)
+    servings_consumed = Column(Float, CheckConstraint('servings_consumed>=0'),
+                               default=1, nullable=False)  # number of servings
+    meal = relationship("Meal", back_populates="food_items")
+    food_item = relationship("FoodItem")
+
+    # the food items of a meal, covering so counting the distinct food items
+    # of a user's meals never reads the table
+    __table_args__ = (
+        Index('idx_meal_id_food_item_id_mfi', 'meal_id', 'food_item_id'),
+    )
+
+
+# WaterIntake class
+class WaterIntake(Base):
+    __tablename__ = 'water_intake'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'),
+                     nullable=False)
+    date = Column(Date, nullable=False)
+    # Ensuring water intake amount is non-negative
+    amount = Column(Float, CheckConstraint('amount>=0'), nullable=False)
+    user = relationship("User", back_populates="water_intakes")
+
+    # indexing user_id and date for faster queries
+    # indexing by user_id first since it is more selective and commonly used
+    __table_args__ = (
+        Index('idx_user_id_date_wi', 'user_id', 'date'),
+    )
+
+
+# NutritionLog class
+class NutritionLog(Base):
+    __tablename__ = 'nutrition_logs'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'),
+                     nullable=False)
+    date = Column(Date, nullable=False)
+    # include total calories, water intake, etc.
+    summary = Column(String(1000), nullable=False)
+    user = relationship("User", back_populates="nutrition_logs")
+
+    # indexing user_id and date for faster queries
+    # indexing by user_id first since it is more selective and commonly used
+    __table_args__ = (
+        Index('idx_user_id_date_nl', 'user_id', 'date'),
+    )
+
+
+class Medication(Base):
+    __tablename__ = 'medications'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    name = Column(String(255), nullable=False)
+    dosage = Column(String(255), nullable=False)  # Dosage in mg or specifics
+    frequency = Column(String(255), nullable=False)  # How often taken
+    start_date = Column(Date, nullable=False)
+    end_date = Column(Date, nullable=True)  # nullable if ongoing
+    reason = Column(String(1000), nullable=True)  # Reason for medication
+
+    user = relationship("User", back_populates="medications")
+
+    __table_args__ = (
+        Index('idx_meds_user_start_end', 'user_id', 'start_date', 'end_date'),
+    )
+
+
+# Workout class
+class Workout(Base):
+    __tablename__ = 'workouts'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'),
+                     nullable=False)
+    date = Column(Date, nullable=False)
+    # Assuming a max length for the workout type
+    type = Column(String(255), nullable=False)
+    # Ensure duration is non-negative
+    duration = Column(Float, CheckConstraint('duration>=0'), nullable=False)
+    # Max length for the intensity description
+    intensity = Column(String(255), nullable=False)
+    # Ensure non-negative calories burned
+    calories_burned = Column(Float, CheckConstraint('calories_burned>=0'),
+                             nullable=False)
+    user = relationship("User", back_populates="workouts")
+
+    # indexing user_id and date for faster queries
+    # indexing by user_id first since it is more selective and commonly used
+    # duration and type make it covering for the workout summary
+    __table_args__ = (
+        Index('idx_user_id_date_duration_type_w',
+              'user_id', 'date', 'duration', 'type'),
+    )
+
+
+# SleepLog class
+class SleepLog(Base):
+    __tablename__ = 'sleep_logs'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'),
+                     nullable=False)
+    date = Column(Date, nullable=False)
+    time_fell_asleep = Column(DateTime, nullable=False)
+    time_woke_up = Column(DateTime, nullable=False)
+    deep_sleep_duration = Column(Float, CheckConstraint(
+        'deep_sleep_duration>=0'), nullable=True)  # Non-negative, optional
+    rem_sleep_duration = Column(Float, CheckConstraint(
+        'rem_sleep_duration>=0'), nullable=True)
+    light_sleep_duration = Column(Float, CheckConstraint(
+        'light_sleep_duration>=0'), nullable=True)
+    interruptions = Column(Integer, CheckConstraint(
+        'interruptions>=0'), nullable=True)
+    sleep_quality_index = Column(Integer, CheckConstraint(
+        'sleep_quality_index>=0'), nullable=True)  # An index of sleep quality
+    notes = Column(String(
+        1000), nullable=True)  # Optional, with a reasonable max length notes
+
+    user = relationship("User", back_populates="sleep_logs")
+
+    @hybrid_property
+    def total_sleep_duration(self):
+        if self.time_fell_asleep and self.time_woke_up:
+            # Calculate total sleep duration based on the timestamps
+            total_seconds = (
+                self.time_woke_up - self.time_fell_asleep).total_seconds()
+            return total_seconds / 3600  # Convert seconds to hours
+        return 0
+
+    @total_sleep_duration.expression
+    def total_sleep_duration(cls):
+        # Use database function to calculate duration for queries
+        return (func.julianday(
+            cls.time_woke_up) - func.julianday(cls.time_fell_asleep)) * 24
+
+    # Validate sleep time range
+    # indexing user_id and date for faster queries
+    # indexing by user_id first since it is more selective and commonly used
+    __table_args__ = (
+        CheckConstraint('time_fell_asleep < time_woke_up',
+                        name='check_sleep_times'),
+        Index('idx_user_id_date_sl', 'user_id', 'date'),
+    )
+
+
+# HealthMetric class
+class HealthMetric(Base):
+    __tablename__ = 'health_metrics'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'),
+                     nullable=False)
+    date = Column(Date, nullable=False)
+    time = Column(DateTime, nullable=False)  # time of the day
+
+    # Heart rate should be positive, optional
+    heart_rate = Column(Integer,
+                        CheckConstraint('heart_rate>0'), nullable=True)
+    systolic_blood_pressure = Column(Integer, CheckConstraint(
+        'systolic_blood_pressure>0'), nullable=True)  # Optional, positive
+    diastolic_blood_pressure = Column(Integer, CheckConstraint(
+        'diastolic_blood_pressure>0'), nullable=True)  # Optional, positive
+
+    blood_oxygen_level = Column(Float, CheckConstraint(
+        'blood_oxygen_level>=0 AND blood_oxygen_level<=100'),
+        nullable=True)  # Optional, 0-100 range
+    blood_glucose_level = Column(Float, CheckConstraint(
+        'blood_glucose_level>0'), nullable=True)  # Optional, positive
+    body_temperature = Column(Float, CheckConstraint(
+        'body_temperature>0'), nullable=True)  # Optional, positive
+
+    user = relationship("User", back_populates="health_metrics")
+
+    # Only the time of day in `time` is meaningful: older seed data stored
+    # an unrelated date there, so a reading was taken at `date` plus this
+    @hybrid_property
+    def time_of_day(self):
+        return self.time.time()
+
+    @time_of_day.expression
+    def time_of_day(cls):
+        # 'HH:MM:SS.SSS' text, which sorts in time order
+        return func.strftime('%H:%M:%f', cls.time)
+
+    # indexing user_id, date, and time for faster queries
+    # indexing by user_id first since it is more selective and commonly used
+    # date and time are commonly used for filtering but date is more important
+    __table_args__ = (
+        Index('idx_user_id_date_time_hm', 'user_id', 'date', 'time'),
+    )
+
+
+# BodyComposition class
+class BodyComposition(Base):
+    __tablename__ = 'body_compositions'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'),
+                     nullable=False)
+    date = Column(Date, nullable=False)
+
+    # Assuming weight can be optional but must be positive when provided
+    weight = Column(Float, CheckConstraint('weight>0'), nullable=True)
+    # height is assumed to be static and is provided in the user model
+    # bmi = Column(Float)  # I will calculate this dynamically
+
+    # detail body composition metrics
+    body_fat_percentage = Column(
+        Float, CheckConstraint(
+            'body_fat_percentage >= 0 AND body_fat_percentage <= 100'),
+        nullable=True)
+    skeletal_muscle_mass = Column(
+        Float, CheckConstraint('skeletal_muscle_mass > 0'),
+        nullable=True)
+    lean_body_mass = Column(
+        Float, CheckConstraint('lean_body_mass > 0'), nullable=True)
+    body_water = Column(
+        Float, CheckConstraint('body_water > 0'), nullable=True)
+    visceral_fat_level = Column(
+        Integer, CheckConstraint('visceral_fat_level >= 0'), nullable=True)
+    bone_mass = Column(Float, CheckConstraint('bone_mass > 0'), nullable=True)
+    basal_metabolic_rate = Column(
+        Integer, CheckConstraint('basal_metabolic_rate > 0'), nullable=True)
+    metabolic_age = Column(Integer, CheckConstraint('metabolic_age > 0'),
+                           nullable=True)
+
+    user = relationship("User", back_populates="body_compositions")
+
+    # indexing user_id and date for faster queries
+    # indexing by user_id first since it is more selective and commonly used
+    # id orders the rows of a day like the latest value lookups do, and
+    # basal_metabolic_rate and weight make those and the weight history
+    # index-only
+    __table_args__ = (
+        Index('idx_user_id_date_id_basal_metabolic_rate_weight_bc',
+              'user_id', 'date', 'id', 'basal_metabolic_rate', 'weight'),
+    )
+
+
+# Goal class
+
+# Define an enumeration for goal statuses
+class GoalStatusEnum(enum.Enum):
+    NOT_STARTED = "Not Started"
+    IN_PROGRESS = "In Progress"
+    ACHIEVED = "Achieved"
+    FAILED = "Failed"
+
+# Define an enumeration for goal types
+class GoalTypesEnum(enum.Enum):
+    WEIGHT_LOSS = "Weight Loss"
+    MUSCLE_GAIN = "Muscle Gain"
+    STAMINA_BUILDING = "Stamina Building"
+
+class Goal(Base):
+    __tablename__ = 'goals'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    # Use Enum for predefined goal types 
+    goal_type = Column(Enum(GoalTypesEnum), nullable=False)
+    target_value = Column(Float, CheckConstraint('target_value>=0'),
+                          nullable=False)  # Targets should be non-negative
+    current_value = Column(Float, CheckConstraint('current_value>=0'),
+                           nullable=False)  # values should be non-negative
+    deadline = Column(Date, nullable=True)  # A goal may not have a deadline
+    # Use Enum for predefined statuses
+    status = Column(Enum(GoalStatusEnum), nullable=False)
+
+    user = relationship("User", back_populates="goals")
+
+    # a user's goals by deadline, for finding the active goal
+    __table_args__ = (
+        Index('idx_user_id_deadline_g', 'user_id', 'deadline'),
+    )
+
+
+# DailyUserSummary class
+# Per-user, per-day totals of the meal, water, sleep and workout tables,
+# maintained by rollups.py whenever those rows change. Totals are stored
+# with their row counts, so averaging a date range gives exactly the
+# per-row averages of the source tables while reading one row per day.
+class DailyUserSummary(Base):
+    __tablename__ = 'daily_user_summary'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    date = Column(Date, primary_key=True)
+
+    # meals: servings_consumed * calories over the day's meal food items
+    calories_in = Column(Float, nullable=False, default=0)
+    meal_food_item_count = Column(Integer, nullable=False, default=0)
+    # water intake in liters
+    water = Column(Float, nullable=False, default=0)
+    water_intake_count = Column(Integer, nullable=False, default=0)
+    # sleep logs starting on this date
+    sleep_hours = Column(Float, nullable=False, default=0)
+    bedtime_hour_total = Column(Integer, nullable=False, default=0)
+    wakeup_hour_total = Column(Integer, nullable=False, default=0)
+    sleep_log_count = Column(Integer, nullable=False, default=0)
+    # workouts
+    calories_burned = Column(Float, nullable=False, default=0)
+    workout_minutes = Column(Float, nullable=False, default=0)
+    workout_intensity_total = Column(Integer, nullable=False, default=0)
+    workout_count = Column(Integer, nullable=False, default=0)
+
+
+# MealNutrientTotal class
+# Nutrition of each meal, the sum of servings_consumed times the food items'
+# nutrition per serving, maintained by rollups.py whenever meal food items or
+# food items change. user_id and date are copied from the meal so nutrition
+# reports read this table alone instead of joining meals, meal food items
+# and food items.
+class MealNutrientTotal(Base):
+    __tablename__ = 'meal_nutrient_totals'
+    meal_id = Column(Integer, ForeignKey('meals.id'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    date = Column(Date, nullable=False)
+    calories = Column(Float, nullable=False, default=0)
+    proteins = Column(Float, nullable=False, default=0)
+    carbs = Column(Float, nullable=False, default=0)
+    fats = Column(Float, nullable=False, default=0)
+    fiber = Column(Float, nullable=False, default=0)
+    food_item_count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('idx_user_id_date_mnt', 'user_id', 'date'),
+    )
+
+
+# MealVitaminTotal and MealMineralTotal classes
+# Amount of each vitamin and mineral in a meal, maintained like
+# MealNutrientTotal from the food items' vitamins and minerals
+class MealVitaminTotal(Base):
+    __tablename__ = 'meal_vitamin_totals'
+    meal_id = Column(Integer, ForeignKey('meals.id'), primary_key=True)
+    vitamin_id = Column(Integer, ForeignKey('vitamins.id'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    date = Column(Date, nullable=False)
+    amount = Column(Float, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('idx_user_id_date_mvt', 'user_id', 'date'),
+    )
+
+
+class MealMineralTotal(Base):
+    __tablename__ = 'meal_mineral_totals'
+    meal_id = Column(Integer, ForeignKey('meals.id'), primary_key=True)
+    mineral_id = Column(Integer, ForeignKey('minerals.id'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    date = Column(Date, nullable=False)
+    amount = Column(Float, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('idx_user_id_date_mmt', 'user_id', 'date'),
+    )
+
+
+# HealthMetricAggregates mixin
+# Per-vital statistics of the readings in a time bucket: the number of
+# non-NULL readings, their min, max and mean, and the latest one. The
+# statistics are NULL when the bucket has no reading of that vital.
+class HealthMetricAggregates:
+    heart_rate_count = Column(Integer, nullable=False, default=0)
+    heart_rate_min = Column(Float, nullable=True)
+    heart_rate_max = Column(Float, nullable=True)
+    heart_rate_mean = Column(Float, nullable=True)
+    heart_rate_last = Column(Float, nullable=True)
+    systolic_blood_pressure_count = Column(Integer, nullable=False, default=0)
+    systolic_blood_pressure_min = Column(Float, nullable=True)
+    systolic_blood_pressure_max = Column(Float, nullable=True)
+    systolic_blood_pressure_mean = Column(Float, nullable=True)
+    systolic_blood_pressure_last = Column(Float, nullable=True)
+    diastolic_blood_pressure_count = Column(Integer, nullable=False, default=0)
+    diastolic_blood_pressure_min = Column(Float, nullable=True)
+    diastolic_blood_pressure_max = Column(Float, nullable=True)
+    diastolic_blood_pressure_mean = Column(Float, nullable=True)
+    diastolic_blood_pressure_last = Column(Float, nullable=True)
+    blood_oxygen_level_count = Column(Integer, nullable=False, default=0)
+    blood_oxygen_level_min = Column(Float, nullable=True)
+    blood_oxygen_level_max = Column(Float, nullable=True)
+    blood_oxygen_level_mean = Column(Float, nullable=True)
+    blood_oxygen_level_last = Column(Float, nullable=True)
+    blood_glucose_level_count = Column(Integer, nullable=False, default=0)
+    blood_glucose_level_min = Column(Float, nullable=True)
+    blood_glucose_level_max = Column(Float, nullable=True)
+    blood_glucose_level_mean = Column(Float, nullable=True)
+    blood_glucose_level_last = Column(Float, nullable=True)
+    body_temperature_count = Column(Integer, nullable=False, default=0)
+    body_temperature_min = Column(Float, nullable=True)
+    body_temperature_max = Column(Float, nullable=True)
+    body_temperature_mean = Column(Float, nullable=True)
+    body_temperature_last = Column(Float, nullable=True)
+
+
+# HealthMetricHourly and HealthMetricDaily classes
+# Downsampling tiers of HealthMetric, one row per user and hour or day with
+# readings, maintained by rollups.py whenever readings change. Charts over
+# long ranges read these instead of every raw reading.
+class HealthMetricHourly(HealthMetricAggregates, Base):
+    __tablename__ = 'health_metric_hourly'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    date = Column(Date, primary_key=True)
+    hour = Column(Integer, CheckConstraint('hour>=0 AND hour<=23'),
+                  primary_key=True)
+
+
+class HealthMetricDaily(HealthMetricAggregates, Base):
+    __tablename__ = 'health_metric_daily'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    date = Column(Date, primary_key=True)
+
+
+# UserLatestState class
+# The latest body composition and health metric reading of each user, kept
+# by rollups.py as rows are written, so "most recent value" lookups read one
+# row by primary key instead of sorting the user's history. The latest body
+# composition is the one with the highest (date, id), the latest reading the
+# one with the highest (date, time, id); the columns are NULL until the user
+# has one.
+class UserLatestState(Base):
+    __tablename__ = 'user_latest_state'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+
+    # latest body composition
+    body_composition_id = Column(Integer, ForeignKey('body_compositions.id'),
+                                 nullable=True)
+    body_composition_date = Column(Date, nullable=True)
+    weight = Column(Float, nullable=True)
+    basal_metabolic_rate = Column(Integer, nullable=True)
+    skeletal_muscle_mass = Column(Float, nullable=True)
+
+    # latest health metric reading
+    health_metric_id = Column(Integer, ForeignKey('health_metrics.id'),
+                              nullable=True)
+    health_metric_date = Column(Date, nullable=True)
+    health_metric_time = Column(DateTime, nullable=True)
+    heart_rate = Column(Integer, nullable=True)
+    systolic_blood_pressure = Column(Integer, nullable=True)
+    diastolic_blood_pressure = Column(Integer, nullable=True)
+    blood_oxygen_level = Column(Float, nullable=True)
+    blood_glucose_level = Column(Float, nullable=True)
+    body_temperature = Column(Float, nullable=True)
+
+
+# Partition class
+# A past year of health_metrics, sleep_logs and meals rows moved out of the
+# main database file into a file of its own by partitions.py. The rows dated
+# from start_date up to, but not including, end_date are in the partition.
+class Partition(Base):
+    __tablename__ = 'partitions'
+    name = Column(String(32), primary_key=True)  # the year, e.g. '2023'
+    start_date = Column(Date, nullable=False)
+    end_date = Column(Date, nullable=False)
+
+
+# ArchiveStub class
+# A month of a user's rows of one table moved out of the hot database into
+# the compressed cold store by archive.py. The month's rows are read back
+# from the store on demand; row_count is how many it holds.
+class ArchiveStub(Base):
+    __tablename__ = 'archive_stubs'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    month = Column(Date, primary_key=True)  # its first day
+    table_name = Column(String(32), primary_key=True)
+    row_count = Column(Integer, nullable=False)
@@ -0,0 +1,446 @@
+# Time partitions
+# health_metrics, sleep_logs and meals get a row for every reading, night
+# and meal, so they are by far the largest tables. The rows of past years
+# can be moved out of the main database file into a partition file per year
+# next to it, health_and_fitness.2023.db for 2023, which every connection
+# attaches as partition_2023. The main file keeps the rows of the current
+# year, so its B-trees stay shallow and VACUUM stays quick, and dropping a
+# year of history is deleting its file.
+#
+# A partition holds the rows of those tables dated within its year and the
+# meal food items of its meals. Its days are closed: the ORM refuses to
+# write rows of any table summarized per day (see rollups.py) dated in a
+# partition, so the rollup tables, which stay in the main file, never need
+# its rows again; they keep covering a partition's days even once it is
+# dropped. Reads of the raw rows go through sources(), which names the
+# partitions overlapping a date range, and entity(), which maps a model onto
+# the copy of its table in a partition.
+#
+# With user shards (see shards.py) each shard file has partitions of its
+# own, health_and_fitness.shard0.2023.db and so on; the commands below go
+# through every shard.
+#
+#     python3 partitions.py create --before 2024
+#     python3 partitions.py list
+#     python3 partitions.py drop 2019
+from models import (
+    Base, Meal, WaterIntake, SleepLog, Workout, HealthMetric, Partition
+)
+from sqlalchemy import MetaData, event, inspect, select, delete
+from sqlalchemy.orm import Session, aliased
+from contextlib import contextmanager
+from datetime import date, datetime
+from functools import lru_cache
+import argparse
+import os
+import re
+import time
+
+# Tables split by the year of their date column
+PARTITIONED_TABLES = ['health_metrics', 'sleep_logs', 'meals']
+
+# Tables whose rows go with the partitioned row they belong to: table ->
+# (foreign key column, partitioned table)
+PARTITION_CHILDREN = {'meal_food_items': ('meal_id', 'meals')}
+
+# Models summarized per day by rollups.py; none of their rows can be
+# written for a day inside a partition
+CLOSED_DAY_MODELS = (Meal, WaterIntake, SleepLog, Workout, HealthMetric)
+
+# Header field of the main file holding the version of the partitions
+# registry, bumped whenever a partition is registered or dropped, so
+# connections re-read the partitions table only after a change.
+# user_version holds the schema version (see create.upgrade_schema).
+REGISTRY_VERSION_PRAGMA = 'application_id'
+
+# SQLite attaches at most 10 databases to a connection unless it was
+# compiled with a higher limit. The connections of a user shard also attach
+# the main database (see create.attach_common), leaving one less for
+# partitions.
+MAX_ATTACHED = 10
+
+
+class PartitionError(RuntimeError):
+    pass
+
+
+# Schema a partition is attached as
+def schema_name(name):
+    return f'partition_{name}'
+
+
+# Partition file of a year, next to the main database file
+def partition_path(main_path, name):
+    stem, extension = os.path.splitext(main_path)
+    return f'{stem}.{name}{extension or ".db"}'
+
+
+# Path of the main database file of a DB-API cursor's connection
+def _main_path(cursor):
+    cursor.execute('PRAGMA database_list')
+    path = next(row[2] for row in cursor.fetchall() if row[1] == 'main')
+    if not path:
+        raise PartitionError("An in-memory database cannot be partitioned.")
+    return path
+
+
+# Day of a date, datetime or ISO string bound, None for an open end
+def _day(value):
+    if value is None or isinstance(value, date) \
+            and not isinstance(value, datetime):
+        return value
+    if isinstance(value, datetime):
+        return value.date()
+    return date.fromisoformat(str(value)[:10])
+
+
+# Bump the version of the partitions registry (see attach_partitions) in
+# the transaction of connection, which changes the partitions table
+def _bump_registry_version(connection):
+    version = connection.exec_driver_sql(
+        f'PRAGMA main.{REGISTRY_VERSION_PRAGMA}').scalar()
+    connection.exec_driver_sql(
+        f'PRAGMA main.{REGISTRY_VERSION_PRAGMA}={version + 1}')
+
+
+# Keep the partitions attached to each connection of a SQLite engine in step
+# with the partitions table, every time the pool hands the connection out.
+# Only the registry version is read at checkout; the table is read again
+# when it has changed since the connection last synced. The (start, end)
+# range of each attached partition is kept by name in the connection's info
+# for sources(). For an AsyncEngine pass its sync_engine.
+def attach_partitions(engine):
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'checkout')
+    def sync_partitions(dbapi_connection, connection_record,
+                        connection_proxy):
+        info = connection_record.info
+        attached = info.setdefault('partitions', {})
+        cursor = dbapi_connection.cursor()
+        try:
+            # the table is missing until init_db() has created the schema
+            if not info.get('partitions_table'):
+                cursor.execute("SELECT count(*) FROM sqlite_master "
+                               "WHERE type = 'table' AND name = 'partitions'")
+                if not cursor.fetchone()[0]:
+                    return
+                info['partitions_table'] = True
+            cursor.execute(f'PRAGMA main.{REGISTRY_VERSION_PRAGMA}')
+            version = cursor.fetchone()[0]
+            if info.get('partitions_version') == version:
+                return
+            cursor.execute('SELECT name, start_date, end_date FROM partitions')
+            registered = {
+                name: (date.fromisoformat(start), date.fromisoformat(end))
+                for name, start, end in cursor.fetchall()}
+            for name in set(attached) - set(registered):
+                cursor.execute(f'DETACH DATABASE {schema_name(name)}')
+                del attached[name]
+            missing = sorted(set(registered) - set(attached))
+            if missing:
+                main_path = _main_path(cursor)
+            for name in missing:
+                cursor.execute(f'ATTACH DATABASE ? AS {schema_name(name)}',
+                               (partition_path(main_path, name),))
+                attached[name] = registered[name]
+            info['partitions_version'] = version
+        finally:
+            cursor.close()
+
+
+# Where the rows of the partitioned tables dated from start to end are: the
+# schema of each partition overlapping the range, oldest first, then None
+# for the main tables, which hold the newest rows (and the few older ones a
+# move leaves behind, see _kept_ids) and are always read.
+# start and end may be dates, datetimes or ISO strings, or None for an open
+# end. connection is a Connection, e.g. session.connection().
+def sources(connection, start=None, end=None):
+    start, end = _day(start), _day(end)
+    overlapping = sorted(
+        (first, name)
+        for name, (first, last) in connection.info.get('partitions',
+                                                       {}).items()
+        if (start is None or start < last) and (end is None or end >= first))
+    return tuple(schema_name(name) for _, name in overlapping) + (None,)
+
+
+# Schema of the partition holding the rows dated on a day, or None when the
+# day's rows are in the main tables
+def partition_of(connection, day):
+    return sources(connection, day, day)[0]
+
+
+_PARTITION_METADATA = MetaData()
+
+
+# The model itself for the main tables (schema None), or the model mapped
+# onto the copy of its table in a partition, to query like the model
+@lru_cache(maxsize=None)
+def entity(model, schema):
+    if schema is None:
+        return model
+    table = model.__table__.to_metadata(_PARTITION_METADATA, schema=schema)
+    return aliased(model, table, adapt_on_names=True)
+
+
+# Within the block, the partitioned tables read unqualified on connection
+# are TEMP views of their rows in the main file and every partition, which
+# SQLite finds before the main tables, so statements written for the main
+# tables, like the rollup rebuilds, read the whole history. Does nothing
+# when no partition is attached.
+@contextmanager
+def across_partitions(connection):
+    attached = connection.info.get('partitions')
+    if not attached:
+        yield
+        return
+    tables = PARTITIONED_TABLES + list(PARTITION_CHILDREN)
+    schemas = ['main'] + [schema_name(name) for name in sorted(attached)]
+    try:
+        for table in tables:
+            columns = ', '.join(Base.metadata.tables[table].columns.keys())
+            connection.exec_driver_sql(
+                f'CREATE TEMP VIEW {table} AS ' + ' UNION ALL '.join(
+                    f'SELECT {columns} FROM {schema}.{table}'
+                    for schema in schemas))
+        yield
+    finally:
+        for table in tables:
+            connection.exec_driver_sql(f'DROP VIEW IF EXISTS temp.{table}')
+
+
+# Current and previous dates of a flushed object
+def _dates(obj):
+    history = inspect(obj).attrs['date'].history
+    return {_day(day) for day in (*history.added, *history.unchanged,
+                                  *history.deleted) if day is not None}
+
+
+@event.listens_for(Session, 'before_flush')
+def _refuse_closed_days(session, flush_context, instances):
+    objects = [obj for obj in (*session.new, *session.dirty, *session.deleted)
+               if isinstance(obj, CLOSED_DAY_MODELS)]
+    if not objects:
+        return
+    connection = session.connection()
+    if not connection.info.get('partitions'):
+        return
+    for obj in objects:
+        for day in _dates(obj):
+            if partition_of(connection, day) is not None:
+                raise PartitionError(
+                    f"{day} is in a closed partition; "
+                    f"{type(obj).__name__} rows can no longer be written "
+                    f"for it.")
+
+
+# SQL creating the partitioned tables and their indexes in a partition,
+# copied from the main file's schema
+def _partition_ddl(connection, schema):
+    tables = PARTITIONED_TABLES + list(PARTITION_CHILDREN)
+    rows = connection.exec_driver_sql(
+        "SELECT sql FROM main.sqlite_master WHERE sql IS NOT NULL "
+        f"AND tbl_name IN ({', '.join('?' * len(tables))}) "
+        "ORDER BY type = 'index'", tuple(tables)).scalars()
+    return [re.sub(r'^(CREATE (?:UNIQUE )?(?:TABLE|INDEX) )',
+                   rf'\1IF NOT EXISTS {schema}.', sql) for sql in rows]
+
+
+# Ids of the rows a move leaves in the main file whatever their date: SQLite
+# gives a new row the highest id in its table plus one, so the rows holding
+# the highest ids stay behind to keep new ids from reusing moved ones
+def _kept_ids(connection):
+    kept = {table: set() for table in PARTITIONED_TABLES}
+    for table in PARTITIONED_TABLES:
+        kept[table].add(connection.exec_driver_sql(
+            f'SELECT max(id) FROM main.{table}').scalar())
+    for child, (column, parent) in PARTITION_CHILDREN.items():
+        kept[parent].add(connection.exec_driver_sql(
+            f'SELECT {column} FROM main.{child} '
+            'ORDER BY id DESC LIMIT 1').scalar())
+    return {table: sorted(ids - {None}) for table, ids in kept.items()}
+
+
+# Move a year's rows of the partitioned tables out of the main file into its
+# partition, creating and registering the partition if needed. Rows already
+# copied by an interrupted move are skipped, so running it again finishes
+# the move. Returns the number of rows moved per table.
+def move_year(engine, year):
+    if year >= date.today().year:
+        raise PartitionError(
+            f"{year} is not over yet; only past years can be partitioned.")
+    name = str(year)
+    schema = schema_name(name)
+    start, end = date(year, 1, 1).isoformat(), date(year + 1, 1, 1).isoformat()
+    with engine.connect() as connection:
+        attached = connection.info['partitions']
+        if name not in attached:
+            databases = connection.exec_driver_sql(
+                'PRAGMA database_list').all()
+            if sum(row[1] not in ('main', 'temp')
+                   for row in databases) >= MAX_ATTACHED:
+                raise PartitionError(
+                    f"SQLite attaches at most {MAX_ATTACHED} databases; "
+                    f"drop an old partition first.")
+            cursor = connection.connection.cursor()
+            try:
+                path = partition_path(_main_path(cursor), name)
+            finally:
+                cursor.close()
+            connection.exec_driver_sql(f'ATTACH DATABASE ? AS {schema}',
+                                       (path,))
+            # detached again at the next checkout unless registered below
+            attached[name] = (date(year, 1, 1), date(year + 1, 1, 1))
+            connection.info['partitions_version'] = None
+            for statement in _partition_ddl(connection, schema):
+                connection.exec_driver_sql(statement)
+            connection.commit()
+
+        kept = _kept_ids(connection)
+        tables = PARTITIONED_TABLES + list(PARTITION_CHILDREN)
+        conditions = {}
+        for table in PARTITIONED_TABLES:
+            conditions[table] = (
+                f'date >= ? AND date < ? AND id NOT IN '
+                f'({", ".join("?" * len(kept[table]))})',
+                (start, end, *kept[table]))
+        for child, (column, parent) in PARTITION_CHILDREN.items():
+            condition, parameters = conditions[parent]
+            conditions[child] = (
+                f'{column} IN (SELECT id FROM main.{parent} '
+                f'WHERE {condition})', parameters)
+
+        # copy into the partition, then delete from the main file and
+        # register the partition in one transaction, so readers find every
+        # row in exactly one place
+        for table in tables:
+            columns = ', '.join(Base.metadata.tables[table].columns.keys())
+            condition, parameters = conditions[table]
+            connection.exec_driver_sql(
+                f'INSERT OR IGNORE INTO {schema}.{table} ({columns}) '
+                f'SELECT {columns} FROM main.{table} WHERE {condition}',
+                parameters)
+        connection.commit()
+
+        moved = {}
+        # children first, while their parents are still there to match
+        for table in reversed(tables):
+            condition, parameters = conditions[table]
+            moved[table] = connection.exec_driver_sql(
+                f'DELETE FROM main.{table} WHERE {condition}',
+                parameters).rowcount
+        connection.exec_driver_sql(
+            'INSERT OR IGNORE INTO main.partitions '
+            '(name, start_date, end_date) VALUES (?, ?, ?)',
+            (name, start, end))
+        _bump_registry_version(connection)
+        connection.commit()
+    return moved
+
+
+# Move every year before the given one that still has rows in the main file
+# into its partition. Returns the rows moved per table, by year.
+def create_partitions(engine, before):
+    with engine.connect() as connection:
+        years = set()
+        for table in PARTITIONED_TABLES:
+            years |= set(connection.exec_driver_sql(
+                f"SELECT DISTINCT CAST(strftime('%Y', date) AS INTEGER) "
+                f"FROM main.{table} WHERE date < ?",
+                (date(before, 1, 1).isoformat(),)).scalars())
+    return {year: move_year(engine, year) for year in sorted(years)}
+
+
+# Drop a partition and delete its file. The rollup tables keep its days.
+def drop_partition(engine, name):
+    with engine.begin() as connection:
+        cursor = connection.connection.cursor()
+        try:
+            path = partition_path(_main_path(cursor), name)
+        finally:
+            cursor.close()
+        dropped = connection.execute(
+            delete(Partition).where(Partition.name == name)).rowcount
+        if dropped:
+            _bump_registry_version(connection)
+    if not dropped:
+        raise PartitionError(f"There is no partition {name}.")
+    # idle connections let go of the file; the ones in use detach it at
+    # their next checkout
+    engine.dispose()
+    for leftover in (path, path + '-journal', path + '-wal', path + '-shm'):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    return path
+
+
+# Each partition's name, date range and rows per partitioned table, oldest
+# first, then the same for the rows left in the main file
+def partition_rows(engine):
+    with engine.connect() as connection:
+        partitions = connection.execute(select(
+            Partition.name, Partition.start_date, Partition.end_date
+        ).order_by(Partition.start_date)).all()
+        places = [(schema_name(name), name, start, end)
+                  for name, start, end in partitions]
+        places.append(('main', 'main', None, None))
+        return [(name, start, end, {
+            table: connection.exec_driver_sql(
+                f'SELECT count(*) FROM {schema}.{table}').scalar()
+            for table in PARTITIONED_TABLES})
+            for schema, name, start, end in places]
+
+
+if __name__ == "__main__":
+    from create import init_db, user_engines
+
+    parser = argparse.ArgumentParser(
+        description="Move past years of the high-volume tables into "
+                    "partition files.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    create = commands.add_parser(
+        'create', help="move every year before a year into its partition")
+    create.add_argument('--before', type=int, default=date.today().year,
+                        help="first year left in the main file "
+                             "(default: the current year)")
+    create.add_argument('--vacuum', action='store_true',
+                        help="VACUUM the main file afterwards to give the "
+                             "freed pages back")
+    commands.add_parser('list', help="list the partitions and their rows")
+    drop = commands.add_parser('drop', help="drop a partition")
+    drop.add_argument('name', help="partition to drop, e.g. 2019")
+    args = parser.parse_args()
+    init_db()
+    # every user shard has partitions of its own
+    engines = user_engines()
+    started = time.perf_counter()
+    dropped = []
+
+    for engine in engines:
+        if len(engines) > 1:
+            print(f"{engine.url.database}:")
+        if args.command == 'create':
+            for year, moved in create_partitions(engine, args.before).items():
+                print(f"{year}: moved " + ', '.join(
+                    f"{count} {table}" for table, count in moved.items()))
+            if args.vacuum:
+                with engine.connect() as connection:
+                    connection.exec_driver_sql('VACUUM main')
+        elif args.command == 'list':
+            for name, start, end, rows in partition_rows(engine):
+                dates = f"{start} to {end}" if start else "everything else"
+                print(f"{name:>6}  {dates:<24}  " + ', '.join(
+                    f"{count} {table}" for table, count in rows.items()))
+        elif args.command == 'drop':
+            with engine.connect() as connection:
+                partitioned = args.name in connection.info['partitions']
+            if partitioned:
+                dropped.append(drop_partition(engine, args.name))
+                print(f"Deleted {dropped[-1]}")
+
+    if args.command == 'create':
+        print(f"Done in {time.perf_counter() - started:.2f}s")
+    elif args.command == 'drop' and not dropped:
+        raise PartitionError(f"There is no partition {args.name}.")
@@ -0,0 +1,383 @@
+# Async versions of the query_data scenarios
+# For asyncio servers: every scenario is a coroutine with the same name,
+# arguments and result as in query_data, running over SQLAlchemy's asyncio
+# extension and the aiosqlite driver. Instead of query_data's shared
+# module-level session, each call opens its own AsyncSession on a pooled
+# connection, of the user's shard when sharded, or uses the one passed as
+# session= to run several scenarios on one connection. Call init_async_db()
+# once at startup.
+import create
+from create import init_db, apply_tuning_profile, attach_common
+from partitions import attach_partitions, sources, partition_of, entity
+from archive import archived_rows
+from query_data import (
+    INTENSITY_SCORES, summary_average, food_item_count_since,
+    recommended_water_intake, calorie_intake_suggestion,
+    fitness_level_feedback, sleep_duration_feedback,
+    sleep_consistency_feedback, dietary_diversity_feedback,
+    goal_progress, goal_progress_feedback, bmi_feedback, nutrient_report,
+    add_archived_workouts
+)
+from models import (
+    MEAL_NUTRIENTS, DailyUserSummary, MealNutrientTotal, MealVitaminTotal,
+    MealMineralTotal, User, Workout, Vitamin, Mineral, HealthMetric,
+    BodyComposition, Goal, GoalTypesEnum, UserLatestState
+)
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+import asyncio
+import os
+
+# Connections the async engine keeps open. Coroutines beyond this wait for
+# a free connection without blocking the event loop; SQLite runs one writer
+# at a time anyway, so more connections mostly add lock contention.
+ASYNC_POOL_SIZE = 10
+
+async_engine = None
+# Async engines of the shards, in shard order; empty when not sharded
+async_shard_engines = []
+# Session factory, bound to async_engine by init_async_db(). Objects stay
+# usable after the session that loaded them is closed.
+AsyncSession = async_sessionmaker(expire_on_commit=False)
+
+
+# Async engine on the database of a sync engine, with the same tuning
+# profile
+def _async_engine(engine, profile, pool_size):
+    async_url = engine.url
+    if async_url.get_backend_name() == 'sqlite':
+        async_url = async_url.set(drivername='sqlite+aiosqlite')
+    new_engine = create_async_engine(async_url, echo=engine.echo,
+                                     pool_size=pool_size, max_overflow=0)
+    apply_tuning_profile(
+        new_engine.sync_engine,
+        profile or os.environ.get('HEALTH_DB_PROFILE', 'default'))
+    return new_engine
+
+
+# Create the schema through the sync engines if needed, then the async
+# engines on the same databases, the main one and every shard
+def init_async_db(url=None, echo=None, profile=None,
+                  pool_size=ASYNC_POOL_SIZE, shards=None):
+    global async_engine, async_shard_engines
+    engine = init_db(url, echo, profile, shards=shards)
+    async_engine = _async_engine(engine, profile, pool_size)
+    attach_partitions(async_engine.sync_engine)
+    async_shard_engines = []
+    for index, shard_engine in enumerate(create.shard_engines):
+        async_shard_engine = _async_engine(shard_engine, profile, pool_size)
+        attach_common(async_shard_engine.sync_engine,
+                      os.path.abspath(engine.url.database), index,
+                      len(create.shard_engines))
+        attach_partitions(async_shard_engine.sync_engine)
+        async_shard_engines.append(async_shard_engine)
+    AsyncSession.configure(bind=async_engine)
+    return async_engine
+
+
+# The caller's session, or a new one closed when the block ends, on the
+# shard of user_id when sharded
+@asynccontextmanager
+async def _session(session=None, user_id=None):
+    if session is not None:
+        yield session
+        return
+    bind = {}
+    if user_id is not None and async_shard_engines:
+        bind['bind'] = async_shard_engines[create.shard_of(user_id)]
+    async with AsyncSession(**bind) as new_session:
+        yield new_session
+
+
+# A user's archived workouts within a date range (see archive.py), for
+# AsyncSession.run_sync
+def _archived_workouts(session, user_id, start_date, end_date):
+    return archived_rows(session.connection(), Workout, [user_id],
+                         start_date, end_date)
+
+
+# Scenario 1: Get all workouts for a specific user within a date range
+async def get_workouts_by_user_and_date(user_id, start_date, end_date,
+                                        session=None):
+    async with _session(session, user_id) as session:
+        workouts = await session.scalars(select(Workout).where(
+            Workout.user_id == user_id,
+            Workout.date.between(start_date, end_date)))
+        workouts = workouts.all()
+        # archived months (see archive.py) are read from the cold store
+        # with a blocking call, only for ranges reaching back that far
+        archived = await session.run_sync(_archived_workouts, user_id,
+                                          start_date, end_date)
+        if archived:
+            workouts = sorted(archived + workouts,
+                              key=lambda workout: workout.date)
+        return workouts
+
+
+# Scenario 2: Calculate the average calories consumed per day by a user
+async def average_daily_calories(user_id, start_date, end_date, session=None):
+    async with _session(session, user_id) as session:
+        return await session.scalar(select(
+            summary_average(DailyUserSummary.calories_in,
+                            DailyUserSummary.meal_food_item_count)
+        ).where(
+            DailyUserSummary.user_id == user_id,
+            DailyUserSummary.date.between(start_date, end_date)))
+
+
+# Scenario 3: Analyze average sleep duration over the last month
+async def average_sleep_duration_last_month(user_id, session=None):
+    one_month_ago = datetime.now() - timedelta(days=30)
+    async with _session(session, user_id) as session:
+        return await session.scalar(select(
+            summary_average(DailyUserSummary.sleep_hours,
+                            DailyUserSummary.sleep_log_count)
+        ).where(
+            DailyUserSummary.user_id == user_id,
+            DailyUserSummary.date >= one_month_ago))
+
+
+# Scenario 4: Track weight change over the past year
+async def weight_change_past_year(user_id, session=None):
+    one_year_ago = datetime.now() - timedelta(days=365)
+    async with _session(session, user_id) as session:
+        weights = await session.execute(select(
+            BodyComposition.date, BodyComposition.weight
+        ).where(
+            BodyComposition.user_id == user_id,
+            BodyComposition.date >= one_year_ago
+        ).order_by(BodyComposition.date.asc()))
+        return weights.all()
+
+
+# Scenario 5: Get the last recorded health metrics for a user
+async def last_recorded_health_metrics(user_id, session=None):
+    async with _session(session, user_id) as session:
+        last_metrics = await session.scalar(select(HealthMetric).join(
+            UserLatestState,
+            UserLatestState.health_metric_id == HealthMetric.id
+        ).where(UserLatestState.user_id == user_id))
+        if last_metrics is not None:
+            return last_metrics
+        # unless it has been moved to a partition
+        latest = await session.get(UserLatestState, user_id)
+        if latest is None or latest.health_metric_id is None:
+            return None
+        connection = await session.connection()
+        schema = partition_of(connection.sync_connection,
+                              latest.health_metric_date)
+        if schema is None:
+            return None
+        reading = entity(HealthMetric, schema)
+        return await session.scalar(select(reading).where(
+            reading.id == latest.health_metric_id))
+
+
+# Scenario 6: Recommend water intake based on recent water intake data
+async def recommend_water_intake(user_id, session=None):
+    recent_date = datetime.now() - timedelta(days=7)
+    async with _session(session, user_id) as session:
+        avg_water_intake = await session.scalar(select(
+            summary_average(DailyUserSummary.water,
+                            DailyUserSummary.water_intake_count)
+        ).where(
+            DailyUserSummary.user_id == user_id,
+            DailyUserSummary.date >= recent_date))
+        user_gender = await session.scalar(
+            select(User.gender).where(User.id == user_id))
+    return avg_water_intake, recommended_water_intake(user_gender)
+
+
+# Scenario 7: Suggest calories intake based on user's goals and recent
+# calorie intake
+async def suggest_calories_intake(user_id, custom_goal_calories=None,
+                                  session=None):
+    async with _session(session, user_id) as session:
+        if custom_goal_calories is None:
+            latest_bmr = (await session.execute(select(
+                UserLatestState.body_composition_id,
+                UserLatestState.basal_metabolic_rate
+            ).where(UserLatestState.user_id == user_id))).first()
+            if latest_bmr is None or latest_bmr.body_composition_id is None:
+                return "No body composition data available to suggest nutritional improvements."
+            goal_calories = latest_bmr.basal_metabolic_rate
+        else:
+            goal_calories = custom_goal_calories
+
+        avg_calories = await average_daily_calories(
+            user_id, datetime.now() - timedelta(days=30), datetime.now(),
+            session=session)
+    return calorie_intake_suggestion(avg_calories, goal_calories)
+
+
+# Scenario 8: Feedback on the user's fitness level from the intensity of
+# recent workouts
+async def assess_fitness_level(user_id, session=None):
+    async with _session(session, user_id) as session:
+        average_intensity = await session.scalar(select(
+            summary_average(DailyUserSummary.workout_intensity_total,
+                            DailyUserSummary.workout_count)
+        ).where(
+            DailyUserSummary.user_id == user_id,
+            DailyUserSummary.date.between(
+                datetime.now() - timedelta(days=30), datetime.now())))
+    return fitness_level_feedback(average_intensity)
+
+
+# Scenario 9: Tips to improve sleep quality from the recent sleep duration
+async def sleep_duration_tips(user_id, session=None):
+    avg_sleep_duration = await average_sleep_duration_last_month(
+        user_id, session=session)
+    return sleep_duration_feedback(avg_sleep_duration)
+
+
+# Scenario 10: Tips to improve sleep consistency from recent bedtimes and
+# wake-up times
+async def sleep_consistency_tips(user_id, session=None):
+    recent_date = datetime.now() - timedelta(days=30)
+    async with _session(session, user_id) as session:
+        avg_bedtime_hour, avg_wakeup_hour = (await session.execute(select(
+            summary_average(DailyUserSummary.bedtime_hour_total,
+                            DailyUserSummary.sleep_log_count),
+            summary_average(DailyUserSummary.wakeup_hour_total,
+                            DailyUserSummary.sleep_log_count)
+        ).where(
+            DailyUserSummary.user_id == user_id,
+            DailyUserSummary.date >= recent_date))).one()
+    return sleep_consistency_feedback(avg_bedtime_hour, avg_wakeup_hour)
+
+
+# Scenario 11: Tips to improve dietary diversity from the number of unique
+# food items consumed
+async def dietary_diversity_tips(user_id, session=None):
+    recent_date = datetime.now() - timedelta(days=30)
+    async with _session(session, user_id) as session:
+        # the meals of the last month may start in a partition
+        connection = await session.connection()
+        recent_food_items_count = await session.scalar(
+            food_item_count_since(sources(connection.sync_connection,
+                                          recent_date)),
+            dict(user_id=user_id, since=recent_date))
+    return dietary_diversity_feedback(recent_food_items_count)
+
+
+# Scenario 12: Track goal progress based on the latest body composition and
+# workout data
+async def track_goal_progress(user_id, session=None):
+    current_date = datetime.now()
+    progress = None
+    async with _session(session, user_id) as session:
+        goal = await session.scalar(select(Goal).where(
+            Goal.user_id == user_id,
+            Goal.deadline >= current_date
+        ).order_by(Goal.deadline.desc(), Goal.id.desc()).limit(1))
+
+        goal_type = goal.goal_type if goal is not None else None
+        if goal_type in (GoalTypesEnum.WEIGHT_LOSS,
+                         GoalTypesEnum.MUSCLE_GAIN):
+            latest = await session.get(UserLatestState, user_id)
+            if latest is not None and latest.body_composition_id is not None:
+                progress = goal_progress(
+                    goal, latest_weight=latest.weight,
+                    latest_muscle_mass=latest.skeletal_muscle_mass)
+        elif goal_type == GoalTypesEnum.STAMINA_BUILDING:
+            intensities = (await session.scalars(select(
+                Workout.intensity
+            ).where(
+                Workout.user_id == user_id,
+                Workout.date >= current_date - timedelta(days=30)))).all()
+            progress = goal_progress(
+                goal, total_intensity=sum(INTENSITY_SCORES[intensity]
+                                          for intensity in intensities),
+                workout_count=len(intensities))
+    return goal_progress_feedback(goal, progress)
+
+
+# Scenario 13: Calculate the BMI for a user
+async def calculate_user_bmi(user_id, session=None):
+    async with _session(session, user_id) as session:
+        user_height = await session.scalar(
+            select(User.height).where(User.id == user_id))
+        latest_weight = await session.scalar(select(
+            UserLatestState.weight
+        ).where(UserLatestState.user_id == user_id))
+    return bmi_feedback(user_id, user_height, latest_weight)
+
+
+# Scenario 14: Summarize the most frequent workout types and their total
+# duration
+async def summarize_frequent_workouts(user_id, start_date, end_date,
+                                      session=None):
+    async with _session(session, user_id) as session:
+        workouts_summary = await session.execute(select(
+            Workout.type,
+            func.count(Workout.id).label("sessions"),
+            func.sum(Workout.duration).label("total_duration")
+        ).where(
+            Workout.user_id == user_id,
+            Workout.date.between(start_date, end_date)
+        ).group_by(Workout.type).order_by(func.count(Workout.id).desc()))
+        summary = [{
+            "workout_type": workout.type,
+            "sessions": workout.sessions,
+            "total_duration": workout.total_duration
+        } for workout in workouts_summary]
+        return add_archived_workouts(summary, await session.run_sync(
+            _archived_workouts, user_id, start_date, end_date))
+
+
+# Scenario 15: Calories, macronutrients, vitamins and minerals consumed
+# within a date range
+async def nutrient_intake_report(user_id, start_date, end_date,
+                                 session=None):
+    async with _session(session, user_id) as session:
+        totals = (await session.execute(select(
+            *[func.total(getattr(MealNutrientTotal, name))
+              for name in MEAL_NUTRIENTS]
+        ).where(
+            MealNutrientTotal.user_id == user_id,
+            MealNutrientTotal.date.between(start_date, end_date)))).one()
+
+        micronutrients = []
+        for total, nutrient in ((MealVitaminTotal, Vitamin),
+                                (MealMineralTotal, Mineral)):
+            amounts = await session.execute(select(
+                nutrient.name, func.sum(total.amount)
+            ).join(nutrient).where(
+                total.user_id == user_id,
+                total.date.between(start_date, end_date)
+            ).group_by(nutrient.id).order_by(nutrient.name, nutrient.id))
+            micronutrients.append([(name, amount)
+                                   for name, amount in amounts])
+    return nutrient_report(totals, *micronutrients)
+
+
+# Usage example
+async def main():
+    # independent scenarios run concurrently, each on its own session
+    print(await asyncio.gather(
+        get_workouts_by_user_and_date(17, '2023-04-01', '2024-01-31'),
+        average_daily_calories(36, '2023-04-01', '2024-01-31'),
+        average_sleep_duration_last_month(34),
+        weight_change_past_year(48),
+        last_recorded_health_metrics(27),
+        recommend_water_intake(29),
+        suggest_calories_intake(45),
+        assess_fitness_level(12),
+        sleep_duration_tips(34),
+        sleep_consistency_tips(34),
+        dietary_diversity_tips(17),
+        track_goal_progress(42),
+        calculate_user_bmi(23),
+        summarize_frequent_workouts(23, '2023-04-01', '2024-01-31'),
+        nutrient_intake_report(36, '2023-04-01', '2024-01-31'),
+    ))
+    for engine in [async_engine] + async_shard_engines:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    init_async_db()
+    asyncio.run(main())
@@ -0,0 +1,489 @@
+# Batch versions of the query_data scenarios
+# Each function takes a list of user ids, or None for every user, and answers
+# the scenario for all of them with one grouped query (or a few, for the
+# scenarios that combine several tables). The result is a dict keyed by user
+# id, with the same values the per-user function would return. When the
+# database is sharded, each function runs on every shard at once (see
+# _across_shards).
+import create
+from query_data import (
+    session, INTENSITY_SCORES, summary_average,
+    recommended_water_intake, calorie_intake_suggestion,
+    fitness_level_feedback, sleep_duration_feedback,
+    sleep_consistency_feedback, dietary_diversity_feedback,
+    goal_progress, goal_progress_feedback, bmi_feedback, nutrient_report,
+    add_archived_workouts
+)
+from models import (
+    MEAL_NUTRIENTS, User, Workout, Vitamin, Mineral, Meal, MealFoodItem,
+    HealthMetric, BodyComposition, Goal, GoalTypesEnum, DailyUserSummary,
+    MealNutrientTotal, MealVitaminTotal, MealMineralTotal
+)
+from partitions import sources, entity
+from archive import archived_rows
+from shards import fan_out, ids_by_shard
+from sqlalchemy import func, distinct, case, select, union_all
+from sqlalchemy.orm import aliased
+from datetime import datetime, timedelta
+from functools import wraps
+import threading
+
+# SQLite caps the number of bound parameters in one statement (32766 since
+# 3.32), so explicit id lists are split into chunks of this size
+MAX_IDS_PER_QUERY = 30000
+
+
+# The (index, count) of the shard a worker thread of _across_shards answers
+# for, and whether the thread is inside a batch function
+_worker = threading.local()
+
+
+# Run function with the query_data session of the thread replaced by a
+# short-lived read session, closed when it returns so its connection goes
+# back to the pool and no loaded object outlives the call. A session the
+# thread had already opened is put back afterwards.
+def _in_session(read_session, function, *args, **kwargs):
+    previous = session.registry() if session.registry.has() else None
+    session.registry.set(read_session)
+    _worker.busy = True
+    try:
+        return function(*args, **kwargs)
+    finally:
+        _worker.busy = False
+        session.remove()
+        if previous is not None:
+            session.registry.set(previous)
+
+
+# Run a batch function in a session of its own (see _in_session), on every
+# shard at once when the database is sharded. Each shard gets a worker
+# thread whose query_data session is bound to it and answers for the given
+# users stored there, or for all of them (see _for_users), and the per-user
+# results are merged. Batch functions called by another one share its
+# session.
+def _across_shards(function):
+    @wraps(function)
+    def run(user_ids=None, *args, **kwargs):
+        if getattr(_worker, 'busy', False):
+            return function(user_ids, *args, **kwargs)
+        if not create.shard_engines:
+            return _in_session(create.ReadSession(), function, user_ids,
+                               *args, **kwargs)
+        grouped = None if user_ids is None else ids_by_shard(user_ids)
+
+        def on_shard(index, engine):
+            _worker.shard = (index, len(create.shard_engines))
+            try:
+                return _in_session(
+                    create.ReadSession(bind=engine), function,
+                    None if grouped is None else grouped[index],
+                    *args, **kwargs)
+            finally:
+                _worker.shard = None
+
+        results = {}
+        for shard_results in fan_out(on_shard):
+            results.update(shard_results)
+        return results
+    return run
+
+
+# Run query once per chunk of user ids, or once unfiltered for all users
+# (all the users of the shard in a worker of _across_shards, since a query
+# starting from the users table sees every user)
+def _for_users(query, user_column, user_ids):
+    if user_ids is None:
+        shard = getattr(_worker, 'shard', None)
+        if shard is not None:
+            index, count = shard
+            query = query.filter(user_column % count == index)
+        yield from query
+        return
+    user_ids = list(user_ids)
+    for start in range(0, len(user_ids), MAX_IDS_PER_QUERY):
+        chunk = user_ids[start:start + MAX_IDS_PER_QUERY]
+        yield from query.filter(user_column.in_(chunk))
+
+
+# The users a batch answers for: the given ids, or every user
+def _all_user_ids(user_ids):
+    if user_ids is not None:
+        return list(user_ids)
+    return [user_id for user_id, in _for_users(session.query(User.id),
+                                               User.id, None)]
+
+
+# Latest row per user of a model with user_id and date columns. Ties on the
+# date go to the highest id, the row the per-user functions' index scan
+# returns first.
+def _latest_per_user(model, *order_by):
+    order_by = order_by or (model.date.desc(),)
+    ranked = session.query(
+        model.id.label('id'),
+        func.row_number().over(partition_by=model.user_id,
+                               order_by=order_by + (model.id.desc(),)
+                               ).label('rank')
+    ).subquery()
+    return session.query(model).join(
+        ranked, model.id == ranked.c.id).filter(ranked.c.rank == 1)
+
+
+# Per-user average of a daily_user_summary total (see
+# query_data.summary_average); users without rows get None
+def _summary_averages(total, count, user_ids, *filters):
+    query = session.query(
+        DailyUserSummary.user_id, summary_average(total, count)
+    ).filter(*filters).group_by(DailyUserSummary.user_id)
+    results = dict.fromkeys(user_ids or [])
+    results.update(_for_users(query, DailyUserSummary.user_id, user_ids))
+    return results
+
+
+# Archived workouts within a date range (see archive.py) of the given users,
+# or every user if None, grouped by user
+def _archived_workouts(user_ids, start_date, end_date):
+    workouts = {}
+    for workout in archived_rows(session.connection(), Workout, user_ids,
+                                 start_date, end_date):
+        workouts.setdefault(workout.user_id, []).append(workout)
+    return workouts
+
+
+# Scenario 1: Workouts for many users within a date range
+@_across_shards
+def get_workouts_by_users_and_date(user_ids, start_date, end_date):
+    query = session.query(Workout).filter(
+        Workout.date.between(start_date, end_date)
+    ).order_by(Workout.user_id, Workout.date)
+    workouts = {user_id: [] for user_id in user_ids or []}
+    for workout in _for_users(query, Workout.user_id, user_ids):
+        workouts.setdefault(workout.user_id, []).append(workout)
+    # the range may reach back into archived months (see archive.py)
+    for user_id, rows in _archived_workouts(
+            user_ids, start_date, end_date).items():
+        workouts[user_id] = sorted(rows + workouts.get(user_id, []),
+                                   key=lambda workout: workout.date)
+    return workouts
+
+
+# Scenario 2: Average calories consumed per day, per user
+@_across_shards
+def average_daily_calories_batch(user_ids, start_date, end_date):
+    return _summary_averages(
+        DailyUserSummary.calories_in, DailyUserSummary.meal_food_item_count,
+        user_ids, DailyUserSummary.date.between(start_date, end_date))
+
+
+# Scenario 3: Average sleep duration over the last month, per user
+@_across_shards
+def average_sleep_duration_last_month_batch(user_ids=None):
+    one_month_ago = datetime.now() - timedelta(days=30)
+    return _summary_averages(
+        DailyUserSummary.sleep_hours, DailyUserSummary.sleep_log_count,
+        user_ids, DailyUserSummary.date >= one_month_ago)
+
+
+# Scenario 4: Weight change over the past year, per user
+@_across_shards
+def weight_change_past_year_batch(user_ids=None):
+    one_year_ago = datetime.now() - timedelta(days=365)
+    query = session.query(
+        BodyComposition.user_id,
+        BodyComposition.date,
+        BodyComposition.weight
+    ).filter(
+        BodyComposition.date >= one_year_ago
+    ).order_by(BodyComposition.user_id, BodyComposition.date.asc())
+    weights = {user_id: [] for user_id in user_ids or []}
+    for user_id, date, weight in _for_users(query, BodyComposition.user_id,
+                                            user_ids):
+        weights.setdefault(user_id, []).append((date, weight))
+    return weights
+
+
+# Scenario 5: Last recorded health metrics, per user. The latest reading of
+# each source of the readings is compared, since a user's newest readings
+# may have been moved to a partition.
+@_across_shards
+def last_recorded_health_metrics_batch(user_ids=None):
+    metrics = dict.fromkeys(user_ids or [])
+    for schema in sources(session.connection()):
+        reading = entity(HealthMetric, schema)
+        query = _latest_per_user(reading, reading.date.desc(),
+                                 reading.time.desc())
+        for metric in _for_users(query, reading.user_id, user_ids):
+            current = metrics.get(metric.user_id)
+            if current is None or (metric.date, metric.time, metric.id) \
+                    > (current.date, current.time, current.id):
+                metrics[metric.user_id] = metric
+    return metrics
+
+
+# Scenario 6: Recent and recommended water intake, per user
+@_across_shards
+def recommend_water_intake_batch(user_ids=None):
+    recent_date = datetime.now() - timedelta(days=7)
+    recent_intake = session.query(
+        DailyUserSummary.user_id.label('user_id'),
+        summary_average(DailyUserSummary.water,
+                        DailyUserSummary.water_intake_count).label('average')
+    ).filter(
+        DailyUserSummary.date >= recent_date
+    ).group_by(DailyUserSummary.user_id).subquery()
+    query = session.query(
+        User.id, recent_intake.c.average, User.gender
+    ).outerjoin(recent_intake, recent_intake.c.user_id == User.id)
+    # unknown users get the per-user function's answer
+    results = dict.fromkeys(user_ids or [],
+                            (None, recommended_water_intake(None)))
+    results.update((user_id, (average, recommended_water_intake(gender)))
+                   for user_id, average, gender in _for_users(query, User.id,
+                                                              user_ids))
+    return results
+
+
+# Scenario 7: Calorie intake suggestions, per user
+@_across_shards
+def suggest_calories_intake_batch(user_ids=None, custom_goal_calories=None):
+    user_ids = _all_user_ids(user_ids)
+    now = datetime.now()
+    avg_calories = average_daily_calories_batch(
+        user_ids, now - timedelta(days=30), now)
+    if custom_goal_calories is not None:
+        goal_calories = dict.fromkeys(user_ids, custom_goal_calories)
+    else:
+        # Use the most recent BMR of each user as the default goal
+        query = _latest_per_user(BodyComposition)
+        goal_calories = {
+            latest.user_id: latest.basal_metabolic_rate
+            for latest in _for_users(query, BodyComposition.user_id,
+                                     user_ids)}
+
+    suggestions = {}
+    for user_id in user_ids:
+        if user_id not in goal_calories:
+            suggestions[user_id] = "No body composition data available to suggest nutritional improvements."
+        else:
+            suggestions[user_id] = calorie_intake_suggestion(
+                avg_calories.get(user_id), goal_calories[user_id])
+    return suggestions
+
+
+# Score of a workout's intensity, computed in SQL
+def _intensity_score():
+    return case(INTENSITY_SCORES, value=Workout.intensity)
+
+
+# Scenario 8: Fitness level feedback from last month's workouts, per user
+@_across_shards
+def assess_fitness_level_batch(user_ids=None):
+    user_ids = _all_user_ids(user_ids)
+    now = datetime.now()
+    averages = _summary_averages(
+        DailyUserSummary.workout_intensity_total,
+        DailyUserSummary.workout_count, user_ids,
+        DailyUserSummary.date.between(now - timedelta(days=30), now))
+    return {user_id: fitness_level_feedback(average)
+            for user_id, average in averages.items()}
+
+
+# Scenario 9: Sleep duration tips, per user
+@_across_shards
+def sleep_duration_tips_batch(user_ids=None):
+    user_ids = _all_user_ids(user_ids)
+    averages = average_sleep_duration_last_month_batch(user_ids)
+    return {user_id: sleep_duration_feedback(average)
+            for user_id, average in averages.items()}
+
+
+# Scenario 10: Sleep consistency tips, per user
+@_across_shards
+def sleep_consistency_tips_batch(user_ids=None):
+    user_ids = _all_user_ids(user_ids)
+    recent_date = datetime.now() - timedelta(days=30)
+    query = session.query(
+        DailyUserSummary.user_id,
+        summary_average(DailyUserSummary.bedtime_hour_total,
+                        DailyUserSummary.sleep_log_count),
+        summary_average(DailyUserSummary.wakeup_hour_total,
+                        DailyUserSummary.sleep_log_count)
+    ).filter(
+        DailyUserSummary.date >= recent_date
+    ).group_by(DailyUserSummary.user_id)
+    hours = {user_id: (None, None) for user_id in user_ids}
+    for user_id, bedtime, wakeup in _for_users(
+            query, DailyUserSummary.user_id, user_ids):
+        hours[user_id] = (bedtime, wakeup)
+    return {user_id: sleep_consistency_feedback(bedtime, wakeup)
+            for user_id, (bedtime, wakeup) in hours.items()}
+
+
+# Scenario 11: Dietary diversity tips, per user
+@_across_shards
+def dietary_diversity_tips_batch(user_ids=None):
+    user_ids = _all_user_ids(user_ids)
+    recent_date = datetime.now() - timedelta(days=30)
+    # the meals of the last month may start in a partition
+    food_items = []
+    for schema in sources(session.connection(), recent_date):
+        meal = entity(Meal, schema)
+        item = entity(MealFoodItem, schema)
+        food_items.append(select(meal.user_id, item.food_item_id).join(
+            meal, meal.id == item.meal_id).where(meal.date >= recent_date))
+    food_items = union_all(*food_items).subquery()
+    query = session.query(
+        food_items.c.user_id,
+        func.count(distinct(food_items.c.food_item_id))
+    ).group_by(food_items.c.user_id)
+    counts = dict.fromkeys(user_ids, 0)
+    counts.update(_for_users(query, food_items.c.user_id, user_ids))
+    return {user_id: dietary_diversity_feedback(count)
+            for user_id, count in counts.items()}
+
+
+# Scenario 12: Goal progress, per user
+@_across_shards
+def track_goal_progress_batch(user_ids=None):
+    user_ids = _all_user_ids(user_ids)
+    current_date = datetime.now()
+
+    # the active goal with the latest deadline of each user, the newest
+    # goal on a tie, as in track_goal_progress
+    active = session.query(Goal).filter(
+        Goal.deadline >= current_date).subquery()
+    active_goal = aliased(Goal, active)
+    ranked = session.query(
+        active_goal,
+        func.row_number().over(partition_by=active_goal.user_id,
+                               order_by=(active_goal.deadline.desc(),
+                                         active_goal.id.desc())
+                               ).label('rank')
+    ).subquery()
+    latest_goal = aliased(Goal, ranked)
+    query = session.query(latest_goal).filter(ranked.c.rank == 1)
+    goals = {goal.user_id: goal
+             for goal in _for_users(query, latest_goal.user_id, user_ids)}
+
+    # latest body composition for weight and muscle goals
+    body_goal_users = [user_id for user_id, goal in goals.items()
+                       if goal.goal_type != GoalTypesEnum.STAMINA_BUILDING]
+    latest = {composition.user_id: composition for composition in _for_users(
+        _latest_per_user(BodyComposition), BodyComposition.user_id,
+        body_goal_users)} if body_goal_users else {}
+
+    # last month's workout intensity for stamina goals
+    stamina_users = [user_id for user_id, goal in goals.items()
+                     if goal.goal_type == GoalTypesEnum.STAMINA_BUILDING]
+    intensity = {}
+    if stamina_users:
+        query = session.query(
+            Workout.user_id, func.sum(_intensity_score()),
+            func.count(Workout.id)
+        ).filter(
+            Workout.date >= current_date - timedelta(days=30)
+        ).group_by(Workout.user_id)
+        intensity = {user_id: (total, count) for user_id, total, count in
+                     _for_users(query, Workout.user_id, stamina_users)}
+
+    progress = {}
+    for user_id in user_ids:
+        goal = goals.get(user_id)
+        if goal is None:
+            progress[user_id] = goal_progress_feedback(None, None)
+            continue
+        composition = latest.get(user_id)
+        total_intensity, workout_count = intensity.get(user_id, (None, 0))
+        value = goal_progress(
+            goal,
+            latest_weight=composition.weight if composition else None,
+            latest_muscle_mass=(composition.skeletal_muscle_mass
+                                if composition else None),
+            total_intensity=total_intensity, workout_count=workout_count)
+        progress[user_id] = goal_progress_feedback(goal, value)
+    return progress
+
+
+# Scenario 13: BMI, per user
+@_across_shards
+def calculate_user_bmi_batch(user_ids=None):
+    ranked = session.query(
+        BodyComposition.user_id.label('user_id'),
+        BodyComposition.weight.label('weight'),
+        func.row_number().over(partition_by=BodyComposition.user_id,
+                               order_by=(BodyComposition.date.desc(),
+                                         BodyComposition.id.desc())
+                               ).label('rank')
+    ).subquery()
+    query = session.query(User.id, User.height, ranked.c.weight).outerjoin(
+        ranked, (ranked.c.user_id == User.id) & (ranked.c.rank == 1))
+    # unknown users get the per-user function's answer
+    results = {user_id: bmi_feedback(user_id, None, None)
+               for user_id in user_ids or []}
+    results.update((user_id, bmi_feedback(user_id, height, weight))
+                   for user_id, height, weight in _for_users(query, User.id,
+                                                             user_ids))
+    return results
+
+
+# Scenario 14: Most frequent workout types and their duration, per user
+@_across_shards
+def summarize_frequent_workouts_batch(user_ids, start_date, end_date):
+    query = session.query(
+        Workout.user_id,
+        Workout.type,
+        func.count(Workout.id).label("sessions"),
+        func.sum(Workout.duration).label("total_duration")
+    ).filter(
+        Workout.date.between(start_date, end_date)
+    ).group_by(Workout.user_id, Workout.type
+    ).order_by(Workout.user_id, func.count(Workout.id).desc())
+    summaries = {user_id: [] for user_id in user_ids or []}
+    for workout in _for_users(query, Workout.user_id, user_ids):
+        summaries.setdefault(workout.user_id, []).append({
+            "workout_type": workout.type,
+            "sessions": workout.sessions,
+            "total_duration": workout.total_duration
+        })
+    for user_id, workouts in _archived_workouts(
+            user_ids, start_date, end_date).items():
+        summaries[user_id] = add_archived_workouts(
+            summaries.get(user_id, []), workouts)
+    return summaries
+
+
+# Scenario 15: Calories, macronutrients, vitamins and minerals consumed
+# within a date range, per user
+@_across_shards
+def nutrient_intake_report_batch(user_ids, start_date, end_date):
+    user_ids = _all_user_ids(user_ids)
+    query = session.query(
+        MealNutrientTotal.user_id,
+        *[func.total(getattr(MealNutrientTotal, name))
+          for name in MEAL_NUTRIENTS]
+    ).filter(
+        MealNutrientTotal.date.between(start_date, end_date)
+    ).group_by(MealNutrientTotal.user_id)
+    totals = {user_id: (0.0,) * len(MEAL_NUTRIENTS) for user_id in user_ids}
+    for user_id, *values in _for_users(query, MealNutrientTotal.user_id,
+                                       user_ids):
+        totals[user_id] = values
+
+    micronutrients = []
+    for total, nutrient in ((MealVitaminTotal, Vitamin),
+                            (MealMineralTotal, Mineral)):
+        query = session.query(
+            total.user_id, nutrient.name, func.sum(total.amount)
+        ).join(nutrient).filter(
+            total.date.between(start_date, end_date)
+        ).group_by(total.user_id, nutrient.id).order_by(
+            total.user_id, nutrient.name, nutrient.id)
+        amounts = {user_id: [] for user_id in user_ids}
+        for user_id, name, amount in _for_users(query, total.user_id,
+                                                user_ids):
+            amounts[user_id].append((name, amount))
+        micronutrients.append(amounts)
+
+    vitamins, minerals = micronutrients
+    return {user_id: nutrient_report(totals[user_id], vitamins[user_id],
+                                     minerals[user_id])
+            for user_id in user_ids}
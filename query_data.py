@@ -1,96 +1,56 @@
-# import necessary modules from create.py
-from create import (
-    Session,
+# import necessary modules from create.py and models.py
+from create import Session, init_db, read_session
+from models import (
+    INTENSITY_SCORES, MEAL_NUTRIENTS, DailyUserSummary,
+    MealNutrientTotal, MealVitaminTotal, MealMineralTotal, UserLatestState,
     User, Workout, FoodItem, Vitamin, Mineral,
     FoodItemVitamin, FoodItemMineral, Meal, MealFoodItem,
     WaterIntake, NutritionLog, Medication, SleepLog,
     HealthMetric, BodyComposition, Goal, GoalStatusEnum, GoalTypesEnum
 )
-from sqlalchemy import func, distinct
-from datetime import datetime, timedelta
-
-# Create a new session
-session = Session()
-
-# Scenario 1: Get all workouts for a specific user within a date range
-def get_workouts_by_user_and_date(user_id, start_date, end_date):
-    workouts = session.query(Workout).filter(
-        Workout.user_id == user_id,
-        Workout.date.between(start_date, end_date)
-    ).all()
-    return workouts
-
-# Scenario 2: Calculate the average calories consumed per day by a user in a specific week
-def average_daily_calories(user_id, start_date, end_date):
-    avg_calories = session.query(
-        func.avg(MealFoodItem.servings_consumed * FoodItem.calories)
-    ).join(Meal).join(FoodItem).filter(
-        Meal.user_id == user_id,
-        Meal.date.between(start_date, end_date)
-    ).scalar()
-    return avg_calories
-
-# Scenario 3: Analyze average sleep duration over the last month
-def average_sleep_duration_last_month(user_id):
-    one_month_ago = datetime.now() - timedelta(days=30)
-    avg_sleep_duration = session.query(
-        func.avg(SleepLog.total_sleep_duration)
-    ).filter(
-        SleepLog.user_id == user_id,
-        SleepLog.date >= one_month_ago
-    ).scalar()
-    return avg_sleep_duration
-
-# Scenario 4: Track weight change over the past year
-def weight_change_past_year(user_id):
-    one_year_ago = datetime.now() - timedelta(days=365)
-    weights = session.query(
-        BodyComposition.date,
-        BodyComposition.weight
-    ).filter(
-        BodyComposition.user_id == user_id,
-        BodyComposition.date >= one_year_ago
-    ).order_by(BodyComposition.date.asc()).all()
-    return weights
-
-# Scenario 5: Get the last recorded health metrics for a user
-def last_recorded_health_metrics(user_id):
-    last_metrics = session.query(HealthMetric).filter(
-        HealthMetric.user_id == user_id
-    ).order_by(HealthMetric.date.desc(), HealthMetric.time.desc()).first()
-    return last_metrics
-
-# Scenario 6: Recommend water intake based on recent water intake data
-def recommend_water_intake(user_id):
-    recent_date = datetime.now() - timedelta(days=7)
-    avg_water_intake = session.query(
-        func.avg(WaterIntake.amount)
-    ).filter(
-        WaterIntake.user_id == user_id,
-        WaterIntake.date >= recent_date
-    ).scalar()
-    # Fetch the gender from the User table
-    user_gender = session.query(User.gender).filter(User.id == user_id).scalar()
-    recommended_intake = 3.7 if user_gender == 'Male' else 2.7  # Liters per day, roughly
-    return avg_water_intake, recommended_intake
-
-
-# Scenario 7: Suggest calories intake based on user's goals and recent calorie intake
-def suggest_calories_intake(user_id, custom_goal_calories=None):
-    # Use the most recent BMR as the default goal unless a custom goal is provided
-    if custom_goal_calories is None:
-        latest_bmr = session.query(BodyComposition.basal_metabolic_rate).filter(
-            BodyComposition.user_id == user_id
-        ).order_by(BodyComposition.date.desc()).first()
-        
-        if latest_bmr is None:
-            return "No body composition data available to suggest nutritional improvements."
-        
-        goal_calories = latest_bmr[0]
-    else:
-        goal_calories = custom_goal_calories
-
-    avg_calories = average_daily_calories(user_id, datetime.now() - timedelta(days=30), datetime.now())
+from partitions import sources, partition_of, entity
+from archive import archived_rows
+from sqlalchemy import (
+    func, distinct, select, union_all, bindparam, Date, DateTime, String,
+    TypeDecorator
+)
+from sqlalchemy.orm import scoped_session
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+# The scenario functions below each read through their own short-lived
+# session (see create.read_session), so they are safe to call from many
+# threads at once and never hand out stale objects. The session is opened
+# on the user's shard when the database is sharded (see shards.py). Pass
+# session= to run several of them on one session, opened with
+# read_session(user_id=...) when sharded.
+#
+# Thread-local session registry for scripts and batch jobs that query
+# directly: every thread gets its own session, opened on first use after
+# init_db() has bound Session to an engine. Call session.remove() when a
+# thread is done with it to close it and return its connection to the pool.
+# It is bound to the main database. The query_batch functions put a
+# short-lived session of their own in it for the length of each call, bound
+# to a shard in the worker threads they run per shard.
+session = scoped_session(Session)
+
+
+# Average per logged row of a daily_user_summary total, e.g. the average
+# water intake entry. Dividing the summed totals by the summed row counts
+# gives the same answer as averaging the source rows, one row per day read.
+def summary_average(total, count):
+    return func.total(total) / func.nullif(func.sum(count), 0)
+
+
+# The helpers below turn query results into the scenarios' answers. They are
+# shared by the per-user functions here and the batch versions in
+# query_batch.py, so both always give the same advice.
+
+def recommended_water_intake(gender):
+    return 3.7 if gender == 'Male' else 2.7  # Liters per day, roughly
+
+
+def calorie_intake_suggestion(avg_calories, goal_calories):
     if avg_calories is None:
         return "No dietary data available to suggest nutritional improvements."
 
@@ -102,25 +62,19 @@ def suggest_calories_intake(user_id, custom_goal_calories=None):
         return "Your current calorie intake aligns with your goals."
 
 
-# Scenario 8: Using the intensity and frequency of workouts to provide feedback on 
-# the user's current fitness level and suggest changes if necessary.
-def assess_fitness_level(user_id):
-    recent_workouts = get_workouts_by_user_and_date(user_id, datetime.now() - timedelta(days=30), datetime.now())
-    if not recent_workouts:
+def fitness_level_feedback(average_intensity):
+    if average_intensity is None:
         return "No recent workouts found. Staying active is key to a healthy lifestyle."
-    average_intensity = sum([{"Low": 1, "Medium": 2, "High": 3}[workout.intensity] for workout in recent_workouts]) / len(recent_workouts)
     if average_intensity < 2:
         return "Consider increasing the intensity of your workouts to improve your fitness level."
     else:
         return "Great job! Your workout intensity is on point."
 
 
-# Scenario 9: Provide tips to improve sleep quality based on recent average sleep duration
-def sleep_duration_tips(user_id):
-    avg_sleep_duration = average_sleep_duration_last_month(user_id)
+def sleep_duration_feedback(avg_sleep_duration):
     if avg_sleep_duration is None:
         return "No sleep data available to suggest improvements."
-    
+
     if avg_sleep_duration < 7:
         return "You might not be getting enough rest. Consider setting a regular bedtime and avoiding screens before sleep to improve sleep quality."
     elif avg_sleep_duration > 9:
@@ -129,24 +83,7 @@ def sleep_duration_tips(user_id):
         return "Your sleep routine looks good. Maintain a consistent sleep schedule to keep up the good work!"
 
 
-# Scenario 10: Provide tips to improve sleep consistency based on recent bedtime and wake-up time
-def sleep_consistency_tips(user_id):
-    # Calculate the average bedtime and wake-up time over the last month
-    recent_date = datetime.now() - timedelta(days=30)
-    avg_bedtime_hour = session.query(
-        func.avg(func.strftime('%H', SleepLog.time_fell_asleep))
-    ).filter(
-        SleepLog.user_id == user_id,
-        SleepLog.date >= recent_date
-    ).scalar()
-
-    avg_wakeup_hour = session.query(
-        func.avg(func.strftime('%H', SleepLog.time_woke_up))
-    ).filter(
-        SleepLog.user_id == user_id,
-        SleepLog.date >= recent_date
-    ).scalar()
-
+def sleep_consistency_feedback(avg_bedtime_hour, avg_wakeup_hour):
     # Provide recommendations based on the consistency of bedtime and wake-up time
     tips = []
     if avg_bedtime_hour is not None and avg_wakeup_hour is not None:
@@ -166,17 +103,9 @@ def sleep_consistency_tips(user_id):
         return " ".join(tips)
     else:
         return "Not enough data to assess your sleep routine."
-    
 
-# Scenario 11: Provide tips to improve dietary diversity based on the number of unique food items consumed
-def dietary_diversity_tips(user_id):
-    recent_food_items_count = session.query(
-        func.count(distinct(MealFoodItem.food_item_id))
-    ).join(Meal).filter(
-        Meal.user_id == user_id,
-        Meal.date >= datetime.now() - timedelta(days=30)
-    ).scalar()
 
+def dietary_diversity_feedback(recent_food_items_count):
     # Thresholds and scoring can be adjusted based on nutritional guidelines
     if recent_food_items_count < 20:
         return "Your diet lacks diversity, which might miss out on essential nutrients. Try incorporating a variety of fruits, vegetables, and proteins."
@@ -184,57 +113,51 @@ def dietary_diversity_tips(user_id):
         return "You have a good variety in your diet. Keep exploring different food items to ensure a balanced intake of nutrients."
 
 
-# Scenario 12: Track goal progress based on the latest health metrics and workout data
-def track_goal_progress(user_id):
-    current_date = datetime.now()
-    goal = session.query(Goal).filter(
-        Goal.user_id == user_id,
-        Goal.deadline >= current_date
-    ).order_by(Goal.deadline.desc()).first()
-
-    # Initialize progress to None
-    progress = None
-
-    if goal:
-        if goal.goal_type == GoalTypesEnum.WEIGHT_LOSS:
-            latest_weight = session.query(BodyComposition).filter(
-                BodyComposition.user_id == user_id
-            ).order_by(BodyComposition.date.desc()).first().weight
-            progress = (goal.current_value - latest_weight) / (goal.current_value - goal.target_value)
-            
-        elif goal.goal_type == GoalTypesEnum.MUSCLE_GAIN:
-            latest_muscle_mass = session.query(BodyComposition).filter(
-                BodyComposition.user_id == user_id
-            ).order_by(BodyComposition.date.desc()).first().skeletal_muscle_mass
-            progress = (latest_muscle_mass - goal.current_value) / (goal.target_value - goal.current_value)
-        
-        elif goal.goal_type == GoalTypesEnum.STAMINA_BUILDING:
-            recent_workouts = session.query(Workout).filter(
-                Workout.user_id == user_id,
-                Workout.date >= current_date - timedelta(days=30)
-            ).all()
-            if recent_workouts:
-                total_difficulty = sum([{"Low": 1, "Medium": 2, "High": 3}[workout.intensity] for workout in recent_workouts])
-                max_possible_score = len(recent_workouts) * 3
-                progress = total_difficulty / max_possible_score
-            else:
-                return "No recent workouts to assess stamina building."
-        
-        # elif.... add more goal types as needed
+# Nutrient report from the summed meal totals and the (name, amount) pairs
+# of the vitamins and minerals consumed
+def nutrient_report(totals, vitamins, minerals):
+    report = dict(zip(MEAL_NUTRIENTS, totals))
+    report["vitamins"] = vitamins
+    report["minerals"] = minerals
+    return report
 
-        progress_percentage = progress * 100
-        return f"You have achieved {progress_percentage:.2f}% of your {goal.goal_type.value.lower()} goal."
-    else:
-        return "No active goals found."
 
+# Progress towards a goal, from the latest body composition values and the
+# intensity scores of the last month's workouts
+def goal_progress(goal, latest_weight=None, latest_muscle_mass=None,
+                  total_intensity=None, workout_count=0):
+    if goal.goal_type == GoalTypesEnum.WEIGHT_LOSS:
+        if latest_weight is None:
+            return None
+        return (goal.current_value - latest_weight) / (goal.current_value - goal.target_value)
 
-# Scenario 13: Calculate the BMI for a user
-def calculate_user_bmi(user_id):
-    user_height = session.query(User.height).filter(User.id == user_id).scalar()
-    latest_weight = session.query(BodyComposition.weight).filter(
-        BodyComposition.user_id == user_id
-    ).order_by(BodyComposition.date.desc()).first()
+    elif goal.goal_type == GoalTypesEnum.MUSCLE_GAIN:
+        if latest_muscle_mass is None:
+            return None
+        return (latest_muscle_mass - goal.current_value) / (goal.target_value - goal.current_value)
+
+    elif goal.goal_type == GoalTypesEnum.STAMINA_BUILDING:
+        if not workout_count:
+            return None
+        max_possible_score = workout_count * 3
+        return total_intensity / max_possible_score
+
+    # elif.... add more goal types as needed
+    return None
+
+
+def goal_progress_feedback(goal, progress):
+    if goal is None:
+        return "No active goals found."
+    if progress is None:
+        if goal.goal_type == GoalTypesEnum.STAMINA_BUILDING:
+            return "No recent workouts to assess stamina building."
+        return f"Not enough data to assess your {goal.goal_type.value.lower()} goal."
+    progress_percentage = progress * 100
+    return f"You have achieved {progress_percentage:.2f}% of your {goal.goal_type.value.lower()} goal."
 
+
+def bmi_feedback(user_id, user_height, latest_weight):
     if user_height is None or latest_weight is None:
         return "Insufficient data to calculate BMI."
 
@@ -243,31 +166,354 @@ def calculate_user_bmi(user_id):
     height_squared = height_in_meters ** 2
 
     # Calculate BMI
-    bmi = latest_weight[0] / height_squared
+    bmi = latest_weight / height_squared
     return f"The calculated BMI for user {user_id} is {bmi:.2f}."
 
+
+# Statements of the scenarios below, built once at import with bound
+# parameters instead of on every call. For these small indexed lookups,
+# building a query and computing its cache key took longer than SQLite
+# took to run it; a prebuilt statement goes straight to SQLAlchemy's
+# compiled cache. benchmarks/statement_cache.py measures the difference.
+
+# Date range bounds as callers pass them: dates, datetimes or ISO strings.
+# Each is bound the way a literal of its own type is, as the query chains
+# these statements replace bound them, so a datetime bound still compares
+# with dates as the same text.
+class DateBound(TypeDecorator):
+    impl = String
+    cache_ok = True
+
+    def bind_processor(self, dialect):
+        processors = [
+            (datetime, DateTime().dialect_impl(dialect).bind_processor(dialect)),
+            (date, Date().dialect_impl(dialect).bind_processor(dialect)),
+        ]
+
+        def process(value):
+            # datetime first, since it is also a date
+            for value_type, processor in processors:
+                if isinstance(value, value_type):
+                    return processor(value) if processor else value
+            return value
+        return process
+
+
+_user_id = bindparam('user_id')
+_start = bindparam('start', type_=DateBound())
+_end = bindparam('end', type_=DateBound())
+_since = bindparam('since', type_=DateBound())
+_now = bindparam('now', type_=DateBound())
+
+
+def _summary_since(*averages):
+    return select(*averages).where(
+        DailyUserSummary.user_id == _user_id,
+        DailyUserSummary.date >= _since)
+
+
+def _summary_in_range(*averages):
+    return select(*averages).where(
+        DailyUserSummary.user_id == _user_id,
+        DailyUserSummary.date.between(_start, _end))
+
+
+WORKOUTS_IN_RANGE = select(Workout).where(
+    Workout.user_id == _user_id, Workout.date.between(_start, _end))
+AVERAGE_CALORIES_IN_RANGE = _summary_in_range(summary_average(
+    DailyUserSummary.calories_in, DailyUserSummary.meal_food_item_count))
+AVERAGE_SLEEP_SINCE = _summary_since(summary_average(
+    DailyUserSummary.sleep_hours, DailyUserSummary.sleep_log_count))
+WEIGHTS_SINCE = select(BodyComposition.date, BodyComposition.weight).where(
+    BodyComposition.user_id == _user_id, BodyComposition.date >= _since
+).order_by(BodyComposition.date.asc())
+LAST_HEALTH_METRICS = select(HealthMetric).join(
+    UserLatestState, UserLatestState.health_metric_id == HealthMetric.id
+).where(UserLatestState.user_id == _user_id)
+LATEST_READING = select(
+    UserLatestState.health_metric_id, UserLatestState.health_metric_date
+).where(UserLatestState.user_id == _user_id)
+AVERAGE_WATER_SINCE = _summary_since(summary_average(
+    DailyUserSummary.water, DailyUserSummary.water_intake_count))
+USER_GENDER = select(User.gender).where(User.id == _user_id)
+LATEST_BMR = select(
+    UserLatestState.body_composition_id, UserLatestState.basal_metabolic_rate
+).where(UserLatestState.user_id == _user_id)
+AVERAGE_INTENSITY_IN_RANGE = _summary_in_range(summary_average(
+    DailyUserSummary.workout_intensity_total, DailyUserSummary.workout_count))
+AVERAGE_SLEEP_HOURS_SINCE = _summary_since(
+    summary_average(DailyUserSummary.bedtime_hour_total,
+                    DailyUserSummary.sleep_log_count),
+    summary_average(DailyUserSummary.wakeup_hour_total,
+                    DailyUserSummary.sleep_log_count))
+FOOD_ITEM_COUNT_SINCE = select(
+    func.count(distinct(MealFoodItem.food_item_id))
+).join(Meal).where(Meal.user_id == _user_id, Meal.date >= _since)
+ACTIVE_GOAL = select(Goal).where(
+    Goal.user_id == _user_id, Goal.deadline >= _now
+).order_by(Goal.deadline.desc(), Goal.id.desc()).limit(1)
+WORKOUTS_SINCE = select(Workout).where(
+    Workout.user_id == _user_id, Workout.date >= _since)
+USER_HEIGHT = select(User.height).where(User.id == _user_id)
+LATEST_WEIGHT = select(UserLatestState.weight).where(
+    UserLatestState.user_id == _user_id)
+WORKOUT_SUMMARY_IN_RANGE = select(
+    Workout.type,
+    func.count(Workout.id).label("sessions"),
+    func.sum(Workout.duration).label("total_duration")
+).where(
+    Workout.user_id == _user_id, Workout.date.between(_start, _end)
+).group_by(Workout.type).order_by(func.count(Workout.id).desc())
+NUTRIENT_TOTALS_IN_RANGE = select(
+    *[func.total(getattr(MealNutrientTotal, name)) for name in MEAL_NUTRIENTS]
+).where(
+    MealNutrientTotal.user_id == _user_id,
+    MealNutrientTotal.date.between(_start, _end))
+# vitamins, then minerals
+MICRONUTRIENT_AMOUNTS_IN_RANGE = [
+    select(nutrient.name, func.sum(total.amount)).join(nutrient).where(
+        total.user_id == _user_id, total.date.between(_start, _end)
+    ).group_by(nutrient.id).order_by(nutrient.name, nutrient.id)
+    for total, nutrient in ((MealVitaminTotal, Vitamin),
+                            (MealMineralTotal, Mineral))
+]
+
+
+# Food items of the user's meals since a date in one of the sources of the
+# meals (see partitions.sources)
+def _meal_food_items_since(schema):
+    meal = entity(Meal, schema)
+    item = entity(MealFoodItem, schema)
+    return select(item.food_item_id).join(meal, meal.id == item.meal_id).where(
+        meal.user_id == _user_id, meal.date >= _since)
+
+
+# FOOD_ITEM_COUNT_SINCE over the given sources of the meals, built once per
+# combination of sources
+@lru_cache(maxsize=None)
+def food_item_count_since(schemas=(None,)):
+    if schemas == (None,):
+        return FOOD_ITEM_COUNT_SINCE
+    food_items = union_all(*[_meal_food_items_since(schema)
+                             for schema in schemas]).subquery()
+    return select(func.count(distinct(food_items.c.food_item_id)))
+
+
+# A reading moved out of the main tables into the partition holding its day
+# (see partitions.py), or None
+def moved_reading(session, reading_id, day):
+    schema = partition_of(session.connection(), day)
+    if schema is None:
+        return None
+    reading = entity(HealthMetric, schema)
+    return session.scalar(select(reading).where(reading.id == reading_id))
+
+
+# Scenario 1: Get all workouts for a specific user within a date range
+def get_workouts_by_user_and_date(user_id, start_date, end_date, session=None):
+    with read_session(session, user_id) as session:
+        workouts = session.scalars(WORKOUTS_IN_RANGE, dict(
+            user_id=user_id, start=start_date, end=end_date)).all()
+        # the range may reach back into archived months (see archive.py)
+        archived = archived_rows(session.connection(), Workout, [user_id],
+                                 start_date, end_date)
+        if archived:
+            workouts = sorted(archived + workouts,
+                              key=lambda workout: workout.date)
+        return workouts
+
+# Scenario 2: Calculate the average calories consumed per day by a user in a specific week
+def average_daily_calories(user_id, start_date, end_date, session=None):
+    with read_session(session, user_id) as session:
+        avg_calories = session.scalar(AVERAGE_CALORIES_IN_RANGE, dict(
+            user_id=user_id, start=start_date, end=end_date))
+        return avg_calories
+
+# Scenario 3: Analyze average sleep duration over the last month
+def average_sleep_duration_last_month(user_id, session=None):
+    with read_session(session, user_id) as session:
+        one_month_ago = datetime.now() - timedelta(days=30)
+        avg_sleep_duration = session.scalar(AVERAGE_SLEEP_SINCE, dict(
+            user_id=user_id, since=one_month_ago))
+        return avg_sleep_duration
+
+# Scenario 4: Track weight change over the past year
+def weight_change_past_year(user_id, session=None):
+    with read_session(session, user_id) as session:
+        one_year_ago = datetime.now() - timedelta(days=365)
+        weights = session.execute(WEIGHTS_SINCE, dict(
+            user_id=user_id, since=one_year_ago)).all()
+        return weights
+
+# Scenario 5: Get the last recorded health metrics for a user
+def last_recorded_health_metrics(user_id, session=None):
+    with read_session(session, user_id) as session:
+        # user_latest_state points at the latest reading
+        last_metrics = session.scalars(LAST_HEALTH_METRICS, dict(
+            user_id=user_id)).first()
+        if last_metrics is None:
+            # unless it has been moved to a partition
+            latest = session.execute(LATEST_READING, dict(
+                user_id=user_id)).first()
+            if latest is not None and latest.health_metric_id is not None:
+                last_metrics = moved_reading(session, *latest)
+        return last_metrics
+
+# Scenario 6: Recommend water intake based on recent water intake data
+def recommend_water_intake(user_id, session=None):
+    with read_session(session, user_id) as session:
+        recent_date = datetime.now() - timedelta(days=7)
+        avg_water_intake = session.scalar(AVERAGE_WATER_SINCE, dict(
+            user_id=user_id, since=recent_date))
+        # Fetch the gender from the User table
+        user_gender = session.scalar(USER_GENDER, dict(user_id=user_id))
+        recommended_intake = recommended_water_intake(user_gender)
+        return avg_water_intake, recommended_intake
+
+
+# Scenario 7: Suggest calories intake based on user's goals and recent calorie intake
+def suggest_calories_intake(user_id, custom_goal_calories=None, session=None):
+    with read_session(session, user_id) as session:
+        # Use the most recent BMR as the default goal unless a custom goal is provided
+        if custom_goal_calories is None:
+            latest_bmr = session.execute(LATEST_BMR, dict(
+                user_id=user_id)).first()
+
+            if latest_bmr is None or latest_bmr.body_composition_id is None:
+                return "No body composition data available to suggest nutritional improvements."
+
+            goal_calories = latest_bmr.basal_metabolic_rate
+        else:
+            goal_calories = custom_goal_calories
+
+        avg_calories = average_daily_calories(user_id, datetime.now() - timedelta(days=30), datetime.now(), session=session)
+        return calorie_intake_suggestion(avg_calories, goal_calories)
+
+
+# Scenario 8: Using the intensity and frequency of workouts to provide feedback on 
+# the user's current fitness level and suggest changes if necessary.
+def assess_fitness_level(user_id, session=None):
+    with read_session(session, user_id) as session:
+        average_intensity = session.scalar(AVERAGE_INTENSITY_IN_RANGE, dict(
+            user_id=user_id, start=datetime.now() - timedelta(days=30),
+            end=datetime.now()))
+        return fitness_level_feedback(average_intensity)
+
+
+# Scenario 9: Provide tips to improve sleep quality based on recent average sleep duration
+def sleep_duration_tips(user_id, session=None):
+    with read_session(session, user_id) as session:
+        avg_sleep_duration = average_sleep_duration_last_month(user_id, session=session)
+        return sleep_duration_feedback(avg_sleep_duration)
+
+
+# Scenario 10: Provide tips to improve sleep consistency based on recent bedtime and wake-up time
+def sleep_consistency_tips(user_id, session=None):
+    with read_session(session, user_id) as session:
+        # Calculate the average bedtime and wake-up time over the last month
+        recent_date = datetime.now() - timedelta(days=30)
+        avg_bedtime_hour, avg_wakeup_hour = session.execute(
+            AVERAGE_SLEEP_HOURS_SINCE, dict(user_id=user_id, since=recent_date)
+        ).one()
+
+        return sleep_consistency_feedback(avg_bedtime_hour, avg_wakeup_hour)
+
+
+# Scenario 11: Provide tips to improve dietary diversity based on the number of unique food items consumed
+def dietary_diversity_tips(user_id, session=None):
+    with read_session(session, user_id) as session:
+        recent_date = datetime.now() - timedelta(days=30)
+        # the meals of the last month may start in a partition
+        recent_food_items_count = session.scalar(
+            food_item_count_since(sources(session.connection(), recent_date)),
+            dict(user_id=user_id, since=recent_date))
+
+        return dietary_diversity_feedback(recent_food_items_count)
+
+
+# Scenario 12: Track goal progress based on the latest health metrics and workout data
+def track_goal_progress(user_id, session=None):
+    with read_session(session, user_id) as session:
+        current_date = datetime.now()
+        goal = session.scalars(ACTIVE_GOAL, dict(
+            user_id=user_id, now=current_date)).first()
+
+        # Initialize progress to None
+        progress = None
+
+        if goal:
+            if goal.goal_type in (GoalTypesEnum.WEIGHT_LOSS, GoalTypesEnum.MUSCLE_GAIN):
+                latest = session.get(UserLatestState, user_id)
+                if latest is not None and latest.body_composition_id is not None:
+                    progress = goal_progress(goal, latest_weight=latest.weight,
+                                             latest_muscle_mass=latest.skeletal_muscle_mass)
+
+            elif goal.goal_type == GoalTypesEnum.STAMINA_BUILDING:
+                recent_workouts = session.scalars(WORKOUTS_SINCE, dict(
+                    user_id=user_id, since=current_date - timedelta(days=30))).all()
+                total_difficulty = sum([INTENSITY_SCORES[workout.intensity] for workout in recent_workouts])
+                progress = goal_progress(goal, total_intensity=total_difficulty,
+                                         workout_count=len(recent_workouts))
+
+        return goal_progress_feedback(goal, progress)
+
+
+# Scenario 13: Calculate the BMI for a user
+def calculate_user_bmi(user_id, session=None):
+    with read_session(session, user_id) as session:
+        user_height = session.scalar(USER_HEIGHT, dict(user_id=user_id))
+        latest_weight = session.scalar(LATEST_WEIGHT, dict(user_id=user_id))
+
+        return bmi_feedback(user_id, user_height, latest_weight)
+
 # Scenario 14: Summarize the most frequent workout types and their total duration
-def summarize_frequent_workouts(user_id, start_date, end_date):
-    workouts_summary = session.query(
-        Workout.type,
-        func.count(Workout.id).label("sessions"),
-        func.sum(Workout.duration).label("total_duration")
-    ).filter(
-        Workout.user_id == user_id,
-        Workout.date.between(start_date, end_date)
-    ).group_by(Workout.type
-    ).order_by(func.count(Workout.id).desc()
-    ).all()
-
-    return [{
-        "workout_type": workout.type,
-        "sessions": workout.sessions,
-        "total_duration": workout.total_duration
-    } for workout in workouts_summary]
+def summarize_frequent_workouts(user_id, start_date, end_date, session=None):
+    with read_session(session, user_id) as session:
+        workouts_summary = session.execute(WORKOUT_SUMMARY_IN_RANGE, dict(
+            user_id=user_id, start=start_date, end=end_date)).all()
+
+        return add_archived_workouts([{
+            "workout_type": workout.type,
+            "sessions": workout.sessions,
+            "total_duration": workout.total_duration
+        } for workout in workouts_summary], archived_rows(
+            session.connection(), Workout, [user_id], start_date, end_date))
+
+
+# Count archived workouts (see archive.py) into a summary of workouts per
+# type, which stays ordered by sessions, most first
+def add_archived_workouts(summary, workouts):
+    if not workouts:
+        return summary
+    by_type = {entry["workout_type"]: entry for entry in summary}
+    for workout in workouts:
+        entry = by_type.setdefault(workout.type, {
+            "workout_type": workout.type, "sessions": 0,
+            "total_duration": 0})
+        entry["sessions"] += 1
+        entry["total_duration"] = (entry["total_duration"] or 0) \
+            + (workout.duration or 0)
+    return sorted(by_type.values(), key=lambda entry: -entry["sessions"])
+
+
+# Scenario 15: Report the calories, macronutrients, vitamins and minerals a user consumed within a date range
+# Reads the per-meal totals maintained by rollups.py instead of joining meals, meal food items and food items
+def nutrient_intake_report(user_id, start_date, end_date, session=None):
+    with read_session(session, user_id) as session:
+        parameters = dict(user_id=user_id, start=start_date, end=end_date)
+        totals = session.execute(NUTRIENT_TOTALS_IN_RANGE, parameters).one()
+
+        micronutrients = []
+        for statement in MICRONUTRIENT_AMOUNTS_IN_RANGE:
+            amounts = session.execute(statement, parameters).all()
+            micronutrients.append([(name, amount) for name, amount in amounts])
+
+        return nutrient_report(totals, *micronutrients)
 
 
 # Usage example
 if __name__ == "__main__":
+    init_db()
     # Scenario 1
     print(get_workouts_by_user_and_date(17, '2023-04-01', '2024-01-31'))
     # Scenario 2
@@ -296,3 +542,5 @@ if __name__ == "__main__":
     print(calculate_user_bmi(23))
     # Scenario 14
     print(summarize_frequent_workouts(23, '2023-04-01', '2024-01-31'))
+    # Scenario 15
+    print(nutrient_intake_report(36, '2023-04-01', '2024-01-31'))
@@ -0,0 +1,543 @@
+# Maintained rollups
+# Keeps daily_user_summary in step with the meal, water, sleep and workout
+# tables, the meal_*_totals tables in step with meal food items and the food
+# items' nutrition, the health_metric_hourly and _daily tiers in step with
+# health_metrics, and user_latest_state in step with body_compositions and
+# health_metrics. after_flush listeners collect the (user_id, date) days and
+# the meals touched by inserted, updated or deleted rows and recompute just
+# those inside the same transaction. A newly inserted body composition or
+# reading replaces its user's latest state only when it is newer; updated or
+# deleted ones recompute the user's latest state. Core bulk inserts bypass
+# the ORM, so the bulk loaders call rebuild_rollups() when they finish; it
+# can also be run by hand:
+#
+#     python3 rollups.py rebuild
+#
+# The rollups of the days moved into partitions (see partitions.py) stay in
+# the main file and are never refreshed, since those days are closed; the
+# rebuilds and the latest state recomputation read the partitions too.
+#
+# With user shards (see shards.py) every shard keeps the rollups of its own
+# users, maintained by the flushes of the sessions opened on it. Food items
+# are written to the main database, whose flushes see none of the shards'
+# meals, so after changing a food item's nutrition run the rebuild, which
+# covers every shard.
+from models import (
+    INTENSITY_SCORES, MEAL_NUTRIENTS, HEALTH_METRIC_VITALS,
+    LATEST_BODY_COMPOSITION_VALUES, User, Workout, FoodItem,
+    FoodItemVitamin, FoodItemMineral, Meal, MealFoodItem, WaterIntake,
+    SleepLog, HealthMetric, BodyComposition, DailyUserSummary,
+    MealNutrientTotal, MealVitaminTotal, MealMineralTotal, HealthMetricHourly,
+    HealthMetricDaily, UserLatestState
+)
+from sqlalchemy import (
+    event, inspect, select, delete, insert, func, literal, tuple_, union_all,
+    case, cast, or_, Integer
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from partitions import across_partitions
+from archive import archived_month
+from itertools import islice
+import argparse
+import time
+
+# Days recomputed per statement; two bound parameters each
+MAX_DAYS_PER_STATEMENT = 10000
+# Meals recomputed per statement
+MAX_MEALS_PER_STATEMENT = 20000
+# Users whose latest state is recomputed per statement
+MAX_USERS_PER_STATEMENT = 20000
+
+SUMMARY_TABLE = DailyUserSummary.__table__
+
+# Summary columns each source fills in, in table order after user_id, date
+SUMMARY_COLUMNS = [column.name for column in SUMMARY_TABLE.columns
+                   if column.name not in ('user_id', 'date')]
+
+MEAL_TOTAL_TABLES = [MealNutrientTotal.__table__, MealVitaminTotal.__table__,
+                     MealMineralTotal.__table__]
+
+HEALTH_METRIC_TIER_TABLES = [HealthMetricHourly.__table__,
+                             HealthMetricDaily.__table__]
+
+LATEST_STATE_TABLE = UserLatestState.__table__
+
+# Every table rebuild_rollups() recomputes
+ROLLUP_TABLES = [SUMMARY_TABLE, *MEAL_TOTAL_TABLES, *HEALTH_METRIC_TIER_TABLES,
+                 LATEST_STATE_TABLE]
+
+# The sources of user_latest_state: the model, the state columns copied from
+# its latest row (state column -> model column) and the state columns whose
+# values order its rows, most significant first
+LATEST_STATE_SOURCES = [
+    (BodyComposition, {
+        'body_composition_id': 'id',
+        'body_composition_date': 'date',
+        **{name: name for name in LATEST_BODY_COMPOSITION_VALUES},
+    }, ('body_composition_date', 'body_composition_id')),
+    (HealthMetric, {
+        'health_metric_id': 'id',
+        'health_metric_date': 'date',
+        'health_metric_time': 'time',
+        **{name: name for name in HEALTH_METRIC_VITALS},
+    }, ('health_metric_date', 'health_metric_time', 'health_metric_id')),
+]
+
+
+# Hour of a timestamp as an integer, as query_data's strftime('%H') averages
+def _hour(column):
+    return cast(func.strftime('%H', column), Integer)
+
+
+# One grouped SELECT per source table, each producing every summary column
+# (zeros for the columns it does not own). keys restricts them to some days.
+def _source_selects(keys=None):
+    def day_filter(user_column, date_column):
+        if keys is None:
+            return []
+        return [tuple_(user_column, date_column).in_(keys)]
+
+    def summary_select(user_column, date_column, values, *joins):
+        columns = [user_column.label('user_id'), date_column.label('date')]
+        columns += [values.get(name, literal(0)).label(name)
+                    for name in SUMMARY_COLUMNS]
+        query = select(*columns)
+        for join in joins:
+            query = query.select_from(join)
+        return query.where(*day_filter(user_column, date_column)).group_by(
+            user_column, date_column)
+
+    intensity = case(INTENSITY_SCORES, value=Workout.intensity, else_=0)
+    return [
+        summary_select(Meal.user_id, Meal.date, {
+            'calories_in': func.sum(MealFoodItem.servings_consumed
+                                    * FoodItem.calories),
+            'meal_food_item_count': func.count(MealFoodItem.id),
+        }, MealFoodItem.__table__.join(Meal.__table__).join(
+            FoodItem.__table__)),
+        summary_select(WaterIntake.user_id, WaterIntake.date, {
+            'water': func.sum(WaterIntake.amount),
+            'water_intake_count': func.count(WaterIntake.id),
+        }),
+        summary_select(SleepLog.user_id, SleepLog.date, {
+            'sleep_hours': func.sum(SleepLog.total_sleep_duration),
+            'bedtime_hour_total': func.sum(_hour(SleepLog.time_fell_asleep)),
+            'wakeup_hour_total': func.sum(_hour(SleepLog.time_woke_up)),
+            'sleep_log_count': func.count(SleepLog.id),
+        }),
+        summary_select(Workout.user_id, Workout.date, {
+            'calories_burned': func.sum(Workout.calories_burned),
+            # durations are logged in hours
+            'workout_minutes': func.sum(Workout.duration * 60),
+            'workout_intensity_total': func.sum(intensity),
+            'workout_count': func.count(Workout.id),
+        }),
+    ]
+
+
+# INSERT ... SELECT summing the per-source rows of each day
+def _insert_summaries(keys=None):
+    sources = union_all(*_source_selects(keys)).subquery()
+    totals = [func.sum(sources.c[name]) for name in SUMMARY_COLUMNS]
+    combined = select(sources.c.user_id, sources.c.date, *totals).group_by(
+        sources.c.user_id, sources.c.date)
+    return insert(SUMMARY_TABLE).from_select(
+        ['user_id', 'date'] + SUMMARY_COLUMNS, combined)
+
+
+# Recompute the summaries of the given (user_id, date) days
+def refresh_daily_summaries(connection, keys):
+    keys = iter(sorted(set(keys)))
+    while chunk := list(islice(keys, MAX_DAYS_PER_STATEMENT)):
+        connection.execute(delete(SUMMARY_TABLE).where(
+            tuple_(SUMMARY_TABLE.c.user_id, SUMMARY_TABLE.c.date).in_(chunk)))
+        connection.execute(_insert_summaries(chunk))
+
+
+# Delete the rows of a rollup table a rebuild recomputes: all but those of
+# archived months
+def _clear(connection, table):
+    connection.execute(delete(table).where(
+        ~archived_month(table.c.user_id, table.c.date)))
+
+
+# Recompute every summary from the source tables
+def rebuild_daily_summaries(connection):
+    with across_partitions(connection):
+        _clear(connection, SUMMARY_TABLE)
+        connection.execute(_insert_summaries().prefix_with('OR IGNORE'))
+
+
+# INSERT ... SELECTs filling the meal totals tables. meal_ids restricts them
+# to some meals.
+def _insert_meal_totals(meal_ids=None):
+    def meal_filter(meal_column):
+        if meal_ids is None:
+            return []
+        return [meal_column.in_(meal_ids)]
+
+    servings = MealFoodItem.servings_consumed
+    # every meal gets a row, zeros when it has no food items yet
+    nutrients = select(
+        Meal.id, Meal.user_id, Meal.date,
+        *[func.total(servings * getattr(FoodItem, name))
+          for name in MEAL_NUTRIENTS],
+        func.count(MealFoodItem.id)
+    ).select_from(Meal.__table__.outerjoin(MealFoodItem.__table__).outerjoin(
+        FoodItem.__table__)).where(*meal_filter(Meal.id)).group_by(Meal.id)
+
+    def micronutrient_select(link, nutrient_id):
+        return select(
+            MealFoodItem.meal_id, nutrient_id, Meal.user_id, Meal.date,
+            func.sum(servings * link.amount)
+        ).select_from(MealFoodItem.__table__.join(Meal.__table__).join(
+            link.__table__, link.food_item_id == MealFoodItem.food_item_id)
+        ).where(*meal_filter(MealFoodItem.meal_id)).group_by(
+            MealFoodItem.meal_id, nutrient_id, Meal.user_id, Meal.date)
+
+    return [
+        insert(MealNutrientTotal.__table__).from_select(
+            ['meal_id', 'user_id', 'date'] + MEAL_NUTRIENTS
+            + ['food_item_count'], nutrients),
+        insert(MealVitaminTotal.__table__).from_select(
+            ['meal_id', 'vitamin_id', 'user_id', 'date', 'amount'],
+            micronutrient_select(FoodItemVitamin, FoodItemVitamin.vitamin_id)),
+        insert(MealMineralTotal.__table__).from_select(
+            ['meal_id', 'mineral_id', 'user_id', 'date', 'amount'],
+            micronutrient_select(FoodItemMineral, FoodItemMineral.mineral_id)),
+    ]
+
+
+# Recompute the nutrient, vitamin and mineral totals of the given meals
+def refresh_meal_totals(connection, meal_ids):
+    meal_ids = iter(sorted(set(meal_ids)))
+    while chunk := list(islice(meal_ids, MAX_MEALS_PER_STATEMENT)):
+        for table in MEAL_TOTAL_TABLES:
+            connection.execute(delete(table).where(
+                table.c.meal_id.in_(chunk)))
+        for statement in _insert_meal_totals(chunk):
+            connection.execute(statement)
+
+
+# Recompute every meal's totals from the source tables
+def rebuild_meal_totals(connection):
+    with across_partitions(connection):
+        for table in MEAL_TOTAL_TABLES:
+            _clear(connection, table)
+        for statement in _insert_meal_totals():
+            connection.execute(statement.prefix_with('OR IGNORE'))
+
+
+# INSERT ... SELECTs filling the hourly and daily health metric tiers.
+# keys restricts them to some (user_id, date) days.
+def _insert_health_metric_tiers(keys=None):
+    def tier_select(bucket):
+        # latest non-NULL reading of each vital in the bucket, repeated on
+        # every row of the bucket so the outer query can pick it with max()
+        def latest(column):
+            return func.last_value(column).over(
+                partition_by=bucket,
+                order_by=(case((column.is_(None), 0), else_=1),
+                          HealthMetric.time_of_day, HealthMetric.id),
+                rows=(None, None))
+
+        readings = select(
+            *bucket, *[getattr(HealthMetric, vital)
+                       for vital in HEALTH_METRIC_VITALS],
+            *[latest(getattr(HealthMetric, vital)).label(f'{vital}_last')
+              for vital in HEALTH_METRIC_VITALS])
+        if keys is not None:
+            readings = readings.where(
+                tuple_(HealthMetric.user_id, HealthMetric.date).in_(keys))
+        readings = readings.subquery()
+
+        statistics = []
+        for vital in HEALTH_METRIC_VITALS:
+            statistics += [func.count(readings.c[vital]),
+                           func.min(readings.c[vital]),
+                           func.max(readings.c[vital]),
+                           func.avg(readings.c[vital]),
+                           func.max(readings.c[f'{vital}_last'])]
+        bucket_columns = [readings.c[column.name] for column in bucket]
+        return select(*bucket_columns, *statistics).group_by(*bucket_columns)
+
+    statistic_columns = [f'{vital}_{statistic}'
+                         for vital in HEALTH_METRIC_VITALS
+                         for statistic in ('count', 'min', 'max', 'mean',
+                                           'last')]
+    day = [HealthMetric.user_id, HealthMetric.date]
+    return [
+        insert(HealthMetricHourly.__table__).from_select(
+            ['user_id', 'date', 'hour'] + statistic_columns,
+            tier_select(day + [_hour(HealthMetric.time).label('hour')])),
+        insert(HealthMetricDaily.__table__).from_select(
+            ['user_id', 'date'] + statistic_columns, tier_select(day)),
+    ]
+
+
+# Recompute the health metric tiers of the given (user_id, date) days
+def refresh_health_metric_tiers(connection, keys):
+    keys = iter(sorted(set(keys)))
+    while chunk := list(islice(keys, MAX_DAYS_PER_STATEMENT)):
+        for table in HEALTH_METRIC_TIER_TABLES:
+            connection.execute(delete(table).where(
+                tuple_(table.c.user_id, table.c.date).in_(chunk)))
+        for statement in _insert_health_metric_tiers(chunk):
+            connection.execute(statement)
+
+
+# Recompute both health metric tiers from every reading
+def rebuild_health_metric_tiers(connection):
+    with across_partitions(connection):
+        for table in HEALTH_METRIC_TIER_TABLES:
+            _clear(connection, table)
+        for statement in _insert_health_metric_tiers():
+            connection.execute(statement.prefix_with('OR IGNORE'))
+
+
+# INSERT ... SELECT filling user_latest_state with a row per user, from the
+# latest row of each source. user_ids restricts it to some users, shard, an
+# (index, count) pair, to the users of a shard (see create.shard_of).
+def _insert_user_latest_state(user_ids=None, shard=None):
+    def latest_select(model, columns, ordering):
+        ranked = select(
+            model.user_id,
+            *[getattr(model, source).label(state)
+              for state, source in columns.items()],
+            func.row_number().over(
+                partition_by=model.user_id,
+                order_by=[getattr(model, columns[state]).desc()
+                          for state in ordering]).label('rank'))
+        if user_ids is not None:
+            ranked = ranked.where(model.user_id.in_(user_ids))
+        ranked = ranked.subquery()
+        return select(ranked).where(ranked.c.rank == 1).subquery()
+
+    query = select(User.id)
+    state_columns = []
+    joined = User.__table__
+    for model, columns, ordering in LATEST_STATE_SOURCES:
+        latest = latest_select(model, columns, ordering)
+        joined = joined.outerjoin(latest, latest.c.user_id == User.id)
+        query = query.add_columns(*[latest.c[state] for state in columns])
+        state_columns += list(columns)
+    query = query.select_from(joined)
+    if user_ids is not None:
+        query = query.where(User.id.in_(user_ids))
+    if shard is not None:
+        index, count = shard
+        query = query.where(User.id % count == index)
+    return insert(LATEST_STATE_TABLE).from_select(
+        ['user_id'] + state_columns, query)
+
+
+# Recompute the latest state of the given users. Their latest reading may
+# be in a partition.
+def refresh_user_latest_state(connection, user_ids):
+    user_ids = iter(sorted(set(user_ids)))
+    with across_partitions(connection):
+        while chunk := list(islice(user_ids, MAX_USERS_PER_STATEMENT)):
+            connection.execute(delete(LATEST_STATE_TABLE).where(
+                LATEST_STATE_TABLE.c.user_id.in_(chunk)))
+            connection.execute(_insert_user_latest_state(chunk))
+
+
+# Recompute every user's latest state from the source tables. On a shard
+# the users table is the main database's, so only the shard's users get a
+# row.
+def rebuild_user_latest_state(connection):
+    with across_partitions(connection):
+        connection.execute(delete(LATEST_STATE_TABLE))
+        connection.execute(_insert_user_latest_state(
+            shard=connection.info.get('shard')))
+
+
+# Record newly inserted rows of a source in user_latest_state. Each user's
+# newest row replaces the stored one only if it sorts after it, so rows
+# arriving out of order never overwrite a newer value.
+def record_latest_state(connection, source, objects):
+    model, columns, ordering = source
+    newest = {}
+    for obj in objects:
+        row = {state: getattr(obj, source_column)
+               for state, source_column in columns.items()}
+        key = tuple(row[state] for state in ordering)
+        if obj.user_id not in newest or key > newest[obj.user_id][0]:
+            newest[obj.user_id] = (key, row)
+    if not newest:
+        return
+
+    statement = sqlite_insert(LATEST_STATE_TABLE)
+    stored = [LATEST_STATE_TABLE.c[state] for state in ordering]
+    statement = statement.on_conflict_do_update(
+        index_elements=['user_id'],
+        set_={state: statement.excluded[state] for state in columns},
+        where=or_(stored[-1].is_(None),
+                  tuple_(*[statement.excluded[state] for state in ordering])
+                  > tuple_(*stored)))
+    connection.execute(statement, [dict(row, user_id=user_id)
+                                   for user_id, (_, row) in newest.items()])
+
+
+# Recompute every rollup table
+def rebuild_rollups(connection):
+    rebuild_daily_summaries(connection)
+    rebuild_meal_totals(connection)
+    rebuild_health_metric_tiers(connection)
+    rebuild_user_latest_state(connection)
+
+
+# Current and previous values of an attribute on a flushed object
+def _values(obj, attribute):
+    history = inspect(obj).attrs[attribute].history
+    values = set(history.added) | set(history.unchanged) \
+        | set(history.deleted)
+    values.discard(None)
+    return values
+
+
+# Whether any of the attributes changed on a flushed object
+def _changed(obj, *attributes):
+    state = inspect(obj)
+    return any(state.attrs[attribute].history.has_changes()
+               for attribute in attributes)
+
+
+# Days an object's current and previous user_id/date values fall on
+def _days(obj):
+    return {(user_id, day) for user_id in _values(obj, 'user_id')
+            for day in _values(obj, 'date')}
+
+
+# Days touched by the objects written in this flush
+def _touched_days(session):
+    days = set()
+    meal_ids = set()
+    food_item_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Meal, WaterIntake, SleepLog, Workout)):
+            days |= _days(obj)
+        elif isinstance(obj, MealFoodItem):
+            meal_ids |= _values(obj, 'meal_id')
+        elif isinstance(obj, FoodItem) and obj in session.dirty \
+                and _changed(obj, 'calories'):
+            food_item_ids.add(obj.id)
+
+    connection = session.connection()
+    if meal_ids:
+        days |= set(connection.execute(
+            select(Meal.user_id, Meal.date).where(Meal.id.in_(meal_ids))))
+    if food_item_ids:
+        days |= set(connection.execute(
+            select(Meal.user_id, Meal.date).distinct().join(MealFoodItem)
+            .where(MealFoodItem.food_item_id.in_(food_item_ids))))
+    return days
+
+
+# Meals whose totals change with the objects written in this flush
+def _touched_meals(session):
+    meal_ids = set()
+    food_item_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Meal):
+            # the totals copy the meal's user_id and date
+            if obj not in session.dirty or _changed(obj, 'user_id', 'date'):
+                meal_ids.add(obj.id)
+        elif isinstance(obj, MealFoodItem):
+            meal_ids |= _values(obj, 'meal_id')
+        elif isinstance(obj, (FoodItemVitamin, FoodItemMineral)):
+            food_item_ids |= _values(obj, 'food_item_id')
+        elif isinstance(obj, FoodItem) and obj in session.dirty \
+                and _changed(obj, *MEAL_NUTRIENTS):
+            food_item_ids.add(obj.id)
+
+    if food_item_ids:
+        meal_ids |= set(session.connection().scalars(
+            select(MealFoodItem.meal_id).distinct()
+            .where(MealFoodItem.food_item_id.in_(food_item_ids))))
+    meal_ids.discard(None)
+    return meal_ids
+
+
+# Days of the health metric readings written in this flush
+def _touched_metric_days(session):
+    days = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, HealthMetric):
+            days |= _days(obj)
+    return days
+
+
+# Users whose latest state has to be recomputed because a body composition
+# or reading was updated or deleted in this flush
+def _touched_latest_users(session):
+    user_ids = set()
+    for obj in list(session.dirty) + list(session.deleted):
+        for model, columns, _ in LATEST_STATE_SOURCES:
+            if isinstance(obj, model) and (
+                    obj in session.deleted
+                    or _changed(obj, 'user_id', *columns.values())):
+                user_ids |= _values(obj, 'user_id')
+    return user_ids
+
+
+@event.listens_for(Session, 'after_flush')
+def _maintain_daily_summaries(session, flush_context):
+    days = _touched_days(session)
+    if days:
+        refresh_daily_summaries(session.connection(), days)
+
+
+@event.listens_for(Session, 'after_flush')
+def _maintain_meal_totals(session, flush_context):
+    meal_ids = _touched_meals(session)
+    if meal_ids:
+        refresh_meal_totals(session.connection(), meal_ids)
+
+
+@event.listens_for(Session, 'after_flush')
+def _maintain_health_metric_tiers(session, flush_context):
+    days = _touched_metric_days(session)
+    if days:
+        refresh_health_metric_tiers(session.connection(), days)
+
+
+@event.listens_for(Session, 'after_flush')
+def _maintain_user_latest_state(session, flush_context):
+    user_ids = _touched_latest_users(session)
+    if user_ids:
+        refresh_user_latest_state(session.connection(), user_ids)
+    for source in LATEST_STATE_SOURCES:
+        # the recomputed users already include this flush's new rows
+        new = [obj for obj in session.new if isinstance(obj, source[0])
+               and obj.user_id not in user_ids]
+        if new:
+            record_latest_state(session.connection(), source, new)
+
+
+if __name__ == "__main__":
+    from create import init_db, user_engines
+
+    parser = argparse.ArgumentParser(description="Maintain rollup tables.")
+    parser.add_argument('command', choices=['rebuild'],
+                        help="rebuild: recompute every rollup table")
+    args = parser.parse_args()
+    init_db()
+    started = time.perf_counter()
+    days = meals = hours = users = 0
+    # every shard when sharded
+    for engine in user_engines():
+        with engine.begin() as connection:
+            rebuild_rollups(connection)
+            days += connection.scalar(select(func.count()).select_from(
+                SUMMARY_TABLE))
+            meals += connection.scalar(select(func.count()).select_from(
+                MealNutrientTotal.__table__))
+            hours += connection.scalar(select(func.count()).select_from(
+                HealthMetricHourly.__table__))
+            users += connection.scalar(select(func.count()).select_from(
+                LATEST_STATE_TABLE))
+    print(f"Rebuilt {days} daily summaries, the totals of {meals} meals, "
+          f"{hours} hourly health metric buckets and the latest state of "
+          f"{users} users in {time.perf_counter() - started:.2f}s")
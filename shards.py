@@ -0,0 +1,196 @@
+# User shards
+# With HEALTH_DB_SHARDS set above one (see create.SHARD_COUNT), each user's
+# rows live in one of that many shard files, picked by user_id, while the
+# main database keeps the users, their login sessions and the food catalog.
+# The query_data, dashboard, metric_charts and query_async scenarios open
+# their sessions on the user's shard; the query_batch and health_series
+# functions, which cover many users, run on every shard at once through
+# fan_out() and merge the per-user results.
+#
+# A database loaded unsharded, or by the loaders in insert_data.py, has all
+# its rows in the main file; split() moves each user's rows into their
+# shard. Loading more rows into a split database and splitting again
+# appends them to the shards. Run it with the application stopped:
+#
+#     HEALTH_DB_SHARDS=4 python3 shards.py split
+#     HEALTH_DB_SHARDS=4 python3 shards.py list
+#
+# The shard of a user is fixed by the number of shards, which cannot be
+# changed once the database has been split.
+import create
+from create import SHARD_TABLES, init_db
+from models import Partition, ArchiveStub
+from rollups import ROLLUP_TABLES, rebuild_rollups
+from sqlalchemy import select
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import time
+
+# Tables whose rows go with the row of another per-user table they belong
+# to: table -> (foreign key column, table with the user_id)
+SHARD_CHILDREN = {'meal_food_items': ('meal_id', 'meals')}
+
+
+class ShardError(RuntimeError):
+    pass
+
+
+# Run function(index, engine) on every shard at once, one thread each, and
+# return the results in shard order. SQLite releases the GIL while it runs a
+# statement, so the shards' queries overlap.
+def fan_out(function):
+    engines = create.shard_engines
+    with ThreadPoolExecutor(len(engines)) as executor:
+        return list(executor.map(function, range(len(engines)), engines))
+
+
+# The given user ids grouped by the index of their shard
+def ids_by_shard(user_ids):
+    grouped = {index: [] for index in range(len(create.shard_engines))}
+    for user_id in user_ids:
+        grouped[create.shard_of(user_id)].append(user_id)
+    return grouped
+
+
+# WHERE clause picking the main database's rows of a per-user table that
+# belong to a shard, with its parameters
+def _shard_condition(table, index, count):
+    if 'user_id' in table.columns:
+        return 'user_id % ? = ?', (count, index)
+    if table.name in SHARD_CHILDREN:
+        column, parent = SHARD_CHILDREN[table.name]
+        return (f'{column} IN (SELECT id FROM common.{parent} '
+                'WHERE user_id % ? = ?)'), (count, index)
+    raise ShardError(f"No rule places the rows of {table.name} in a shard.")
+
+
+# Shift the ids of the main database's rows of the split tables past the
+# highest id any shard already uses, along with the columns referring to
+# them, so rows loaded after an earlier split keep ids of their own
+def _renumber(connection, tables, shard_engines):
+    for table in tables:
+        if 'id' not in table.columns:
+            continue
+        lowest, highest = connection.exec_driver_sql(
+            f'SELECT min(id), max(id) FROM main.{table.name}').one()
+        if lowest is None:
+            continue
+        taken = 0
+        for shard_engine in shard_engines:
+            with shard_engine.connect() as shard:
+                taken = max(taken, shard.exec_driver_sql(
+                    f'SELECT coalesce(max(id), 0) '
+                    f'FROM main.{table.name}').scalar())
+        if lowest > taken:
+            continue
+        offset = max(taken, highest)
+        connection.exec_driver_sql(
+            f'UPDATE main.{table.name} SET id = id + ?', (offset,))
+        for referring in tables:
+            for key in referring.foreign_keys:
+                if key.column is table.columns['id']:
+                    connection.exec_driver_sql(
+                        f'UPDATE main.{referring.name} '
+                        f'SET {key.parent.name} = {key.parent.name} + ?',
+                        (offset,))
+
+
+# Move the per-user rows of the main database into the shards. The rows are
+# first renumbered past the ids the shards use, then each shard copies its
+# users' rows with a plain INSERT, which fails rather than overwrite a row,
+# deletes them from the main database and rebuilds its rollups, all in one
+# transaction, so a split interrupted between shards can be run again. The
+# rollup tables are not copied but rebuilt, since a user's rows may now be
+# in both places. Returns the rows copied per table, by shard.
+def split(engine=None, shard_engines=None):
+    engine = engine or create.engine
+    shard_engines = shard_engines or create.shard_engines
+    if not shard_engines:
+        raise ShardError("HEALTH_DB_SHARDS is not set above one.")
+    with engine.connect() as connection:
+        if connection.scalar(select(Partition.name).limit(1)) is not None:
+            raise ShardError(
+                "The main database has partitions; drop them (see "
+                "partitions.py) before splitting it.")
+        if connection.scalar(select(ArchiveStub.user_id).limit(1)) \
+                is not None:
+            raise ShardError(
+                "The main database has archived months, whose cold store "
+                "cannot be split; split it before archiving.")
+    skipped = [Partition.__table__, ArchiveStub.__table__, *ROLLUP_TABLES]
+    tables = [table for table in SHARD_TABLES if table not in skipped]
+
+    with engine.begin() as connection:
+        _renumber(connection, tables, shard_engines)
+        for table in ROLLUP_TABLES:
+            connection.exec_driver_sql(f'DELETE FROM main.{table.name}')
+
+    copied = []
+    for index, shard_engine in enumerate(shard_engines):
+        rows = {}
+        with shard_engine.begin() as connection:
+            conditions = {table.name: _shard_condition(
+                table, index, len(shard_engines)) for table in tables}
+            for table in tables:
+                condition, parameters = conditions[table.name]
+                columns = ', '.join(table.columns.keys())
+                rows[table.name] = connection.exec_driver_sql(
+                    f'INSERT INTO main.{table.name} ({columns}) '
+                    f'SELECT {columns} FROM common.{table.name} '
+                    f'WHERE {condition}', parameters).rowcount
+            for table in reversed(tables):
+                condition, parameters = conditions[table.name]
+                connection.exec_driver_sql(
+                    f'DELETE FROM common.{table.name} WHERE {condition}',
+                    parameters)
+            rebuild_rollups(connection)
+        copied.append(rows)
+    return copied
+
+
+# Rows per per-user table in the main database and in each shard
+def shard_rows(engine=None, shard_engines=None):
+    engine = engine or create.engine
+    shard_engines = shard_engines or create.shard_engines
+    places = [('main', engine)] + [(f'shard{index}', shard_engine)
+                                   for index, shard_engine
+                                   in enumerate(shard_engines)]
+    rows = []
+    for name, place in places:
+        with place.connect() as connection:
+            rows.append((name, {
+                table: connection.exec_driver_sql(
+                    f'SELECT count(*) FROM main.{table}').scalar()
+                for table in ('workouts', 'meals', 'health_metrics',
+                              'sleep_logs')}))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Split the per-user rows into the user shards.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    split_command = commands.add_parser(
+        'split', help="move the per-user rows of the main database into "
+                      "their shards")
+    split_command.add_argument('--vacuum', action='store_true',
+                               help="VACUUM the main database afterwards to "
+                                    "give the freed pages back")
+    commands.add_parser('list', help="list the rows of each shard")
+    args = parser.parse_args()
+    engine = init_db(splitting=args.command == 'split')
+
+    if args.command == 'split':
+        started = time.perf_counter()
+        for index, copied in enumerate(split()):
+            print(f"shard{index}: " + ', '.join(
+                f"{count} {table}" for table, count in copied.items()
+                if count))
+        if args.vacuum:
+            with engine.connect() as connection:
+                connection.exec_driver_sql('VACUUM main')
+        print(f"Done in {time.perf_counter() - started:.2f}s")
+    elif args.command == 'list':
+        for name, rows in shard_rows():
+            print(f"{name:>7}  " + ', '.join(
+                f"{count} {table}" for table, count in rows.items()))